@@ -1,7 +1,5 @@
-import os
-from loop import get_filelist
-list00 = get_filelist('D:\\paper\\fall_detection\\images\\', [])
-for i in range(0,len(list00)):
-    st = "python recolor.py -i " + list00[i]
-    print(st)
-    os.system(st)
+from loop import get_filelist
+from recolor import Recolor
+list00 = get_filelist('D:\\paper\\fall_detection\\images\\', [])
+# all images in this process: imports and models are loaded once, not once per image
+Recolor().run_batch(list00)
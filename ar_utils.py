@@ -19,6 +19,15 @@ methods = [
     "ideepcolor-px-grid+selective"
 ]
 
+# .mask format version 2, see Mask.to_bytes_v2
+MASK_V2_MAGIC = b"RCMK"
+# magic, version, layout, compression, mask size, p, grid_size, cell step, ab_step, a min, a bits, b min, b bits,
+# coordinate bits, number of cues
+_mask_v2_header = struct.Struct("<4sBBBHBBHBbBbBBI")
+# cue positions: delta coded cell indices, every cell of a grid, bitmap of the occupied cells of a grid
+MASK_LAYOUT_COORDS, MASK_LAYOUT_GRID, MASK_LAYOUT_BITMAP = 0, 1, 2
+mask_compressions = [None, "zlib", "zstd"]
+
 
 class Mask(object):
     def __init__(self, size=256, p=1):
@@ -42,11 +51,52 @@ class Mask(object):
         self.input_ab[:, loc[0] - p : loc[0] + p + 1, loc[1] - p : loc[1] + p + 1] = np.array(val)[:, np.newaxis, np.newaxis]
         self.mask[:, loc[0] - p : loc[0] + p + 1, loc[1] - p : loc[1] + p + 1] = 1
 
-    def save(self, path, name, grid_size=None, name_extra=None, round_to_int=True, method="bytes"):
+    def put_points(self, locs, vals):
+        """
+        Same as calling put_point for every point in order, but for all points at once.
+        Where patches overlap, the later point wins.
+        :param locs: Nx2 array of (h,w)
+        :param vals: Nx2 array of (a,b)
+        """
+        locs = np.asarray(locs, dtype=int).reshape(-1, 2)
+        vals = np.asarray(vals).reshape(-1, 2)
+        if not len(locs):
+            return
+        p = self.p
+        idx = np.arange(len(locs))
+        # cell ranges of the slices [loc-p : loc+p+1] in put_point, with python slicing of negative values
+        y_start, y_stop = self._slice_bounds(locs[:, 0] - p, locs[:, 0] + p + 1)
+        x_start, x_stop = self._slice_bounds(locs[:, 1] - p, locs[:, 1] + p + 1)
+
+        # index of the last point covering each cell
+        owner = np.full((self.size, self.size), -1, dtype=np.int64)
+        for dy in range(2 * p + 1):
+            for dx in range(2 * p + 1):
+                y_cells = y_start + dy
+                x_cells = x_start + dx
+                inside = (y_cells < y_stop) & (x_cells < x_stop)
+                np.maximum.at(owner, (y_cells[inside], x_cells[inside]), idx[inside])
+
+        cells = owner >= 0
+        self.input_ab[:, cells] = vals[owner[cells]].T
+        self.mask[:, cells] = 1
+
+    def _slice_bounds(self, start, stop):
+        """
+        Vectorized slice(start, stop).indices(self.size)
+        """
+        start = np.clip(np.where(start < 0, start + self.size, start), 0, self.size)
+        stop = np.clip(np.where(stop < 0, stop + self.size, stop), 0, self.size)
+        return start, stop
+
+    def save(self, path, name, grid_size=None, name_extra=None, round_to_int=True, method="bytes", version=1,
+             ab_step=1, compression=None):
         """
         :param grid_size: optional, for grids, if set saves grid size, saves on coordinates
+        :param version: "bytes" format version, 1 or 2 (bit packed, see to_bytes_v2)
+        :param ab_step: version 2: precision of a/b, 1: lossless
+        :param compression: version 2: None, "zlib" or "zstd"
         """
-        # TODO: round to 2 and change to bitwise save (Saves one bit per a/b)
         save_path = os.path.join(path, gen_new_mask_filename(name, extras=name_extra))
 
         if method == "numpy" or method == "np":
@@ -69,36 +119,130 @@ class Mask(object):
                         writer.writerow(row)
 
         elif method == "bytes":
-            if self.size > 256:
-                coord_type = "H"
-            else:
-                coord_type = "B"
             with open(save_path, "wb") as f:
-                # first two Bytes save the mask size. -> coord Byte size and for restoring mask size
-                f.write(struct.pack("H", self.size))
-                # 3. Byte stores p size and if grid size is saved in next 2 Bytes -> last bit 1 (unsigned char "B")
-                third_byte = self.p
-                # TODO: fix weird bug with p>0 and grid method
-                if grid_size:
-                    # assuming p size is <128, which would be ridiculous anyway
-                    third_byte = third_byte + (1 << 7)  # set last bit to 1
-                f.write(struct.pack("B", third_byte))
-                # 4. Byte optional grid_size (unsigned char) unlikely to be >255
-                if grid_size:
-                    f.write(struct.pack("B", grid_size))
+                if version == 2:
+                    f.write(self.to_bytes_v2(grid_size, ab_step=ab_step, compression=compression))
+                else:
+                    f.write(self.to_bytes(grid_size))
 
-                for y in range(self.size):
-                    for x in range(self.size):
-                        if self.mask[0][y][x] == 0:
-                            continue
-                        a = int(self.input_ab[0][y][x])
-                        b = int(self.input_ab[1][y][x])
-                        # Not using grid, save coordinates
-                        if grid_size is None:
-                            f.write(struct.pack(coord_type, y))
-                            f.write(struct.pack(coord_type, x))
-                        f.write(struct.pack("b", a))
-                        f.write(struct.pack("b", b))
+    def to_bytes(self, grid_size=None) -> bytes:
+        """
+        Serializes the mask into the "bytes" sidecar format
+        :param grid_size: optional, for grids, if set saves grid size, saves on coordinates
+        """
+        # first two Bytes save the mask size. -> coord Byte size and for restoring mask size
+        header = struct.pack("H", self.size)
+        # 3. Byte stores p size and if grid size is saved in next 2 Bytes -> last bit 1 (unsigned char "B")
+        third_byte = self.p
+        # TODO: fix weird bug with p>0 and grid method
+        if grid_size:
+            # assuming p size is <128, which would be ridiculous anyway
+            third_byte = third_byte + (1 << 7)  # set last bit to 1
+        header += struct.pack("B", third_byte)
+        # 4. Byte optional grid_size (unsigned char) unlikely to be >255
+        if grid_size:
+            header += struct.pack("B", grid_size)
+
+        # row by row, same order as the cues are read back in
+        ys, xs = np.nonzero(self.mask[0])
+        a = self.input_ab[0][ys, xs].astype(np.int64)
+        b = self.input_ab[1][ys, xs].astype(np.int64)
+        if len(ys) and (min(a.min(), b.min()) < -128 or max(a.max(), b.max()) > 127):
+            raise ValueError("a/b values have to be in range -128 - 127 to be saved as signed char")
+
+        # Not using grid, save coordinates
+        records = np.empty(len(ys), dtype=self._record_dtype(self.size, with_coords=not grid_size))
+        if not grid_size:
+            records["y"] = ys
+            records["x"] = xs
+        records["a"] = a
+        records["b"] = b
+        return header + records.tobytes()
+
+    def to_bytes_v2(self, grid_size=None, ab_step=1, compression=None) -> bytes:
+        """
+        Serializes the mask into version 2 of the "bytes" sidecar format. With ab_step 1, decodes to the same mask as
+        version 1 for coordinate masks (any p) and for grids with p=0. Grids with p>0 differ: version 1 doesn't save
+        their positions and restores the cues on the grid, which doesn't match the saved cues (see the TODO in
+        to_bytes), version 2 saves the positions of the cues.
+        Header (_mask_v2_header, little endian) followed by the payload, optionally compressed as a whole:
+        cue positions, then a values, then b values, each part bit packed and starting at a full byte.
+        Positions are stored in the smallest of 3 layouts:
+        - every cell of a grid: nothing to store, only the cell step
+        - bitmap of the occupied cells of a grid, e.g. grid-exclude. The grid is found automatically.
+        - delta coded indices (y * size + x) of the occupied cells, e.g. selective
+        a/b values are stored as (value - min) / ab_step, with as many bits as the largest one needs.
+        :param grid_size: optional, saved for the filename of the decoder, like in version 1
+        :param ab_step: precision of a/b, 1: lossless, 2: round to 2, ...
+        :param compression: None, "zlib" or "zstd" (needs zstandard)
+        """
+        ys, xs = np.nonzero(self.mask[0])
+        a = self.input_ab[0][ys, xs].astype(np.int64)
+        b = self.input_ab[1][ys, xs].astype(np.int64)
+        if len(ys) and (min(a.min(), b.min()) < -128 or max(a.max(), b.max()) > 127):
+            raise ValueError("a/b values have to be in range -128 - 127")
+        if not 1 <= ab_step <= 255:
+            raise ValueError("ab_step has to be in range 1 - 255")
+
+        # positions
+        layout, cell_step, coord_bits, positions = self._pack_positions_v2(ys, xs)
+
+        # values
+        parts = [positions]
+        ab_header = []
+        for vals in (a, b):
+            v_min = int(vals.min()) if len(vals) else 0
+            q = np.rint((vals - v_min) / ab_step).astype(np.uint64)
+            bits = int(q.max()).bit_length() if len(q) else 0
+            parts.append(_pack_bits(q, bits))
+            ab_header += [v_min, bits]
+
+        payload = b"".join(parts)
+        if compression == "zlib":
+            import zlib
+            payload = zlib.compress(payload, 9)
+        elif compression == "zstd":
+            import zstandard
+            payload = zstandard.ZstdCompressor(level=19).compress(payload)
+        elif compression is not None:
+            raise ValueError("Unknown compression: " + str(compression))
+
+        header = _mask_v2_header.pack(MASK_V2_MAGIC, 2, layout, mask_compressions.index(compression), self.size,
+                                      self.p, grid_size or 0, cell_step, ab_step, ab_header[0], ab_header[1],
+                                      ab_header[2], ab_header[3], coord_bits, len(ys))
+        return header + payload
+
+    def _pack_positions_v2(self, ys, xs):
+        """
+        :return: tuple (layout, cell step, bits per coordinate, packed positions)
+        """
+        count = len(ys)
+        # coarsest grid, that all cues are on
+        cell_step = max(1, int(np.gcd.reduce(np.concatenate((ys, xs))))) if count else 1
+        cells_per_row = -(-self.size // cell_step)
+        if count == cells_per_row ** 2:
+            return MASK_LAYOUT_GRID, cell_step, 0, b""
+
+        idx = ys.astype(np.int64) * self.size + xs
+        # no prepend= of diff, needs numpy >= 1.16
+        deltas = np.diff(np.concatenate(([-1], idx))) - 1
+        coord_bits = int(deltas.max()).bit_length() if count else 0
+        if cells_per_row ** 2 <= count * coord_bits:
+            bitmap = np.zeros((cells_per_row, cells_per_row), dtype=np.uint8)
+            bitmap[ys // cell_step, xs // cell_step] = 1
+            return MASK_LAYOUT_BITMAP, cell_step, 0, np.packbits(bitmap.ravel()).tobytes()
+        return MASK_LAYOUT_COORDS, 1, coord_bits, _pack_bits(deltas, coord_bits)
+
+    @staticmethod
+    def _record_dtype(mask_size, with_coords=True):
+        """
+        One cue in the "bytes" format: y, x (unsigned char, unsigned short for masks >256, native byte order), a, b (signed char)
+        """
+        fields = [("a", np.int8), ("b", np.int8)]
+        if with_coords:
+            coord_type = np.uint16 if mask_size > 256 else np.uint8
+            fields = [("y", coord_type), ("x", coord_type)] + fields
+        return np.dtype(fields)
 
     def load(self, path, name, name_extra=None, method="bytes", initialize=True):
         """
@@ -136,41 +280,280 @@ class Mask(object):
 
         elif method == "bytes":
             with open(save_path, "rb") as f:
-                # first 2 Byte: mask size
-                saved_mask_size = struct.unpack("H", f.read(2))[0]
-                # Restore saved mask size
-                if self.size != saved_mask_size and initialize:
-                    self.size = saved_mask_size
-                    self._init_mask()
-                # 3. Byte: p size
-                third_byte = struct.unpack("B", f.read(1))[0]
-                # if lsb is 0 (<128) -> no grid_size saved -> coordinates needed
-                self.p = third_byte & 0b1111111
-                if (third_byte - self.p) >= (1 << 7):
-                    # read optional 4. Byte
-                    self.grid_size = struct.unpack("B", f.read(1))[0]
-
-                coord_type, coord_bytes = ( ("H", 2) if saved_mask_size > 256 else ("B", 1) )
-                for y in range(self.size):
-                    for x in range(self.size):
-                        if self.grid_size:
-                            if y % self.grid_size != 0 or x % self.grid_size != 0:
-                                continue
-                        if self.grid_size is None:
-                            y = f.read(coord_bytes)
-                            x = f.read(coord_bytes)
-                            if not all((y, x)):
-                                break
-                            y = struct.unpack(coord_type, y)[0]
-                            x = struct.unpack(coord_type, x)[0]
-
-                        a = f.read(1)
-                        b = f.read(1)
-                        if not all((a, b)):
-                            break
-                        a = struct.unpack("b", a)[0]
-                        b = struct.unpack("b", b)[0]
-                        self.put_point((y, x), (a, b))
+                self.from_bytes(f.read(), initialize=initialize)
+
+    def from_bytes(self, data, initialize=True):
+        """
+        Restores the mask from the "bytes" sidecar format, version 1 or 2 (detected by its header)
+        :param initialize: if mask size differs from saved size, reinitialize mask with saved size
+        """
+        saved_mask_size, p, grid_size, locs, vals = self.parse_cues(data, self.grid_size)
+        # Restore saved mask size
+        if self.size != saved_mask_size and initialize:
+            self.size = saved_mask_size
+            self._init_mask()
+        self.p = p
+        if grid_size:
+            self.grid_size = grid_size
+        self.put_points(locs, vals)
+
+    @staticmethod
+    def parse_cues(data, grid_size=None):
+        """
+        Reads the cues of the "bytes" sidecar format, version 1 or 2, without creating the dense mask arrays
+        :param grid_size: version 1: grid size to use, if the file doesn't contain one
+        :return: tuple (mask size, p, grid size, Nx2 array of (h,w), Nx2 array of (a,b)), cues in the order they are put
+        """
+        if data[:len(MASK_V2_MAGIC)] == MASK_V2_MAGIC:
+            return Mask._parse_cues_v2(data)
+        # first 2 Byte: mask size
+        saved_mask_size = struct.unpack_from("H", data, 0)[0]
+        # 3. Byte: p size
+        third_byte = data[2]
+        offset = 3
+        # if lsb is 0 (<128) -> no grid_size saved -> coordinates needed
+        p = third_byte & 0b1111111
+        if (third_byte - p) >= (1 << 7):
+            # read optional 4. Byte
+            grid_size = data[3]
+            offset = 4
+
+        if grid_size:
+            # only values saved, in order of the grid positions
+            record_dtype = Mask._record_dtype(saved_mask_size, with_coords=False)
+            records = np.frombuffer(data, dtype=record_dtype, offset=offset,
+                                    count=(len(data) - offset) // record_dtype.itemsize)
+            grid = np.arange(0, saved_mask_size, grid_size)
+            grid_y, grid_x = np.meshgrid(grid, grid, indexing="ij")
+            n = min(len(records), grid_y.size)
+            records = records[:n]
+            locs = np.stack((grid_y.ravel()[:n], grid_x.ravel()[:n]), axis=1)
+        else:
+            record_dtype = Mask._record_dtype(saved_mask_size, with_coords=True)
+            records = np.frombuffer(data, dtype=record_dtype, offset=offset,
+                                    count=(len(data) - offset) // record_dtype.itemsize)
+            locs = np.stack((records["y"], records["x"]), axis=1)
+
+        return saved_mask_size, p, grid_size, locs, np.stack((records["a"], records["b"]), axis=1)
+
+    @staticmethod
+    def parse_size(data):
+        """
+        Mask size of the "bytes" sidecar format, version 1 or 2, read from the header only
+        """
+        if data[:len(MASK_V2_MAGIC)] == MASK_V2_MAGIC:
+            return _mask_v2_header.unpack_from(data, 0)[4]
+        return struct.unpack_from("H", data, 0)[0]
+
+    @staticmethod
+    def _parse_cues_v2(data):
+        """
+        Reads the cues of version 2 of the "bytes" format, see to_bytes_v2 and parse_cues
+        """
+        (magic, version, layout, compression, saved_mask_size, p, grid_size, cell_step, ab_step,
+         a_min, a_bits, b_min, b_bits, coord_bits, count) = _mask_v2_header.unpack_from(data, 0)
+        if version != 2:
+            raise ValueError("Unsupported mask format version: " + str(version))
+
+        payload = memoryview(data)[_mask_v2_header.size:]
+        if mask_compressions[compression] == "zlib":
+            import zlib
+            payload = zlib.decompress(payload)
+        elif mask_compressions[compression] == "zstd":
+            import zstandard
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+
+        cells_per_row = -(-saved_mask_size // cell_step)
+        offset = 0
+        if layout == MASK_LAYOUT_COORDS:
+            deltas, offset = _unpack_bits(payload, offset, count, coord_bits)
+            idx = np.cumsum(deltas.astype(np.int64) + 1) - 1
+            ys, xs = np.divmod(idx, saved_mask_size)
+        else:
+            if layout == MASK_LAYOUT_BITMAP:
+                # no count= of unpackbits, needs numpy >= 1.17
+                bitmap = np.unpackbits(np.frombuffer(payload, dtype=np.uint8,
+                                                     count=(cells_per_row ** 2 + 7) // 8))[:cells_per_row ** 2]
+                offset = (cells_per_row ** 2 + 7) // 8
+                cells = np.nonzero(bitmap)[0]
+            else:
+                cells = np.arange(count)
+            ys, xs = np.divmod(cells, cells_per_row)
+            ys, xs = ys * cell_step, xs * cell_step
+
+        a, offset = _unpack_bits(payload, offset, count, a_bits)
+        b, offset = _unpack_bits(payload, offset, count, b_bits)
+        vals = np.stack((a_min + a.astype(np.int64) * ab_step, b_min + b.astype(np.int64) * ab_step), axis=1)
+        return saved_mask_size, p, grid_size or None, np.stack((ys, xs), axis=1), vals
+
+    @classmethod
+    def from_cues_window(cls, locs, vals, p, y0, x0, size):
+        """
+        Mask of the window [y0:y0+size, x0:x0+size] of a bigger mask with the cues locs, vals, e.g. a tile of it.
+        Same content as the window of the big mask after put_points(locs, vals), without creating the big mask.
+        :param locs: Nx2 array of (h,w) in the big mask
+        """
+        locs = np.asarray(locs, dtype=np.int64).reshape(-1, 2)
+        vals = np.asarray(vals).reshape(-1, 2)
+        # put_points drops patches crossing the top or left border of the big mask (negative slice start)
+        keep = (locs >= p).all(axis=1)
+        # cues with patches reaching into the window
+        keep &= (locs[:, 0] >= y0 - p) & (locs[:, 0] < y0 + size + p)
+        keep &= (locs[:, 1] >= x0 - p) & (locs[:, 1] < x0 + size + p)
+        # padding of 2p, so no local patch starts at a negative index
+        padded = cls(size + 4 * p, p)
+        padded.put_points(locs[keep] - (y0 - 2 * p, x0 - 2 * p), vals[keep])
+        mask = cls(size, p)
+        mask.input_ab = padded.input_ab[:, 2 * p:2 * p + size, 2 * p:2 * p + size]
+        mask.mask = padded.mask[:, 2 * p:2 * p + size, 2 * p:2 * p + size]
+        return mask
+
+
+class IntermediateRepresentation(object):
+    """
+    Grayscale image + color cues of one image in memory, same content as its files in the intermediate representation folder.
+    Lets the Decoder use the output of the Encoder directly, without writing and reading the files.
+    """
+
+    def __init__(self, img_path, gray, masks=None, glob_dist=None, mask_options=None, glob_dist_options=None,
+                 mask_data=None, glob_dist_data=None):
+        """
+        :param img_path: path to the original color image
+        :param gray: grayscale image HxW uint8
+        :param masks: list of (Mask, grid_size), more than one is saved with name extras "1", "2", ...
+        :param glob_dist: global distribution (313 bins) or None
+        :param mask_options: keyword arguments for Mask.save, e.g. version=2, ab_step=2
+        :param glob_dist_options: keyword arguments for save_glob_dist, e.g. version=2, dtype="uint8"
+        :param mask_data: instead of masks: list of serialized masks (content of the .mask files)
+        :param glob_dist_data: instead of glob_dist: content of the .glob_dist file
+        """
+        self.img_path = img_path
+        self.gray = gray
+        self.masks = masks if masks is not None else []
+        self.glob_dist = glob_dist
+        self.mask_options = mask_options if mask_options is not None else {}
+        self.glob_dist_options = glob_dist_options if glob_dist_options is not None else {}
+        self.mask_data = mask_data
+        self.glob_dist_data = glob_dist_data
+
+    @classmethod
+    def from_archive(cls, archive, gray_name):
+        """
+        Loads the grayscale image and its sidecar files from an ir_archive.IRArchive, without extracting them.
+        :param gray_name: name of the grayscale image in the archive, e.g. "img.gray.png"
+        """
+        gray = cv2.imdecode(np.frombuffer(archive.read(gray_name), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if gray is None:
+            raise IOError("Can't decode image " + gray_name)
+        mask_name = gen_new_mask_filename(gray_name)
+        if mask_name in archive:
+            mask_data = [bytes(archive.read(mask_name))]
+        else:
+            # two masks of grid+selective
+            mask_data = [bytes(archive.read(gen_new_mask_filename(gray_name, extras=str(i))))
+                         for i in (1, 2) if gen_new_mask_filename(gray_name, extras=str(i)) in archive]
+        glob_dist_name = _encode_glob_dist_path(gray_name)
+        glob_dist_data = bytes(archive.read(glob_dist_name)) if glob_dist_name in archive else None
+        # the grayscale name keeps all derived filenames the same as for the extracted files
+        return cls(gray_name, gray, mask_data=mask_data, glob_dist_data=glob_dist_data)
+
+    @property
+    def gray_filename(self):
+        return gen_new_gray_filename(self.img_path)
+
+    def get_mask(self, size=256, p=0):
+        """
+        Combined mask, exactly as the Decoder would load it from the sidecar file(s): values truncated to int,
+        later masks put over the first one.
+        """
+        mask = Mask(size, p)
+        for i, data in enumerate(self.mask_bytes()):
+            if i:
+                mask.grid_size = None
+            mask.from_bytes(data, initialize=(i == 0))
+        return mask
+
+    def get_glob_dist(self):
+        """
+        Global distribution with the precision of the .glob_dist file
+        """
+        if self.glob_dist_data is not None:
+            return glob_dist_from_bytes(self.glob_dist_data)
+        return glob_dist_from_bytes(glob_dist_to_bytes(self.glob_dist, **self.glob_dist_options), len(self.glob_dist))
+
+    def files(self) -> dict:
+        """
+        Content of all files of this image in the intermediate representation, grayscale image last.
+        :return: dict filename -> bytes
+        """
+        files = {}
+        mask_name = os.path.basename(gen_new_mask_filename(self.img_path))
+        mask_bytes = self.mask_bytes()
+        for i, data in enumerate(mask_bytes):
+            name_extra = str(i + 1) if len(mask_bytes) > 1 else None
+            files[gen_new_mask_filename(mask_name, extras=name_extra)] = data
+        if self.glob_dist_data is not None:
+            files[os.path.basename(_encode_glob_dist_path(self.img_path))] = self.glob_dist_data
+        elif self.glob_dist is not None:
+            files[os.path.basename(_encode_glob_dist_path(self.img_path))] = glob_dist_to_bytes(
+                self.glob_dist, **self.glob_dist_options)
+        ok, gray = cv2.imencode(get_fn_wo_ext(self.img_path)[1], self.gray)
+        if not ok:
+            raise IOError("Can't encode image " + self.gray_filename)
+        files[self.gray_filename] = gray.tobytes()
+        return files
+
+    def save(self, path):
+        """
+        Writes grayscale image and sidecar files to folder path.
+        Grayscale image last, so a watching Decoder finds the sidecar files complete.
+        :return: path to the grayscale image
+        """
+        for name, data in self.files().items():
+            with open(os.path.join(path, name), "wb") as f:
+                f.write(data)
+        return os.path.join(path, self.gray_filename)
+
+    def mask_bytes(self):
+        """
+        :return: list of serialized masks, content of the .mask files
+        """
+        if self.mask_data is not None:
+            return self.mask_data
+        options = dict(self.mask_options)
+        if options.pop("version", 1) == 2:
+            return [m.to_bytes_v2(grid_size, **options) for m, grid_size in self.masks]
+        return [m.to_bytes(grid_size) for m, grid_size in self.masks]
+
+
+def _pack_bits(values, bits) -> bytes:
+    """
+    Packs unsigned integers with bits bits each, most significant bit first
+    """
+    values = np.asarray(values)
+    if bits == 0 or not len(values):
+        return b""
+    if bits == 8:
+        return values.astype(np.uint8).tobytes()
+    shifts = np.arange(bits - 1, -1, -1, dtype=np.uint64)
+    bit_array = (values.astype(np.uint64)[:, np.newaxis] >> shifts) & 1
+    return np.packbits(bit_array.astype(np.uint8)).tobytes()
+
+
+def _unpack_bits(data, offset, count, bits):
+    """
+    Reverse of _pack_bits
+    :return: tuple (array of count unsigned integers, offset after them)
+    """
+    if bits == 0 or not count:
+        return np.zeros(count, dtype=np.uint64), offset
+    n_bytes = (count * bits + 7) // 8
+    raw = np.frombuffer(data, dtype=np.uint8, count=n_bytes, offset=offset)
+    if bits == 8:
+        return raw.astype(np.uint64), offset + n_bytes
+    bit_array = np.unpackbits(raw)[:count * bits].reshape(count, bits)
+    weights = np.uint64(1) << np.arange(bits - 1, -1, -1, dtype=np.uint64)
+    return bit_array.astype(np.uint64) @ weights, offset + n_bytes
 
 
 # TODO: rename to save_img_lab
@@ -224,6 +607,28 @@ def gen_new_recolored_filename(orig_fn, method, extras=[]):
     return new_fn
 
 
+def parse_recolored_filename(filename):
+    """
+    Inverse of gen_new_recolored_filename. The method is the longest of methods, that matches,
+    e.g. ideepcolor-px-grid-exclude instead of ideepcolor-px-grid. Unknown methods end at the next "_".
+    :param filename: recolored filename or path, e.g. rgb_0001_recolored_ideepcolor-px-grid_256_10.png
+    :return: tuple (original filename wo extension, method, list of extras as strings, extension),
+        None if filename isn't a recolored filename
+    """
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    orig_fn_wo_ext, sep, rest = stem.rpartition("_recolored_")
+    if not sep or not orig_fn_wo_ext or not rest:
+        return None
+    method = None
+    for m in methods:
+        if (rest == m or rest.startswith(m + "_")) and (method is None or len(m) > len(method)):
+            method = m
+    if method is None:
+        method = rest.split("_", 1)[0]
+    extras = rest[len(method) + 1:].split("_") if len(rest) > len(method) else []
+    return orig_fn_wo_ext, method, extras, ext
+
+
 def gen_new_mask_filename(input_image_path, extras=None) -> str:
     """
     Generates a new filename without extension by appending the parameters.
@@ -259,57 +664,118 @@ def gen_new_hist_filename(method, input_image_path, load_size) -> str:
     return new_filename
 
 
-def save_glob_dist(out_path, name, glob_dist, elements=313) -> str:
+def save_glob_dist(out_path, name, glob_dist, elements=313, version=1, dtype="float16") -> str:
     """
     Save global distribution array
     :param path: output folder
     :param name: either original image filename or full path to original image
+    :param version: file format, see glob_dist_to_bytes
+    :param dtype: version 2: precision of the values, see glob_dist_to_bytes
     :return: str New path + filename it was saved to
     """
-    # TODO: check if elements after 256 are empty and only save 256 first with 1 index Byte
-    if elements < 256:
-        print("Elements < 256. You are wasting one Byte! Consider saving the index as unsigned char ('B')")
-
     path = _encode_glob_dist_path(os.path.join(out_path, os.path.basename(name)))
     # wb: write binary
     with open(path, "wb") as f:
-        for idx, val in enumerate(glob_dist):
-            # print(idx, val)
-            # don't save elements without content
-            if val == 0.0:
-                continue
-            # h = unsigned short (2 Byte)
-            f.write(struct.pack("h", idx))
-            # f = float (4 Byte)
-            f.write(struct.pack("f", val))
+        f.write(glob_dist_to_bytes(glob_dist, elements, version=version, dtype=dtype))
     return path
 
 
 def load_glob_dist(img_path, elements=313) -> np.ndarray:
     """
-    Load global distribution array
+    Load global distribution array, version 1 or 2
     :param img_path: path to image with sidecar .glob_dist file or file itself
     :param elements: length of glob_dist array.
     """
-    # TODO: shift elements into 256, if leading & trailing 0 and save offset -> 1 Byte for idx
-    glob_dist = np.zeros(elements)
     path = _encode_glob_dist_path(img_path)
     with open(path, "rb") as f:
-        while True:
-            # h: u short = 2 Byte
-            i = f.read(2)
-            if not i:
-                break
-            idx = struct.unpack("h", i)[0]
-            # f: float = 4 Byte
-            v = f.read(4)
-            if not v:
-                break
-            val = struct.unpack("f", v)[0]
-            glob_dist[idx] = val
+        return glob_dist_from_bytes(f.read(), elements)
+
+
+# .glob_dist format version 2, see glob_dist_to_bytes
+GLOB_DIST_V2_MAGIC = b"RCGD"
+# magic, version, value type, index Bytes, offset, number of values, scale
+_glob_dist_v2_header = struct.Struct("<4sBBBHHf")
+glob_dist_dtypes = ["float32", "float16", "uint8"]
+# version 1: h = index (2 Byte), f = float (4 Byte) per non zero value
+_glob_dist_v1_dtype = np.dtype([("idx", "=i2"), ("val", "=f4")])
+
+
+def glob_dist_to_bytes(glob_dist, elements=313, version=1, dtype="float16") -> bytes:
+    """
+    Serializes the non zero values of a global distribution.
+    Version 1: 2 Byte index + 4 Byte float per value.
+    Version 2: header (_glob_dist_v2_header), then index - offset (1 Byte, 2 if the values span more than 256 bins)
+    + value per value, or without index all values from offset on, if that is smaller (most bins used).
+    Values as float32, float16 or uint8 * scale (scale = max / 255).
+    :param dtype: version 2: "float32" (same as version 1), "float16" or "uint8"
+    """
+    glob_dist = np.asarray(glob_dist)
+    idx = np.nonzero(glob_dist)[0]
+    vals = glob_dist[idx]
+    if version == 1:
+        if elements < 256:
+            print("Elements < 256. You are wasting one Byte! Consider saving the index as unsigned char ('B')")
+        records = np.empty(len(idx), dtype=_glob_dist_v1_dtype)
+        records["idx"] = idx
+        records["val"] = vals
+        return records.tobytes()
+
+    if dtype not in glob_dist_dtypes:
+        raise ValueError("dtype has to be one of: " + ", ".join(glob_dist_dtypes))
+    offset = int(idx[0]) if len(idx) else 0
+    span = int(idx[-1]) - offset + 1 if len(idx) else 0
+    value_bytes = np.dtype(dtype).itemsize
+    index_bytes = 1 if span <= 256 else 2
+    if span * value_bytes < len(idx) * (index_bytes + value_bytes):
+        # dense: no index, zeros in between are stored
+        index_bytes = 0
+        idx = np.arange(offset, offset + span)
+        vals = glob_dist[idx]
+    scale = 1.0
+    if dtype == "uint8":
+        scale = float(np.abs(vals).max()) / 255 if len(vals) else 1.0
+        vals = np.rint(vals / scale)
+    records = np.empty(len(idx), dtype=_glob_dist_v2_dtype(index_bytes, dtype))
+    if index_bytes:
+        records["idx"] = idx - offset
+    records["val"] = vals
+    header = _glob_dist_v2_header.pack(GLOB_DIST_V2_MAGIC, 2, glob_dist_dtypes.index(dtype), index_bytes, offset,
+                                       len(idx), scale)
+    return header + records.tobytes()
+
+
+def glob_dist_from_bytes(data, elements=313) -> np.ndarray:
+    """
+    Restores a global distribution from version 1 or 2 (detected by its header) of the .glob_dist format
+    """
+    glob_dist = np.zeros(elements)
+    if data[:len(GLOB_DIST_V2_MAGIC)] == GLOB_DIST_V2_MAGIC:
+        magic, version, dtype, index_bytes, offset, count, scale = _glob_dist_v2_header.unpack_from(data, 0)
+        if version != 2:
+            raise ValueError("Unsupported glob_dist format version: " + str(version))
+        records = np.frombuffer(data, dtype=_glob_dist_v2_dtype(index_bytes, glob_dist_dtypes[dtype]), count=count,
+                                offset=_glob_dist_v2_header.size)
+        if index_bytes:
+            glob_dist[records["idx"].astype(int) + offset] = records["val"].astype(np.float64) * scale
+        else:
+            glob_dist[offset:offset + count] = records["val"].astype(np.float64) * scale
+    else:
+        # ignore an incomplete last record, like reading 6 Bytes at a time did
+        records = np.frombuffer(data, dtype=_glob_dist_v1_dtype, count=len(data) // _glob_dist_v1_dtype.itemsize)
+        glob_dist[records["idx"]] = records["val"]
     return glob_dist
 
 
+def _glob_dist_v2_dtype(index_bytes, dtype):
+    """
+    One value in version 2: index (0: none, 1 or 2 Bytes) and value
+    """
+    fields = [("val", np.dtype(dtype).newbyteorder("<"))]
+    if index_bytes:
+        fields.insert(0, ("idx", "<u1" if index_bytes == 1 else "<u2"))
+    return np.dtype(fields)
+
+
 def _encode_glob_dist_path(img_path) -> str:
     """
     Generate new filename for global distribution file
@@ -333,6 +799,9 @@ def _coord_mask_to_img(h, w, y, x, size=256):
 
 def _coord_transform(src, target, val):
     # TODO: DON'T USE int() baka, -> int(round())
+    if isinstance(val, np.ndarray):
+        # same truncation as int(), for all coordinates at once
+        return ((src / target) * val).astype(int)
     return int((src / target) * val)
 
 
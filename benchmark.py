@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for automatic-recolorization. Every benchmark is a subcommand, e.g.:
+python benchmark.py decode-batch -i intermediate_representation
+"""
+
+import os, sys
+import argparse
+import time
+import ar_utils
+
+
+def find_gray_images(path):
+    """
+    Returns sorted list of all grayscale images (*.gray.*) in folder path
+    """
+    if os.path.isfile(path):
+        return [path]
+    return sorted(fil.path for fil in os.scandir(path)
+                  if fil.is_file() and ar_utils.get_fn_wo_ext(fil.name)[2] == ".gray")
+
+
+def print_table(header, rows):
+    print("| " + " | ".join(header) + " |")
+    print("|" + "|".join("---" for h in header) + "|")
+    for row in rows:
+        print("| " + " | ".join(str(r) for r in row) + " |")
+
+
+def bench_decode_batch(args):
+    """
+    images/sec of the per image decode loop compared to Decoder.decode_batch
+    """
+    import decoder
+    paths = find_gray_images(args.input_path)
+    if not paths:
+        print("No grayscale images found in: " + args.input_path)
+        return
+    # repeat input images to get enough for a stable measurement
+    paths = (paths * (args.images // len(paths) + 1))[:args.images]
+
+    dc = decoder.Decoder(output_path=args.output_path, method=args.method, size=args.size, gpu_id=args.gpu_id)
+    # load model before timing
+    dc.decode(paths[0])
+
+    rows = []
+    start = time.perf_counter()
+    for path in paths:
+        dc.decode(path)
+    elapsed = time.perf_counter() - start
+    rows.append(["loop", len(paths), "%.3f" % elapsed, "%.2f" % (len(paths) / elapsed)])
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        dc.decode_batch(paths, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        rows.append(["batch %d" % batch_size, len(paths), "%.3f" % elapsed, "%.2f" % (len(paths) / elapsed)])
+
+    print_table(["Mode", "Images", "Time (s)", "Images/s"], rows)
+    dc.session.report()
+
+
+def find_images(path):
+    """
+    Returns sorted list of all color images in folder path (no grayscale intermediate images)
+    """
+    import cv2
+    if os.path.isfile(path):
+        return [path]
+    paths = []
+    for fil in sorted(os.scandir(path), key=lambda f: f.name):
+        if not fil.is_file() or ar_utils.get_fn_wo_ext(fil.name)[2] == ".gray":
+            continue
+        if cv2.haveImageReader(fil.path):
+            paths.append(fil.path)
+    return paths
+
+
+def flood_fill_area_ids(ec, ab):
+    """
+    Previous blob labeling: one flood fill over the whole image per blob. Reference for the selective benchmark.
+    """
+    import numpy as np
+    ab = np.array(ab, dtype="uint32")
+    id_ = 0
+    for col in np.unique(ab):
+        while np.where(ab == col)[0].size:
+            found_pos = np.where(ab == col)
+            ab = ec.flood_fill(ab, (found_pos[0][0], found_pos[1][0]), id_)
+            id_ = id_ + 1
+    return ab
+
+
+def bench_selective(args):
+    """
+    Time of the blob labeling of ideepcolor-px-selective on Cityscapes sized (640x480) images
+    """
+    import cv2
+    import numpy as np
+    import encoder
+    paths = find_images(args.input_path)
+    if not paths:
+        print("No images found in: " + args.input_path)
+        return
+    ec = encoder.Encoder(output_path=args.output_path, method=ar_utils.methods[1])
+    rows = []
+    for path in paths:
+        rgb = ec.load_image(path, colorspace="rgb")
+        if args.width and args.height:
+            rgb = cv2.resize(rgb, (args.width, args.height), interpolation=cv2.INTER_AREA)
+        # blobs are searched in a downscaled image, same scaling as in get_color_mask_selective
+        scaling_factor = max(1, int(round(min(rgb.shape[:2]) / 250)))
+        rgb = cv2.resize(rgb, (rgb.shape[1] // scaling_factor, rgb.shape[0] // scaling_factor), interpolation=cv2.INTER_AREA)
+        lab = ec.rgb_to_lab(ec.denoise_image_for_px_selection(rgb))
+
+        start = time.perf_counter()
+        ab = ec.get_ab(lab[1].astype(int), lab[2].astype(int), args.round_to)
+        ab_ids = ec.set_color_area_ids(ab)
+        label_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ec.get_centres(ab_ids)
+        centres_time = time.perf_counter() - start
+
+        row = [os.path.basename(path), "%dx%d" % ab.shape[::-1], int(ab_ids.max()) + 1,
+               "%.4f" % label_time, "%.4f" % centres_time]
+        if args.reference:
+            start = time.perf_counter()
+            same = np.array_equal(flood_fill_area_ids(ec, ab), ab_ids)
+            row += ["%.4f" % (time.perf_counter() - start), same]
+        rows.append(row)
+
+    header = ["Image", "Blob image", "Blobs", "Labeling (s)", "Centres (s)"]
+    if args.reference:
+        header += ["Flood fill (s)", "Same blobs"]
+    print_table(header, rows)
+
+
+def random_mask(size, grid_size=None, p=0, points=None, keep=1.0, seed=0):
+    """
+    Mask filled with random a/b values, either on a grid or on random coordinates
+    :param keep: share of grid points to keep, like grid-exclude
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    mask = ar_utils.Mask(size=size, p=p)
+    if grid_size:
+        grid = np.arange(0, size, grid_size)
+        grid_y, grid_x = np.meshgrid(grid, grid, indexing="ij")
+        locs = np.stack((grid_y.ravel(), grid_x.ravel()), axis=1)
+        locs = locs[rng.random(len(locs)) < keep]
+    else:
+        locs = rng.integers(0, size, (points or size * 4, 2))
+    mask.put_points(locs, rng.integers(-110, 111, (len(locs), 2)))
+    return mask
+
+
+def mask_formats():
+    """
+    (name, keyword arguments for Mask.save) of all .mask formats to compare
+    """
+    formats = [("v1", {}), ("v2", dict(version=2)), ("v2 zlib", dict(version=2, compression="zlib"))]
+    try:
+        import zstandard
+        formats.append(("v2 zstd", dict(version=2, compression="zstd")))
+    except ImportError:
+        pass
+    formats.append(("v2 ab_step 2", dict(version=2, ab_step=2)))
+    return formats
+
+
+def bench_mask(args):
+    """
+    Size and serialize/parse speed of the .mask sidecar formats, round trip check of the file
+    """
+    import tempfile
+    import numpy as np
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            variants = [("grid", random_mask(size, grid_size=args.grid_size), args.grid_size),
+                        ("grid-exclude", random_mask(size, grid_size=args.grid_size, keep=0.6), None),
+                        ("selective", random_mask(size, points=max(1, size // 2)), None),
+                        ("coords", random_mask(size), None)]
+            for variant, mask, grid_size in variants:
+                reference = ar_utils.Mask()
+                reference.from_bytes(mask.to_bytes(grid_size))
+                for name, options in mask_formats():
+                    mask.save(tmp_dir, "bench.png", grid_size=grid_size, **options)
+                    path = os.path.join(tmp_dir, ar_utils.gen_new_mask_filename("bench.png"))
+                    with open(path, "rb") as f:
+                        data = f.read()
+
+                    start = time.perf_counter()
+                    for i in range(args.repeats):
+                        if options:
+                            mask.to_bytes_v2(grid_size, **{k: v for k, v in options.items() if k != "version"})
+                        else:
+                            mask.to_bytes(grid_size)
+                    save_time = (time.perf_counter() - start) / args.repeats
+
+                    loaded = ar_utils.Mask()
+                    start = time.perf_counter()
+                    for i in range(args.repeats):
+                        loaded.from_bytes(data)
+                    load_time = (time.perf_counter() - start) / args.repeats
+
+                    loaded = ar_utils.Mask()
+                    loaded.load(tmp_dir, "bench.png")
+                    same = np.array_equal(reference.input_ab, loaded.input_ab) and np.array_equal(reference.mask, loaded.mask)
+                    rows.append([size, variant, int(mask.mask.sum()), name, len(data),
+                                 "%.1f%%" % (100 * len(data) / max(1, len(reference.to_bytes(grid_size)))),
+                                 "%.3f" % (1000 * save_time), "%.3f" % (1000 * load_time), same])
+    print_table(["Size", "Variant", "Cues", "Format", "Bytes", "Of v1", "Serialize (ms)", "Parse (ms)", "Same as v1"],
+                rows)
+
+    # existing sidecar files have to be written back byte by byte identical
+    if args.input_path:
+        for fil in sorted(os.scandir(args.input_path), key=lambda f: f.name):
+            if not fil.name.endswith(".mask"):
+                continue
+            mask = ar_utils.Mask()
+            mask.load(args.input_path, fil.name)
+            with open(fil.path, "rb") as f:
+                identical = f.read() == mask.to_bytes(mask.grid_size)
+            print(fil.name + ": " + ("identical" if identical else "DIFFERENT"))
+
+
+def load_glob_dist_struct(data, elements=313):
+    """
+    Previous .glob_dist reader: 6 Bytes at a time with struct. Reference for the glob-dist benchmark.
+    """
+    import struct
+    import numpy as np
+    glob_dist = np.zeros(elements)
+    for pos in range(0, len(data) - 5, 6):
+        idx = struct.unpack("h", data[pos:pos + 2])[0]
+        glob_dist[idx] = struct.unpack("f", data[pos + 2:pos + 6])[0]
+    return glob_dist
+
+
+def bench_glob_dist(args):
+    """
+    Size, error and speed of the .glob_dist formats, on existing files and random distributions
+    """
+    import numpy as np
+    glob_dists = []
+    if args.input_path and os.path.isdir(args.input_path):
+        for fil in sorted(os.scandir(args.input_path), key=lambda f: f.name):
+            if fil.name.endswith(".glob_dist"):
+                with open(fil.path, "rb") as f:
+                    glob_dists.append(ar_utils.glob_dist_from_bytes(f.read()))
+    source = "%d files" % len(glob_dists)
+    if not glob_dists:
+        # probability distributions, half with most bins empty, half with every bin used
+        rng = np.random.default_rng(0)
+        for i in range(args.samples):
+            glob_dist = rng.dirichlet(np.full(313, 0.2))
+            if i % 2:
+                glob_dist = glob_dist * (rng.random(313) < 0.3)
+            glob_dists.append(glob_dist / max(glob_dist.sum(), 1e-12))
+        source = "%d random distributions" % len(glob_dists)
+
+    formats = [("v1", dict(version=1))] + [("v2 " + dtype, dict(version=2, dtype=dtype))
+                                           for dtype in ar_utils.glob_dist_dtypes]
+    rows = []
+    v1_bytes = None
+    for name, options in formats:
+        datas = [ar_utils.glob_dist_to_bytes(g, **options) for g in glob_dists]
+        start = time.perf_counter()
+        for g in glob_dists:
+            ar_utils.glob_dist_to_bytes(g, **options)
+        save_time = (time.perf_counter() - start) / len(glob_dists)
+        start = time.perf_counter()
+        loaded = [ar_utils.glob_dist_from_bytes(d) for d in datas]
+        load_time = (time.perf_counter() - start) / len(glob_dists)
+
+        errors = np.abs(np.array(loaded) - np.array(glob_dists))
+        size = np.mean([len(d) for d in datas])
+        v1_bytes = v1_bytes or size
+        rows.append([name, "%.1f" % size, "%.1f%%" % (100 * size / v1_bytes), "%.2e" % errors.max(),
+                     "%.2e" % errors.mean(), "%.1f" % (1e6 * save_time), "%.1f" % (1e6 * load_time)])
+
+    datas = [ar_utils.glob_dist_to_bytes(g) for g in glob_dists]
+    start = time.perf_counter()
+    for d in datas:
+        load_glob_dist_struct(d)
+    rows.append(["v1 struct reader", "", "", "", "", "", "%.1f" % (1e6 * (time.perf_counter() - start) / len(datas))])
+
+    print("Global distributions: " + source)
+    print_table(["Format", "Bytes", "Of v1", "Max error", "Mean error", "Write (us)", "Read (us)"], rows)
+
+
+# packages with a noticeable import time, reported if a run imported them
+# (colorize_image of interactive-deep-colorization is imported with importlib, which importtime doesn't show)
+heavy_packages = ["torch", "lpips", "sklearn", "skimage", "scipy", "PIL", "caffe", "fast_qa"]
+
+
+def parse_importtime(stderr):
+    """
+    Reads the output of python -X importtime
+    :return: tuple (import time of all top level imports in s, set of imported modules)
+    """
+    total_us = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # nested imports are indented by two more spaces
+        if not name.startswith("  "):
+            total_us += int(cumulative_us)
+        modules.add(name.strip())
+    return total_us / 1e6, modules
+
+
+def run_importtime(cli_args):
+    """
+    Runs a script of this repo with python -X importtime
+    :return: tuple (wall time in s, import time in s, imported heavy packages, return code)
+    """
+    import subprocess
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + cli_args, cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall_time = time.perf_counter() - start
+    import_time, modules = parse_importtime(proc.stderr)
+    heavy = [pkg for pkg in heavy_packages if any(m == pkg or m.startswith(pkg + ".") for m in modules)]
+    return wall_time, import_time, heavy, proc.returncode
+
+
+def bench_startup(args):
+    """
+    Startup and import time of every entry point, once with --help and once per method / metric on a small image
+    """
+    import tempfile
+    import numpy as np
+    import cv2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ref_dir = os.path.join(tmp_dir, "ref")
+        os.makedirs(ref_dir)
+        img_path = os.path.join(ref_dir, "startup.png")
+        cv2.imwrite(img_path, np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8))
+        ir_dir = os.path.join(tmp_dir, "ir")
+        out_dir = os.path.join(tmp_dir, "out")
+
+        runs = [["encoder.py", "--help"], ["decoder.py", "--help"], ["recolor.py", "--help"],
+                ["image_quality.py", "--help"]]
+        for method in args.methods:
+            runs.append(["encoder.py", "-i", img_path, "-o", ir_dir, "-m", method])
+            runs.append(["decoder.py", "-i", os.path.join(ir_dir, ar_utils.gen_new_gray_filename(img_path)),
+                         "-o", out_dir, "-m", method])
+            runs.append(["recolor.py", "-i", img_path, "-ir", ir_dir, "-o", out_dir, "-m", method])
+        for metric in args.metrics:
+            runs.append(["image_quality.py", "-i", out_dir, "-r", ref_dir, "-o", "startup.org", "--" + metric])
+
+        rows = []
+        for run in runs:
+            wall_time, import_time, heavy, returncode = run_importtime(run)
+            rows.append([run[0], " ".join(a for a in run[1:] if tmp_dir not in a), "%.3f" % wall_time,
+                         "%.3f" % import_time, ", ".join(heavy) or "-", "ok" if returncode == 0 else "error"])
+    print_table(["Script", "Arguments", "Wall (s)", "Imports (s)", "Heavy imports", "Status"], rows)
+
+
+def max_rss():
+    """
+    Peak resident memory of this process in bytes, None if not available (Windows)
+    """
+    # Linux: ru_maxrss would include the parent, that forked this process before exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, Bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def decode_peak_memory(gray_path, output_path, size, tile_size, tile_overlap):
+    """
+    Decodes one image, runs in a fresh process to measure its peak memory
+    :return: tuple (decode time in s, peak memory before decoding, peak memory after decoding)
+    """
+    import decoder
+    rss_start = max_rss()
+    dc = decoder.Decoder(output_path=output_path, method=ar_utils.methods[0], size=size, tile_size=tile_size,
+                         tile_overlap=tile_overlap)
+    start = time.perf_counter()
+    dc.decode(gray_path)
+    return time.perf_counter() - start, rss_start, max_rss()
+
+
+def bench_tiled_decode(args):
+    """
+    Peak memory and time of decoding large masks at once and in tiles, every decode in its own process
+    """
+    import tempfile
+    import multiprocessing
+    import concurrent.futures
+    import numpy as np
+    import cv2
+
+    def mb(n_bytes):
+        return "%.0f" % (n_bytes / 2**20) if n_bytes is not None else "n/a"
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            # smooth random grayscale image with the resolution of the mask
+            rng = np.random.default_rng(0)
+            gray = cv2.resize(rng.integers(0, 256, (32, 32), dtype=np.uint8), (size, size), interpolation=cv2.INTER_CUBIC)
+            gray_path = os.path.join(tmp_dir, "bench_%d.gray.png" % size)
+            cv2.imwrite(gray_path, gray)
+            random_mask(size, grid_size=args.grid_size).save(tmp_dir, os.path.basename(gray_path), grid_size=args.grid_size)
+
+            outputs = {}
+            for tile_size in [0] + args.tile_sizes:
+                mode = "tiles %d" % tile_size if tile_size else "whole mask"
+                output_path = os.path.join(tmp_dir, "out_%d_%d" % (size, tile_size))
+                try:
+                    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                        elapsed, rss_start, rss_peak = pool.submit(decode_peak_memory, gray_path, output_path, size,
+                                                                   tile_size, args.tile_overlap).result()
+                except (MemoryError, concurrent.futures.process.BrokenProcessPool) as err:
+                    rows.append([size, mode, "failed: " + (str(err) or type(err).__name__), "", "", ""])
+                    continue
+                outputs[tile_size] = cv2.imread(os.path.join(output_path, os.listdir(output_path)[0])).astype(np.float64)
+                diff = "-"
+                if tile_size and 0 in outputs:
+                    mse = np.mean((outputs[tile_size] - outputs[0]) ** 2)
+                    diff = "%.1f" % (10 * np.log10(255 ** 2 / mse)) if mse else "identical"
+                rows.append([size, mode, "%.2f" % elapsed, mb(rss_peak),
+                             mb(rss_peak - rss_start) if rss_peak is not None else "n/a", diff])
+    print_table(["Mask size", "Mode", "Time (s)", "Peak memory (MB)", "Decode memory (MB)", "PSNR to whole mask (dB)"],
+                rows)
+
+
+def bench_lpips(args):
+    """
+    images/sec of LPIPS as before (every pair read again by lpips.load_image, batch size 1)
+    compared to ImageQuality.calc_lpips on the already decoded images, batched
+    """
+    import tempfile
+    import numpy as np
+    import cv2
+    import torch
+    import lpips
+    import image_quality
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    iq = image_quality.ImageQuality(lpips=True)
+    iq.loss_fn = lpips.LPIPS(net="alex", pnet_rand=args.pnet_rand, verbose=False)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rng = np.random.default_rng(0)
+        pairs = []
+        for i in range(args.images):
+            ref = cv2.resize(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8), (args.width, args.height),
+                             interpolation=cv2.INTER_CUBIC)
+            rec = np.clip(ref.astype(int) + rng.integers(-20, 21, ref.shape), 0, 255).astype(np.uint8)
+            ref_path = os.path.join(tmp_dir, "ref_%d.png" % i)
+            rec_path = os.path.join(tmp_dir, "rec_%d.png" % i)
+            cv2.imwrite(ref_path, ref)
+            cv2.imwrite(rec_path, rec)
+            pairs.append((ref_path, rec_path))
+        # warm up
+        iq.calc_lpips([iq.read_pair(*pairs[0])])
+
+        rows = []
+        start = time.perf_counter()
+        previous = []
+        for ref_path, rec_path in pairs:
+            # images are decoded by OpenCV for the other metrics anyway
+            iq.read_pair(ref_path, rec_path)
+            ref_tensor = lpips.im2tensor(lpips.load_image(ref_path))
+            rec_tensor = lpips.im2tensor(lpips.load_image(rec_path))
+            previous.append(float(iq.loss_fn.forward(ref_tensor, rec_tensor)))
+        elapsed = time.perf_counter() - start
+        rows.append(["per pair, read twice", len(pairs), "%.3f" % elapsed, "%.2f" % (len(pairs) / elapsed), "-"])
+
+        for batch_size in args.batch_sizes:
+            iq.lpips_batch = batch_size
+            start = time.perf_counter()
+            values = iq.calc_lpips([iq.read_pair(ref_path, rec_path) for ref_path, rec_path in pairs])
+            elapsed = time.perf_counter() - start
+            rows.append(["batch %d" % batch_size, len(pairs), "%.3f" % elapsed, "%.2f" % (len(pairs) / elapsed),
+                         "%.1e" % np.max(np.abs(np.array(values) - previous))])
+    print("%dx%d images, %d torch thread(s)" % (args.width, args.height, torch.get_num_threads()))
+    print_table(["Mode", "Pairs", "Time (s)", "Pairs/s", "Max difference"], rows)
+
+
+def bench_reference_cache(args):
+    """
+    pairs/sec of image_quality, decoding the reference for every recolored image vs. the reference cache,
+    for the engines fast_qa (if installed) and numpy. Every pair is sent to a worker alone (chunksize 1),
+    otherwise the pairs of a chunk share their decoded reference also without the cache.
+    """
+    import tempfile
+    import contextlib
+    import io
+    import numpy as np
+    import cv2
+    import image_quality
+
+    engines = ["numpy"]
+    try:
+        from fast_qa import fast_qa
+        engines.insert(0, "fast_qa")
+    except ImportError:
+        print("fast_qa not installed, only the numpy engine is measured")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ref_path = os.path.join(tmp_dir, "ref")
+        in_path = os.path.join(tmp_dir, "recolored")
+        os.makedirs(ref_path)
+        os.makedirs(in_path)
+        rng = np.random.default_rng(0)
+        for i in range(args.references):
+            ref = cv2.resize(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8), (args.width, args.height),
+                             interpolation=cv2.INTER_CUBIC)
+            cv2.imwrite(os.path.join(ref_path, "rgb_%04d.png" % i), ref)
+            for j in range(args.variants):
+                rec = np.clip(ref.astype(int) + rng.integers(-20, 21, ref.shape), 0, 255).astype(np.uint8)
+                cv2.imwrite(os.path.join(in_path, "rgb_%04d_recolored_ideepcolor-px-grid_256_%d.png" % (i, j + 1)), rec)
+        pairs = args.references * args.variants
+
+        for engine in engines:
+            reports = {}
+            for cache in (False, True):
+                out_file = "%s_%d.org" % (engine, cache)
+                iq = image_quality.ImageQuality(in_path=in_path, reference_path=ref_path, out_file=out_file,
+                                                recursive=False, ab=args.ab, ssim=True, msssim=True, psnr=True,
+                                                jobs=args.jobs, chunksize=1, engine=engine, reference_cache=cache)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    iq.get_and_write_quality()
+                elapsed = time.perf_counter() - start
+                with open(os.path.join(in_path, out_file)) as f:
+                    reports[cache] = f.read()
+                rows.append([engine, "reference cache" if cache else "decode per pair", pairs, "%.2f" % elapsed,
+                             "%.2f" % (pairs / elapsed), "-" if not cache else reports[True] == reports[False]])
+    print("%d references of %dx%d, %d recolored images each, %s, %d worker(s)"
+          % (args.references, args.width, args.height, args.variants, "ab" if args.ab else "RGB", args.jobs))
+    print_table(["Engine", "Mode", "Pairs", "Time (s)", "Pairs/s", "Same .org"], rows)
+
+
+def bench_metrics(args):
+    """
+    Time per image pair of PSNR and SSIM (and MS-SSIM, if fast_qa is installed) as one thread pool task per channel
+    and metric, vs. quality_metrics computing all channels in one vectorized pass.
+    Also the max difference per metric to skimage (PSNR, SSIM) and fast_qa (SSIM, MS-SSIM), on R, G, B.
+    """
+    import concurrent.futures
+    import numpy as np
+    import cv2
+    import quality_metrics
+    from image_quality import skimage_metrics
+    ssim_sk, psnr_sk = skimage_metrics()
+    try:
+        from fast_qa import fast_qa
+    except ImportError:
+        fast_qa = None
+        print("fast_qa not installed, per channel tasks without MS-SSIM, no comparison to fast_qa")
+
+    rng = np.random.default_rng(0)
+    pairs = []
+    for i in range(args.images):
+        ref = cv2.resize(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8), (args.width, args.height),
+                         interpolation=cv2.INTER_CUBIC)
+        rec = np.clip(ref.astype(int) + rng.integers(-20, 21, ref.shape), 0, 255).astype(np.uint8)
+        pairs.append((np.ascontiguousarray(ref.transpose((2, 0, 1))), np.ascontiguousarray(rec.transpose((2, 0, 1)))))
+
+    def per_channel_tasks(ref_planes, planes):
+        metrics = {"PSNR": lambda x, y: psnr_sk(x, y, data_range=255),
+                   "SSIM": lambda x, y: ssim_sk(x, y, data_range=255, gaussian_weights=True, sigma=1.5,
+                                                use_sample_covariance=False)}
+        if fast_qa is not None:
+            metrics["MS-SSIM"] = lambda x, y: fast_qa.ms_ssim(x, y, max_val=255)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = {metric: [executor.submit(func, x, y) for x, y in zip(ref_planes, planes)]
+                       for metric, func in metrics.items()}
+            return {metric: np.array([future.result() for future in fs]) for metric, fs in futures.items()}
+
+    def vectorized(ref_planes, planes, stats=None):
+        if stats is None:
+            stats = quality_metrics.ReferenceStats.from_planes(ref_planes, 255, quality_metrics.ms_ssim_scales(
+                ref_planes.shape[1:]) if fast_qa is not None else 1)
+        return stats.compare(planes, psnr=True, ssim=True, ms_ssim=fast_qa is not None)
+
+    rows = []
+    results = {}
+    start = time.perf_counter()
+    results["tasks"] = [per_channel_tasks(ref_planes, planes) for ref_planes, planes in pairs]
+    rows.append(["per channel tasks", "%.1f" % ((time.perf_counter() - start) / len(pairs) * 1000)])
+    start = time.perf_counter()
+    results["vectorized"] = [vectorized(ref_planes, planes) for ref_planes, planes in pairs]
+    rows.append(["vectorized", "%.1f" % ((time.perf_counter() - start) / len(pairs) * 1000)])
+    # the same reference for every pair, its statistics computed once
+    stats = quality_metrics.ReferenceStats.from_planes(pairs[0][0], 255, quality_metrics.ms_ssim_scales(
+        pairs[0][0].shape[1:]) if fast_qa is not None else 1)
+    start = time.perf_counter()
+    for ref_planes, planes in pairs:
+        vectorized(pairs[0][0], planes, stats)
+    rows.append(["vectorized, reference statistics cached", "%.1f" % ((time.perf_counter() - start) / len(pairs) * 1000)])
+    print("%d pairs of %dx%d RGB images" % (len(pairs), args.width, args.height))
+    print_table(["Mode", "Time per pair (ms)"], rows)
+
+    rows = []
+    for metric in results["tasks"][0]:
+        reference = "skimage" if metric != "MS-SSIM" else "fast_qa"
+        diff = max(np.max(np.abs(task[metric] - vec[metric])) for task, vec in zip(results["tasks"], results["vectorized"]))
+        rows.append([metric, reference, "%.1e" % diff])
+    if fast_qa is not None:
+        diff = max(np.max(np.abs([fast_qa.ssim(x, y, max_val=255) for x, y in zip(ref_planes, planes)] - vec["SSIM"]))
+                   for (ref_planes, planes), vec in zip(pairs, results["vectorized"]))
+        rows.append(["SSIM", "fast_qa", "%.1e" % diff])
+    print_table(["Metric", "Compared to", "Max difference per channel"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="Recolor Benchmarks",
+                                     description="Benchmarks for encoding, decoding and the intermediate representation")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    p = subparsers.add_parser("decode-batch", help="images/sec of per image decoding vs. batched decoding")
+    p.add_argument('-i', '--input_path', action='store', dest='input_path', type=str,
+                   default='intermediate_representation',
+                   help='Folder with grayscale images and their sidecar files')
+    p.add_argument('-o', '--output_path', action='store', dest='output_path', type=str, default='output_images')
+    p.add_argument('-m', '--method', action='store', dest='method', type=str, default=ar_utils.methods[0],
+                   help='The colorization method to use. Possible values: \"' + ', '.join(ar_utils.methods) + '\"')
+    p.add_argument('-s', '--size', action='store', dest='size', type=int, default=256)
+    p.add_argument('-n', '--images', action='store', dest='images', type=int, default=32,
+                   help='Number of images to decode, input images are repeated to reach it')
+    p.add_argument('-b', '--batch_sizes', action='store', dest='batch_sizes', type=int, nargs='+', default=[4, 8, 16])
+    p.add_argument('--gpu_id', dest='gpu_id', help='gpu id', type=int, default=-1)
+    p.set_defaults(func=bench_decode_batch)
+
+    p = subparsers.add_parser("mask", help="size and speed of the .mask sidecar formats v1 and v2, round trip check")
+    p.add_argument('-i', '--input_path', action='store', dest='input_path', type=str,
+                   default='intermediate_representation',
+                   help='Folder with existing .mask files to check, empty to skip')
+    p.add_argument('-s', '--sizes', action='store', dest='sizes', type=int, nargs='+', default=[256, 1024, 2048])
+    p.add_argument('-g', '--grid_size', action='store', dest='grid_size', type=int, default=10)
+    p.add_argument('-r', '--repeats', action='store', dest='repeats', type=int, default=20,
+                   help='Serialize and parse every mask this often, to average the time')
+    p.set_defaults(func=bench_mask)
+
+    p = subparsers.add_parser("selective", help="blob labeling and centres of the selective method on 640x480 images")
+    p.add_argument('-i', '--input_path', action='store', dest='input_path', type=str, default='input_images',
+                   help='Folder with color images, e.g. the output of cityscapes_preprocess.sh')
+    p.add_argument('-o', '--output_path', action='store', dest='output_path', type=str,
+                   default='intermediate_representation')
+    p.add_argument('--width', action='store', dest='width', type=int, default=640,
+                   help='Resize images to this width first, 0: keep size')
+    p.add_argument('--height', action='store', dest='height', type=int, default=480,
+                   help='Resize images to this height first, 0: keep size')
+    p.add_argument('-r', '--round_to', action='store', dest='round_to', type=int, default=10)
+    p.add_argument('--reference', dest='reference', action='store_true',
+                   help='Also run the previous flood fill labeling and compare the blobs')
+    p.set_defaults(func=bench_selective)
+
+    p = subparsers.add_parser("glob-dist", help="size, error and speed of the .glob_dist formats v1 and v2")
+    p.add_argument('-i', '--input_path', action='store', dest='input_path', type=str,
+                   default='intermediate_representation',
+                   help='Folder with existing .glob_dist files, random distributions if there are none')
+    p.add_argument('-n', '--samples', action='store', dest='samples', type=int, default=1000,
+                   help='Number of random distributions')
+    p.set_defaults(func=bench_glob_dist)
+
+    p = subparsers.add_parser("startup", help="import time of the command line tools per method and metric (python -X importtime)")
+    p.add_argument('-m', '--methods', action='store', dest='methods', type=str, nargs='*', default=ar_utils.methods,
+                   help='Methods to run encoder, decoder and recolor with')
+    p.add_argument('--metrics', action='store', dest='metrics', type=str, nargs='*',
+                   default=["psnr", "ssim", "ms-ssim", "vif", "lpips"], help='Metrics to run image_quality with')
+    p.set_defaults(func=bench_startup)
+
+    p = subparsers.add_parser("tiled-decode", help="peak memory of decoding large masks at once vs. in tiles")
+    p.add_argument('-s', '--sizes', action='store', dest='sizes', type=int, nargs='+', default=[2048, 4096])
+    p.add_argument('-t', '--tile_sizes', action='store', dest='tile_sizes', type=int, nargs='+', default=[256])
+    p.add_argument('--tile_overlap', action='store', dest='tile_overlap', type=int, default=32)
+    p.add_argument('-g', '--grid_size', action='store', dest='grid_size', type=int, default=10)
+    p.set_defaults(func=bench_tiled_decode)
+
+    p = subparsers.add_parser("lpips", help="pairs/sec of LPIPS per pair vs. batched on decoded images (CPU)")
+    p.add_argument('-n', '--images', action='store', dest='images', type=int, default=64)
+    p.add_argument('--width', action='store', dest='width', type=int, default=256)
+    p.add_argument('--height', action='store', dest='height', type=int, default=256)
+    p.add_argument('-b', '--batch_sizes', action='store', dest='batch_sizes', type=int, nargs='+', default=[1, 4, 8, 16])
+    p.add_argument('--threads', action='store', dest='threads', type=int, default=0,
+                   help='torch threads, like a worker of image_quality. Default: 0, torch default')
+    p.add_argument('--pnet_rand', dest='pnet_rand', action='store_true',
+                   help='Random AlexNet weights instead of downloading the pretrained ones, same speed')
+    p.set_defaults(func=bench_lpips)
+
+    p = subparsers.add_parser("reference-cache", help="pairs/sec of image_quality with and without the reference cache")
+    p.add_argument('-r', '--references', action='store', dest='references', type=int, default=3)
+    p.add_argument('-v', '--variants', action='store', dest='variants', type=int, default=8,
+                   help='recolored images per reference')
+    p.add_argument('--width', action='store', dest='width', type=int, default=640)
+    p.add_argument('--height', action='store', dest='height', type=int, default=480)
+    p.add_argument('-ab', '--ab', dest='ab', action='store_true', help='compare the a&b channels')
+    p.add_argument('-j', '--jobs', action='store', dest='jobs', type=int, default=os.cpu_count())
+    p.set_defaults(func=bench_reference_cache)
+
+    p = subparsers.add_parser("metrics", help="time per pair of per channel metric tasks vs. the vectorized engine, "
+                                               "difference to skimage and fast_qa")
+    p.add_argument('-n', '--images', action='store', dest='images', type=int, default=16)
+    p.add_argument('--width', action='store', dest='width', type=int, default=640)
+    p.add_argument('--height', action='store', dest='height', type=int, default=480)
+    p.set_defaults(func=bench_metrics)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,14 +6,32 @@ Converts a grayscale image + color cues back into a color image.
 
 import os, sys
 import argparse
+import cv2
 import ar_utils
+import model_session
+import watch
+import ir_archive
 import importlib
-from PIL import Image
+import numpy as np
+
+# interactive-deep-colorization.data.colorize_image, only imported by get_colorize_image when a model is created
+CI = None
+
+
+def get_colorize_image():
+    """
+    :return: colorize_image module of interactive-deep-colorization, imported on first call
+    """
+    global CI
+    if CI is None:
+        # -'s in import not allowed
+        CI = importlib.import_module("interactive-deep-colorization.data.colorize_image")
+    return CI
 
-CI = importlib.import_module("interactive-deep-colorization.data.colorize_image")
 
 class Decoder(object):
-    def __init__(self, output_path="output_images", gpu_id=-1, method=ar_utils.methods[0], size=256, p=0, plot=False) -> None:
+    def __init__(self, output_path="output_images", gpu_id=-1, method=ar_utils.methods[0], size=256, p=0, plot=False,
+                 session=None, tile_size=0, tile_overlap=32) -> None:
         self.gpu_id = None if gpu_id < 0 else gpu_id
         self.methods = ar_utils.methods
         self.method = method
@@ -24,6 +42,9 @@ class Decoder(object):
             self.size = 256
         self.p = p
         self.plot = plot
+        # ideepcolor-px: colorize masks bigger than tile_size in overlapping tiles, 0: whole mask at once
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
         # self.input_path = input_path
         self.output_path = output_path
         # lower CPU priority (to not freeze PC)
@@ -39,6 +60,8 @@ class Decoder(object):
         self.caffe_model = "./models/reference_model/model.caffemodel"
         self.global_prototxt = "./models/global_model/deploy_nodist.prototxt"
         self.global_caffemodel = "./models/global_model/global_model.caffemodel"
+        # loaded models are shared between all decoders of this process by default
+        self.session = session if session is not None else model_session.default_session
 
         sys.path.insert(1, os.path.abspath("interactive-deep-colorization"))
         os.environ['GLOG_minloglevel'] = '2'  # supress Caffe verbose prints
@@ -80,6 +103,55 @@ class Decoder(object):
             help="watch input folder for new images",
             action="store_true",
         )
+        parser.add_argument(
+            "--journal",
+            action="store",
+            dest="journal",
+            type=str,
+            default=None,
+            help="Watch: file to record decoded images in, to skip them after a restart. Default: in output_path",
+        )
+        parser.add_argument(
+            "--settle_time",
+            action="store",
+            dest="settle_time",
+            type=float,
+            default=1.0,
+            help="Watch: seconds a new file has to stay unchanged, before it counts as completely written",
+        )
+        parser.add_argument(
+            "--archive",
+            action="store",
+            dest="archive",
+            type=str,
+            default=None,
+            help="Decode all images of this archive folder (see ir_archive.py), instead of input_path",
+        )
+        parser.add_argument(
+            "-s", "--size",
+            action="store",
+            dest="size",
+            type=int,
+            default=256,
+            help="Size the network runs on (Xd). Default: 256",
+        )
+        parser.add_argument(
+            "--tile_size",
+            action="store",
+            dest="tile_size",
+            type=int,
+            default=0,
+            help="ideepcolor-px: colorize bigger masks in overlapping tiles of this size, memory then depends on "
+                 "the tile size instead of the mask size. e.g. 256. Default: 0, off",
+        )
+        parser.add_argument(
+            "--tile_overlap",
+            action="store",
+            dest="tile_overlap",
+            type=int,
+            default=32,
+            help="Overlap of neighbouring tiles, blended linearly. Default: 32",
+        )
 
         parser.add_argument(
             "-plt", "--plot",
@@ -89,20 +161,31 @@ class Decoder(object):
         )
         
         args = parser.parse_args()
+        from PIL import Image
         self.method = args.method
         self.watch = args.watch
         self.size = args.size
+        # set default size for global mode
+        if self.method == self.methods[2]:
+            self.size = 256
         # self.grid_size = args.grid_size
         self.output_path = args.output_path
         self.plot = args.plot
+        self.tile_size = args.tile_size
+        self.tile_overlap = args.tile_overlap
 
         try:
             os.makedirs(self.output_path, exist_ok=True)
         except FileExistsError:
             pass
 
-        # TODO: implement watch functionality
-        if not os.path.isdir(args.input_path):
+        if args.archive:
+            self.decode_archive(args.archive)
+        elif self.watch:
+            journal = args.journal or os.path.join(self.output_path, ".decoder_journal")
+            watch.watch_folder(args.input_path, self.decode, journal_path=journal, accept=watch.is_gray_image,
+                               settle_time=args.settle_time)
+        elif not os.path.isdir(args.input_path):
             try:
                 Image.open(args.input_path) # Just to test if file is image
                 self.decode(args.input_path)
@@ -119,60 +202,228 @@ class Decoder(object):
                 except IOError as err:
                     # print("Warning: Found non image file: " + fil.path)
                     pass
+        self.session.report()
 
 
     def decode(self, img_gray_path):
+        """
+        :param img_gray_path: path to grayscale image with sidecar files or ar_utils.IntermediateRepresentation from Encoder.encode
+        """
         if "ideepcolor-px" in self.method:
             # filename_mask = ar_utils.gen_new_mask_filename(img_gray_path)
-            self.decode_ideepcolor_px(img_gray_path)
+            if self.tile_size:
+                return self.decode_ideepcolor_px_tiled(img_gray_path)
+            return self.decode_ideepcolor_px(img_gray_path)
 
         elif self.method == "ideepcolor-global":
-            self.decode_ideepcolor_global(img_gray_path)
+            return self.decode_ideepcolor_global(img_gray_path)
 
         # ideepcolor-stock
         elif self.method == ar_utils.methods[3]:
             # same as global, but without global hints
-            self.decode_ideepcolor_global(img_gray_path, stock=True)
+            return self.decode_ideepcolor_global(img_gray_path, stock=True)
         
         else:
             print("Error: method not valid:", self.method)
 
-    def decode_ideepcolor_px(self, img_gray_path, model="pytorch"):
-        
+    def decode_archive(self, archive_path, names=None):
+        """
+        Decodes grayscale images of an ir_archive.IRArchive, read directly from the memory mapped shards
+        :param names: names of the grayscale images in the archive, None: all
+        :return: number of decoded images
+        """
+        decoded = 0
+        with ir_archive.IRArchive(archive_path) as archive:
+            if names is None:
+                names = [name for name in archive.names() if ar_utils.get_fn_wo_ext(name)[2] == ".gray"]
+            for name in names:
+                try:
+                    self.decode(ar_utils.IntermediateRepresentation.from_archive(archive, name))
+                    decoded += 1
+                except (IOError, KeyError) as err:
+                    print("Error decoding " + name + " from archive: " + str(err))
+        return decoded
+
+    def load_mask(self, img_gray_path):
+        """
+        Loads the mask sidecar file(s) belonging to the grayscale image
+        :param img_gray_path: path to grayscale image or ar_utils.IntermediateRepresentation
+        """
+        if isinstance(img_gray_path, ar_utils.IntermediateRepresentation):
+            return img_gray_path.get_mask(self.size, self.p)
         mask = ar_utils.Mask(self.size, self.p)
+        for i, data in enumerate(self.load_mask_bytes(img_gray_path)):
+            # second mask of grid+selective is put over the first one
+            if i:
+                mask.grid_size = None
+            mask.from_bytes(data, initialize=(i == 0))
+        return mask
 
+    def load_mask_bytes(self, img_gray_path):
+        """
+        :return: list of the contents of the mask sidecar file(s) belonging to the grayscale image
+        """
+        if isinstance(img_gray_path, ar_utils.IntermediateRepresentation):
+            return img_gray_path.mask_bytes()
         # "ideepcolor-px-grid+selective"
-        if self.method == ar_utils.methods[5]:
-            mask.load(os.path.dirname(img_gray_path), os.path.basename(img_gray_path), name_extra="1", initialize=True)
-            mask.grid_size = None
-            mask.load(os.path.dirname(img_gray_path), os.path.basename(img_gray_path), name_extra="2", initialize=False)
-        else:
-            mask.load(os.path.dirname(img_gray_path), os.path.basename(img_gray_path))
+        name_extras = ["1", "2"] if self.method == ar_utils.methods[5] else [None]
+        mask_bytes = []
+        for name_extra in name_extras:
+            with open(os.path.join(os.path.dirname(img_gray_path),
+                                   ar_utils.gen_new_mask_filename(os.path.basename(img_gray_path), extras=name_extra)), "rb") as f:
+                mask_bytes.append(f.read())
+        return mask_bytes
+
+    def decode_ideepcolor_px(self, img_gray_path, model="pytorch"):
+        
+        mask = self.load_mask(img_gray_path)
 
         prev_wd = os.getcwd()
-        if model == "pytorch":
-            colorModel = CI.ColorizeImageTorch(Xd=mask.size, maskcent=self.maskcent)
-            gpu_id = None
-            if type(self.gpu_id) is int:
-                gpu_id = None if self.gpu_id < 0 else self.gpu_id
-            colorModel.prep_net(path=os.path.abspath(self.color_model), gpu_id=gpu_id)
-        elif model == "caffe":
+        if model == "caffe":
             ideepcolor_folder = "./interactive-deep-colorization"
             # check if already in folder
             if not os.path.basename(ideepcolor_folder) == os.path.basename(os.getcwd()):
                 os.chdir(ideepcolor_folder)
-            colorModel = CI.ColorizeImageCaffe(Xd=mask.size)
-            colorModel.prep_net(self.gpu_id, self.caffe_net, self.caffe_model)
-            
-        colorModel.load_image(img_gray_path)
+        colorModel = self.get_color_model(model, mask.size)
 
-        img_out = colorModel.net_forward(mask.input_ab, mask.mask)
-        img_out_fullres = colorModel.get_img_fullres()
+        with self.session.inference():
+            _load_image(colorModel, img_gray_path)
+
+            img_out = colorModel.net_forward(mask.input_ab, mask.mask)
+            img_out_fullres = colorModel.get_img_fullres()
 
         os.chdir(prev_wd)
 
-        self._save_img_out(img_gray_path, img_out_fullres, extras=[mask.size, mask.grid_size])
+        self._save_px_out(img_gray_path, colorModel, img_out_fullres, mask)
         new_rc_mask_filename = None
+
+        return (img_out_fullres, new_rc_mask_filename)
+
+    def decode_ideepcolor_px_tiled(self, img_gray_path):
+        """
+        Like decode_ideepcolor_px, but runs the network on overlapping tiles of self.tile_size instead of the whole mask.
+        The cues are read without creating the dense mask, every tile gets its own small mask.
+        The ab outputs of the tiles are blended linearly in the overlaps and scaled to full resolution at the end.
+        Tiles are processed row by row: once a row of tiles is done, the ab rows above the next one are final and
+        their full resolution rows are written, so the ab buffers only hold about one row of tiles (tile x size).
+        Masks not bigger than one tile are decoded as usual.
+        """
+        cues = [ar_utils.Mask.parse_cues(data) for data in self.load_mask_bytes(img_gray_path)]
+        size, p = cues[0][0], cues[0][1]
+        # grid size of the last mask, like load_mask
+        grid_size = cues[-1][2]
+        if size <= self.tile_size:
+            return self.decode_ideepcolor_px(img_gray_path)
+        locs = np.concatenate([c[3] for c in cues])
+        vals = np.concatenate([c[4] for c in cues])
+        tile = self.tile_size
+        overlap = min(self.tile_overlap, tile // 2)
+
+        colorModel = self.get_color_model("pytorch", tile)
+        with self.session.inference():
+            img_rgb_fullres = _read_rgb(img_gray_path)
+            h, w = img_rgb_fullres.shape[:2]
+            # network input of the whole mask, only the tiles of it are colorized.
+            # All channels of the grayscale image are equal, one is enough
+            img_gray = cv2.resize(img_rgb_fullres[:, :, 0], (size, size))
+            img_out_fullres = np.empty((h, w, 3), dtype=np.uint8)
+            # sums of the weighted tile outputs, rows band_y0..band_y0+tile
+            band_ab = np.zeros((2, tile, size), dtype=np.float32)
+            band_weights = np.zeros((tile, size), dtype=np.float32)
+            # blended ab rows ready_y0.. not yet needed by the full resolution rows out_row..
+            ready = np.zeros((2, 0, size), dtype=np.float32)
+            ready_y0 = 0
+            out_row = 0
+            # ab rows the full resolution rows are interpolated from
+            left, right, _ = _linear_weights(size, h)
+            starts = _tile_starts(size, tile, overlap)
+            for i, y0 in enumerate(starts):
+                for x0 in starts:
+                    mask = ar_utils.Mask.from_cues_window(locs, vals, p, y0, x0, tile)
+                    _load_image_resized(colorModel, cv2.cvtColor(img_gray[y0:y0 + tile, x0:x0 + tile],
+                                                                 cv2.COLOR_GRAY2RGB))
+                    colorModel.net_forward(mask.input_ab, mask.mask)
+                    weight = np.outer(_blend_ramp(tile, overlap, y0 > 0, y0 + tile < size),
+                                      _blend_ramp(tile, overlap, x0 > 0, x0 + tile < size))
+                    band_ab[:, :, x0:x0 + tile] += colorModel.output_ab * weight
+                    band_weights[:, x0:x0 + tile] += weight
+
+                # rows above the next row of tiles get nothing more
+                next_y0 = starts[i + 1] if i + 1 < len(starts) else size
+                done = next_y0 - y0
+                ready = np.concatenate((ready, band_ab[:, :done] / band_weights[:done]), axis=1)
+                band_ab[:, :tile - done] = band_ab[:, done:].copy()
+                band_ab[:, tile - done:] = 0
+                band_weights[:tile - done] = band_weights[done:].copy()
+                band_weights[tile - done:] = 0
+
+                stop = int(np.searchsorted(right, next_y0))
+                _compose_rows(img_rgb_fullres, ready, ready_y0, size, out_row, stop, img_out_fullres)
+                out_row = stop
+                if out_row < h:
+                    # scaling down, the next output row can start after the rows blended so far
+                    keep = min(left[out_row], next_y0)
+                    ready = ready[:, keep - ready_y0:]
+                    ready_y0 = keep
+
+        # no plot of the mask, there is no mask of the whole image
+        self._save_img_out(img_gray_path, img_out_fullres, extras=[size, grid_size])
+        return (img_out_fullres, None)
+
+    def decode_batch(self, img_gray_paths, batch_size=8):
+        """
+        Decodes multiple images of an ideepcolor-px method with one forward pass of the pytorch model per batch.
+        Images with different mask sizes can't be stacked, so they are sorted into separate buckets first.
+        Other methods and models without batch support are decoded one by one.
+        :param img_gray_paths: list of paths to grayscale images with sidecar files or ar_utils.IntermediateRepresentations
+        :param batch_size: max number of images per forward pass
+        :return: list of full resolution outputs, same order as img_gray_paths
+        """
+        if "ideepcolor-px" not in self.method:
+            return [self.decode(path) for path in img_gray_paths]
+        if self.tile_size:
+            return [self.decode_ideepcolor_px_tiled(path)[0] for path in img_gray_paths]
+
+        # bucket by mask size, keep index to restore order. Only the size in the header is read here,
+        # the dense masks are loaded per batch, so at most batch_size of them are in memory
+        buckets = {}
+        for idx, path in enumerate(img_gray_paths):
+            size = ar_utils.Mask.parse_size(self.load_mask_bytes(path)[0])
+            buckets.setdefault(size, []).append((idx, path))
+
+        results = [None] * len(img_gray_paths)
+        for size, bucket in buckets.items():
+            colorModel = self.get_color_model("pytorch", size)
+            if not hasattr(colorModel.net, "model1"):
+                # unknown network layout, can't hook into it
+                for idx, path in bucket:
+                    results[idx] = self.decode_ideepcolor_px(path)[0]
+                continue
+
+            for start in range(0, len(bucket), batch_size):
+                batch = [(idx, path, self.load_mask(path)) for idx, path in bucket[start:start + batch_size]]
+                with self.session.inference():
+                    net_inputs = []
+                    states = []
+                    for idx, path, mask in batch:
+                        _load_image(colorModel, path)
+                        net_inputs.append(_capture_net_input(colorModel, mask))
+                        # attributes get replaced, not modified, when the next image is loaded -> shallow copy is enough
+                        states.append(dict(colorModel.__dict__))
+
+                    output_ab = _net_forward_batch(colorModel, net_inputs)
+
+                    for i, (idx, path, mask) in enumerate(batch):
+                        colorModel.__dict__.update(states[i])
+                        # same as the end of ColorizeImageTorch.net_forward
+                        colorModel.output_rgb = get_colorize_image().lab2rgb_transpose(colorModel.img_l, output_ab[i])
+                        colorModel._set_out_ab_()
+                        results[idx] = colorModel.get_img_fullres()
+                        self._save_px_out(path, colorModel, results[idx], mask)
+        return results
+
+    def _save_px_out(self, img_gray_path, colorModel, img_out_fullres, mask):
+        self._save_img_out(img_gray_path, img_out_fullres, extras=[mask.size, mask.grid_size])
         # only save plot for grid method, selective has its own
         if self.plot and (self.method == ar_utils.methods[0] or self.method == ar_utils.methods[4] or self.method == ar_utils.methods[5]):
             img_mask_fullres = colorModel.get_input_img_fullres()
@@ -182,44 +433,259 @@ class Decoder(object):
             # self._save_img_out(img_gray_path, img_real_mask_fullres,
             #                    extras=[mask.size, mask.grid_size, ".mask_rgb_real"])
 
-        return (img_out_fullres, new_rc_mask_filename)
-
     def decode_ideepcolor_global(self, img_gray_path, stock=False):
-        # TODO: don't recreate cid
-        img_gray_abspath = os.path.abspath(img_gray_path)
+        if isinstance(img_gray_path, ar_utils.IntermediateRepresentation):
+            img_gray_abspath = img_gray_path
+        else:
+            img_gray_abspath = os.path.abspath(img_gray_path)
 
         prev_wd = os.getcwd()
         ideepcolor_folder = "./interactive-deep-colorization"
         # check if already in folder
         if not os.path.basename(ideepcolor_folder) == os.path.basename(os.getcwd()):
             os.chdir(ideepcolor_folder)
-        
-        cid = CI.ColorizeImageCaffeGlobDist(self.size)
-        gpu_id = -1 if self.gpu_id is None else self.gpu_id
-        cid.prep_net(gpu_id,
-                     prototxt_path=self.global_prototxt,
-                     caffemodel_path=self.global_caffemodel)
-        cid.load_image(img_gray_abspath)
-        dummy_mask = ar_utils.Mask(self.size)
-        if not stock:
-            glob_dist = ar_utils.load_glob_dist(img_gray_path)
-            img_pred = cid.net_forward(dummy_mask.input_ab, dummy_mask.mask, glob_dist)
-        else:
-            img_pred = cid.net_forward(dummy_mask.input_ab, dummy_mask.mask)
-        img_out_fullres = cid.get_img_fullres()
+
+        cid = self.get_color_model("caffe-global", self.size)
+        with self.session.inference():
+            _load_image(cid, img_gray_abspath)
+            dummy_mask = ar_utils.Mask(self.size)
+            if not stock:
+                if isinstance(img_gray_abspath, ar_utils.IntermediateRepresentation):
+                    glob_dist = img_gray_abspath.get_glob_dist()
+                else:
+                    glob_dist = ar_utils.load_glob_dist(img_gray_abspath)
+                img_pred = cid.net_forward(dummy_mask.input_ab, dummy_mask.mask, glob_dist)
+            else:
+                img_pred = cid.net_forward(dummy_mask.input_ab, dummy_mask.mask)
+            img_out_fullres = cid.get_img_fullres()
         os.chdir(prev_wd)
 
         self._save_img_out(img_gray_path, img_out_fullres)
         return img_out_fullres
 
+    def load_model(self):
+        """
+        Loads the model of self.method before the first image, so a missing or broken model shows up right away.
+        Assumes masks of self.size, like the encoder writes them.
+        """
+        if "ideepcolor-px" in self.method:
+            size = self.tile_size if self.tile_size and self.size > self.tile_size else self.size
+            return self.get_color_model("pytorch", size)
+
+        prev_wd = os.getcwd()
+        ideepcolor_folder = "./interactive-deep-colorization"
+        if not os.path.basename(ideepcolor_folder) == os.path.basename(os.getcwd()):
+            os.chdir(ideepcolor_folder)
+        try:
+            return self.get_color_model("caffe-global", self.size)
+        finally:
+            os.chdir(prev_wd)
+
+    def get_color_model(self, model, size):
+        """
+        Returns a prepared colorization model from the session, only loads the weights on first use.
+        Caffe models expect to be called from inside the interactive-deep-colorization folder.
+        :param model: "pytorch", "caffe" or "caffe-global"
+        :param size: Xd, size the network runs on
+        """
+        if model == "pytorch":
+            gpu_id = None
+            if type(self.gpu_id) is int:
+                gpu_id = None if self.gpu_id < 0 else self.gpu_id
+
+            def load():
+                colorModel = get_colorize_image().ColorizeImageTorch(Xd=size, maskcent=self.maskcent)
+                colorModel.prep_net(path=os.path.abspath(self.color_model), gpu_id=gpu_id)
+                return colorModel
+            return self.session.get(model, size, self.color_model, gpu_id, load)
+
+        elif model == "caffe":
+            def load():
+                colorModel = get_colorize_image().ColorizeImageCaffe(Xd=size)
+                colorModel.prep_net(self.gpu_id, self.caffe_net, self.caffe_model)
+                return colorModel
+            return self.session.get(model, size, self.caffe_model, self.gpu_id, load)
+
+        elif model == "caffe-global":
+            gpu_id = -1 if self.gpu_id is None else self.gpu_id
+
+            def load():
+                cid = get_colorize_image().ColorizeImageCaffeGlobDist(size)
+                cid.prep_net(gpu_id,
+                             prototxt_path=self.global_prototxt,
+                             caffemodel_path=self.global_caffemodel)
+                return cid
+            return self.session.get(model, size, self.global_caffemodel, gpu_id, load)
+
     def _save_img_out(self, img_gray_path, img, method=None, extras=None):
         if method is None:
             method = self.method
+        if isinstance(img_gray_path, ar_utils.IntermediateRepresentation):
+            img_gray_path = img_gray_path.gray_filename
         
         new_rc_filename = ar_utils.gen_new_recolored_filename(img_gray_path, method, extras)
         ar_utils.save(self.output_path, new_rc_filename, img)
 
 
+def _load_image(colorModel, img_gray):
+    """
+    colorModel.load_image for a path or an ar_utils.IntermediateRepresentation.
+    The in memory image goes through the same steps as in ColorizeImageBase.load_image, without the file.
+    """
+    if not isinstance(img_gray, ar_utils.IntermediateRepresentation):
+        colorModel.load_image(img_gray)
+        return
+    im = _read_rgb(img_gray)
+    colorModel.img_rgb_fullres = im.copy()
+    colorModel._set_img_lab_fullres_()
+
+    _load_image_resized(colorModel, cv2.resize(im, (colorModel.Xd, colorModel.Xd)))
+
+
+def _load_image_resized(colorModel, img_rgb):
+    """
+    Second half of colorModel.load_image: sets the network input from an RGB image of size Xd, e.g. a tile.
+    Leaves the full resolution image unchanged.
+    """
+    colorModel.img_rgb = img_rgb.copy()
+    colorModel.img_l_set = True
+
+    colorModel._set_img_lab_()
+    colorModel._set_img_lab_mc_()
+
+
+def _read_rgb(img_gray):
+    """
+    :param img_gray: path to grayscale image or ar_utils.IntermediateRepresentation
+    :return: image as RGB HxWx3, same as in ColorizeImageBase.load_image
+    """
+    if isinstance(img_gray, ar_utils.IntermediateRepresentation):
+        im = img_gray.gray
+        # same as cv2.imread(.., 1) of the grayscale png + BGR2RGB
+        return cv2.cvtColor(im, cv2.COLOR_GRAY2RGB) if im.ndim == 2 else cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    return cv2.cvtColor(cv2.imread(img_gray, 1), cv2.COLOR_BGR2RGB)
+
+
+def _compose_fullres(img_rgb_fullres, output_ab, strip_rows=256):
+    """
+    Same as colorModel.get_img_fullres, but in strips of rows, to not need the full resolution Lab image at once.
+    ab is scaled up like scipy.ndimage.zoom(.., order=1): linear, first and last pixels aligned.
+    :param output_ab: predicted ab channels 2xSxS
+    :return: RGB image HxWx3 uint8
+    """
+    h, w = img_rgb_fullres.shape[:2]
+    img_out = np.empty((h, w, 3), dtype=np.uint8)
+    _compose_rows(img_rgb_fullres, output_ab, 0, output_ab.shape[1], 0, h, img_out, strip_rows)
+    return img_out
+
+
+def _compose_rows(img_rgb_fullres, ab_rows, ab_y0, ab_h, start, stop, img_out, strip_rows=256):
+    """
+    Writes the full resolution rows start..stop of _compose_fullres into img_out, from a part of the ab prediction
+    :param ab_rows: rows ab_y0.. of the predicted ab channels, containing all rows that output rows start..stop need
+    :param ab_h: number of rows of the whole ab prediction
+    """
+    CI = get_colorize_image()
+    h, w = img_rgb_fullres.shape[:2]
+    x0, x1, x_frac = _linear_weights(ab_rows.shape[2], w)
+    for strip in range(start, stop, strip_rows):
+        strip_stop = min(strip + strip_rows, stop)
+        y0, y1, y_frac = _linear_weights(ab_h, h, strip, strip_stop)
+        y_frac = y_frac[:, np.newaxis]
+        rows = ab_rows[:, y0 - ab_y0] * (1 - y_frac) + ab_rows[:, y1 - ab_y0] * y_frac
+        ab = rows[:, :, x0] * (1 - x_frac) + rows[:, :, x1] * x_frac
+        img_l = CI.rgb2lab_transpose(img_rgb_fullres[strip:strip_stop])[[0]]
+        img_out[strip:strip_stop] = CI.lab2rgb_transpose(img_l, ab)
+
+
+def _linear_weights(n_in, n_out, start=0, stop=None):
+    """
+    Neighbours and weights to scale n_in samples to n_out linearly, for output samples start..stop
+    :return: tuple (index of left neighbour, index of right neighbour, weight of right neighbour)
+    """
+    stop = n_out if stop is None else stop
+    pos = np.arange(start, stop) * ((n_in - 1) / (n_out - 1) if n_out > 1 else 0.0)
+    left = np.minimum(np.floor(pos).astype(np.int64), n_in - 1)
+    right = np.minimum(left + 1, n_in - 1)
+    return left, right, pos - left
+
+
+def _tile_starts(size, tile, overlap):
+    """
+    Start positions of tiles covering 0..size, neighbours overlapping by at least overlap
+    """
+    starts = list(range(0, size - tile, tile - overlap))
+    return starts + [size - tile]
+
+
+def _blend_ramp(tile, overlap, ramp_start, ramp_end):
+    """
+    Blend weights along one axis of a tile: rising linearly over the overlap at sides with a neighbour, 1 elsewhere
+    """
+    ramp = np.ones(tile, dtype=np.float32)
+    if overlap:
+        rising = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        if ramp_start:
+            ramp[:overlap] = np.minimum(ramp[:overlap], rising)
+        if ramp_end:
+            ramp[-overlap:] = np.minimum(ramp[-overlap:], rising[::-1])
+    return ramp
+
+
+class _NetInputCaptured(Exception):
+    """Raised from a hook, to stop the network once its input is known."""
+
+
+# Batching relies on the SIGGRAPHGenerator of interactive-deep-colorization (models/pytorch/model.py):
+#   forward(self, input_A, input_B, mask_B, maskcent=0) wraps each numpy input into a batch of one and starts with
+#   conv1_2 = self.model1(torch.cat((input_A / self.l_norm, input_B / self.ab_norm, mask_B), dim=1))
+# i.e. model1 is called once, with the normalized 1x4xHxW input, and every later layer only depends on its output.
+# forward can't be called with stacked inputs directly, so the input of model1 is captured per image by a pre-hook,
+# and replaced by the stacked batch in a second call.
+
+
+def _capture_net_input(colorModel, mask):
+    """
+    Runs the preprocessing of colorModel.net_forward, but stops at the first layer of the network.
+    :return: prepared network input as tensor 1xCxHxW
+    """
+    captured = []
+
+    def hook(module, inputs):
+        captured.append(inputs[0])
+        raise _NetInputCaptured()
+
+    handle = colorModel.net.model1.register_forward_pre_hook(hook)
+    try:
+        colorModel.net_forward(mask.input_ab, mask.mask)
+    except _NetInputCaptured:
+        pass
+    finally:
+        handle.remove()
+    return captured[0]
+
+
+def _net_forward_batch(colorModel, net_inputs):
+    """
+    One forward pass for multiple inputs from _capture_net_input. The stacked batch replaces the input of the first layer.
+    :return: predicted ab channels as array Nx2xHxW
+    """
+    import torch
+    batch = torch.cat(net_inputs, dim=0)
+
+    def hook(module, inputs):
+        return (batch,)
+
+    handle = colorModel.net.model1.register_forward_pre_hook(hook)
+    try:
+        with torch.no_grad():
+            output_ab = colorModel.net.forward(colorModel.img_l_mc, colorModel.input_ab_mc,
+                                               colorModel.input_mask_mult, colorModel.mask_cent)
+    finally:
+        handle.remove()
+    return output_ab.cpu().data.numpy()
+
+
 if __name__ == "__main__":
     dc = Decoder()
     dc.main()
@@ -6,21 +6,154 @@ Encodes an RGB image into grayscale + color cues.
 
 import os, sys
 import argparse
+import time
+import threading
+import tracemalloc
+import multiprocessing
+import multiprocessing.util
 # from typing_extensions import ParamSpecArgs
 import cv2
 import numpy as np
 import math
 import random
-from skimage import color
-from sklearn.cluster import KMeans
-from PIL import Image
 import ar_utils
-import importlib
+import model_session
+import watch
+import ir_archive
+# skimage, sklearn, PIL and caffe are imported where needed, most methods only need some of them
+
+# models need to be downloaded before, using "interactive-deep-colorization/models/fetch_models.sh"
+ideepcolor_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "interactive-deep-colorization")
+global_stats_prototxt = os.path.join(ideepcolor_folder, "models", "global_model", "global_stats.prototxt")
+global_stats_weights = os.path.join(ideepcolor_folder, "models", "global_model", "dummy.caffemodel")
+# caffe nets keep their in- and outputs in the net, only one forward at a time
+_global_stats_lock = threading.Lock()
+
+
+def _rgb2lab(rgb):
+    """
+    :return: Lab image 3xHxW
+    """
+    from skimage import color
+    return color.rgb2lab(rgb).transpose((2, 0, 1))
+
+
+class Quantizer(object):
+    """
+    K-Means quantization for integer channels with values 0-255.
+    Clusters the histogram of the channel instead of every pixel, so K-Means gets at most 256 weighted values.
+    Pixels are mapped back with a lookup table. Results are cached by histogram and k until cleared.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def clear(self):
+        self.cache.clear()
+
+    def fit(self, arr, k):
+        """
+        :param arr: uint8 array
+        :param k: number of clusters
+        :return: tuple (label_lut, centers). label_lut: cluster label for each value 0-255, centers: float array
+        """
+        counts = np.bincount(arr.ravel(), minlength=256)
+        key = (k, counts.tobytes())
+        if key in self.cache:
+            return self.cache[key]
+
+        values = np.nonzero(counts)[0]
+        if len(values) <= k:
+            # nothing to cluster, every value is its own center
+            labels = np.arange(len(values))
+            centers = values.astype(float)
+        else:
+            from sklearn.cluster import KMeans
+            # fixed seed: same clusters in every process and run
+            kmeans = KMeans(n_clusters=k, init='k-means++', random_state=0)
+            kmeans.fit(values.reshape((-1, 1)), sample_weight=counts[values])
+            labels = kmeans.labels_
+            centers = kmeans.cluster_centers_[:, 0]
+
+        label_lut = np.zeros(256, dtype=int)
+        label_lut[values] = labels
+        self.cache[key] = (label_lut, centers)
+        return self.cache[key]
+
+    def quantize(self, arr, k, ret_labels=False):
+        """
+        :param arr: uint8 array
+        :param ret_labels: if True, returns tuple: (label image, centers). False: quantized array (int)
+        """
+        label_lut, centers = self.fit(arr, k)
+        if ret_labels:
+            return (label_lut[arr], centers.astype(int))
+        value_lut = centers[label_lut].astype(int)
+        return value_lut[arr]
+
+
+class ImageContext(object):
+    """
+    One input image, read from disk and decoded once.
+    Views of it (rgb, gray, median denoised, lab, ...) are computed on first use and kept until the context is dropped.
+    Views are shared, don't modify them.
+    """
+
+    def __init__(self, path, bgr=None):
+        """
+        :param bgr: optional, already decoded image (as from cv2.imread), to not read path again
+        """
+        self.path = path
+        self._bgr = bgr
+        self.views = {}
+
+    def view(self, name, compute):
+        """
+        Returns the view called name, calls compute() to create it, if it doesn't exist yet
+        """
+        if name not in self.views:
+            self.views[name] = compute()
+        return self.views[name]
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            self._bgr = cv2.imread(self.path, 1)
+            if self._bgr is None:
+                raise IOError("Can't read image: " + str(self.path))
+        return self._bgr
+
+    @property
+    def rgb(self):
+        return self.view("rgb", lambda: cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB))
+
+    @property
+    def gray(self):
+        return self.view("gray", lambda: cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def lab(self):
+        return self.view("lab", lambda: _rgb2lab(self.rgb))
+
+    def rgb_median(self, k=5):
+        return self.view(("rgb_median", k), lambda: cv2.medianBlur(self.rgb, k))
+
+    def lab_median(self, k=5):
+        return self.view(("lab_median", k), lambda: _rgb2lab(self.rgb_median(k)))
+
+    def nbytes(self):
+        """
+        Memory used by the decoded image and all views
+        """
+        arrays = list(self.views.values()) + [self._bgr]
+        return sum(arr.nbytes for arr in arrays if isinstance(arr, np.ndarray))
 
 
 class Encoder(object):
     def __init__(self, output_path="intermediate_representation", method=ar_utils.methods[0],
-                 size=256, p=0, grid_size=10, plot=False, quantize=0) -> None:
+                 size=256, p=0, grid_size=10, plot=False, quantize=0, stats=False, session=None,
+                 write_ir=True, mask_format=1, ab_step=1, compression=None, glob_dist_format=1,
+                 glob_dist_dtype="float16", archive=None) -> None:
         self.methods = ar_utils.methods
         self.method = method
         self.watch = False
@@ -34,6 +167,26 @@ class Encoder(object):
         self.output_path = output_path
         self.plot = plot
         self.quantize_k = quantize
+        self.quantizer = Quantizer()
+        # context of the image currently encoded
+        self.context = None
+        # print time and peak memory per image
+        self.stats = stats
+        # keeps the global stats net loaded between images, shared with Decoders by default
+        self.session = session if session is not None else model_session.default_session
+        # False: only return the intermediate representation from encode, don't write it to output_path
+        self.write_ir = write_ir
+        # .mask format, see ar_utils.Mask.to_bytes_v2
+        self.mask_format = mask_format
+        self.ab_step = ab_step
+        self.compression = compression
+        # .glob_dist format, see ar_utils.glob_dist_to_bytes
+        self.glob_dist_format = glob_dist_format
+        self.glob_dist_dtype = glob_dist_dtype
+        # folder of an ir_archive.IRArchive to append the intermediate representation to, instead of output_path
+        self.archive = archive
+        # writer of this process, opened on first use
+        self._archive_writer = None
 
         # lower CPU priority (to not freeze PC), unix only
         # os.nice(19)
@@ -43,7 +196,7 @@ class Encoder(object):
         except FileExistsError:
             pass
 
-        sys.path.insert(1, os.path.abspath("./interactive-deep-colorization/caffe_files"))
+        sys.path.insert(1, os.path.join(ideepcolor_folder, "caffe_files"))
         os.environ['GLOG_minloglevel'] = '2'  # supress Caffe verbose prints
 
     def main(self):
@@ -58,12 +211,16 @@ class Encoder(object):
         parser.add_argument('-m', '--method', action='store', dest='method', type=str, default=self.methods[0],
                             help='The colorization method to use. Possible values: \"' + ', '.join(self.methods) + '\"')
         parser.add_argument('-w', '--watch', dest='watch', help='watch input folder for new images', action='store_true')
+        parser.add_argument('--journal', dest='journal', action='store', type=str, default=None,
+                            help='Watch: file to record encoded images in, to skip them after a restart. Default: in output_path')
+        parser.add_argument('--settle_time', dest='settle_time', action='store', type=float, default=1.0,
+                            help='Watch: seconds a new file has to stay unchanged, before it counts as completely written')
 
         # for ideepcolor-px
         parser.add_argument('-s', '--size', action='store', dest='size', type=int, default=256,
                             help='Size of the indermediate mask to store the color pixels. Power of 2. \
                             The bigger, the more accurate the result, but requires more storage, and RAM capacity (decoder) \
-                            (For 2048 up to 21GB RAM)')
+                            (For 2048 up to 21GB RAM, unless decoded with --tile_size)')
         parser.add_argument('-g', '--grid_size', action='store', dest='grid_size', type=int, default=10,
                             help='Spacing between color pixels in intermediate mask (--size)  1: fill every spot in mask.  0: dont use any color pixel ')
         parser.add_argument('-p', '--p', action='store', dest='p', type=int, default=0,
@@ -72,6 +229,21 @@ class Encoder(object):
         parser.add_argument('-plt', '--plot', dest='plot', help='Generate Plots for visualization', action='store_true')
         parser.add_argument('-q', '--quantize', dest='quantize', action='store', type=int, default=0, 
                             help='Quantize Pixel values. Number of bins. Default: not used (0), off. ')
+        parser.add_argument('--stats', dest='stats', help='Print time and peak memory for every image', action='store_true')
+        parser.add_argument('--mask_format', dest='mask_format', action='store', type=int, default=1, choices=[1, 2],
+                            help='Version of the .mask format. 2: bit packed, smaller, needs a Decoder of this version. Default: 1')
+        parser.add_argument('--ab_step', dest='ab_step', action='store', type=int, default=1,
+                            help='Mask format 2: precision of the saved a/b values, 1: lossless, 2: round to 2, ... Default: 1')
+        parser.add_argument('--compression', dest='compression', action='store', type=str, default=None,
+                            choices=["zlib", "zstd"], help='Mask format 2: compress .mask files. zstd needs zstandard')
+        parser.add_argument('--glob_dist_format', dest='glob_dist_format', action='store', type=int, default=1,
+                            choices=[1, 2], help='Version of the .glob_dist format. 2: 1 Byte index, smaller values. Default: 1')
+        parser.add_argument('--glob_dist_dtype', dest='glob_dist_dtype', action='store', type=str, default="float16",
+                            choices=ar_utils.glob_dist_dtypes, help='glob_dist format 2: type of the values. Default: float16')
+        parser.add_argument('-j', '--jobs', dest='jobs', action='store', type=int, default=1,
+                            help='Number of worker processes for folders, each with its own Encoder. Default: 1, no workers')
+        parser.add_argument('--archive', dest='archive', action='store', type=str, default=None,
+                            help='Append the intermediate representation to this archive folder (see ir_archive.py), instead of single files in output_path')
 
         args = parser.parse_args()
         self.watch = args.watch
@@ -82,19 +254,32 @@ class Encoder(object):
         self.method = args.method
         self.plot = args.plot
         self.quantize_k = args.quantize
+        self.stats = args.stats
+        self.mask_format = args.mask_format
+        self.ab_step = args.ab_step
+        self.compression = args.compression
+        self.glob_dist_format = args.glob_dist_format
+        self.glob_dist_dtype = args.glob_dist_dtype
+        self.archive = args.archive
 
         try:
             os.makedirs(self.output_path, exist_ok=True)
         except FileExistsError:
             pass
 
-        # TODO: implement watch functionality
-        if not os.path.isdir(args.input_path):
+        from PIL import Image
+        if self.watch:
+            journal = args.journal or os.path.join(self.output_path, ".encoder_journal")
+            watch.watch_folder(args.input_path, self.encode, journal_path=journal, accept=watch.is_image,
+                               settle_time=args.settle_time)
+        elif not os.path.isdir(args.input_path):
             try:
                 Image.open(args.input_path) # Just to test if file is image
                 self.encode(args.input_path)
             except IOError as err:
                 print("Error: File is not a image file: " + args.input_path)
+        elif args.jobs > 1:
+            self.encode_parallel(self.get_image_paths(args.input_path), args.jobs)
         else:
             for fil in os.scandir(args.input_path):
                 if os.path.isdir(fil):
@@ -108,25 +293,151 @@ class Encoder(object):
                     print("Warning: Found non image file: " + fil.path)
                     pass
 
+    def get_image_paths(self, input_path):
+        """
+        Returns all image files directly in folder input_path
+        """
+        from PIL import Image
+        paths = []
+        for fil in os.scandir(input_path):
+            if os.path.isdir(fil):
+                continue
+            try:
+                # to check if file is valid image
+                Image.open(fil.path)
+                paths.append(fil.path)
+            except IOError as err:
+                print("Warning: Found non image file: " + fil.path)
+        return paths
+
+    def get_kwargs(self):
+        """
+        Keyword arguments to create an Encoder with the same settings, e.g. in a worker process
+        """
+        return dict(output_path=self.output_path, method=self.method, size=self.size, p=self.p,
+                    grid_size=self.grid_size, plot=self.plot, quantize=self.quantize_k, stats=self.stats,
+                    write_ir=self.write_ir, mask_format=self.mask_format, ab_step=self.ab_step,
+                    compression=self.compression, glob_dist_format=self.glob_dist_format,
+                    glob_dist_dtype=self.glob_dist_dtype, archive=self.archive)
+
+    def get_archive_writer(self):
+        """
+        Writer for self.archive. Every process opens its own, so worker processes append to their own shards.
+        Closed by close().
+        """
+        if self._archive_writer is None:
+            self._archive_writer = ir_archive.IRArchive(self.archive, mode="a")
+        return self._archive_writer
+
+    def close(self):
+        """
+        Closes the files of the archive writer, if one was opened. Encoding again opens a new one.
+        """
+        if self._archive_writer is not None:
+            self._archive_writer.close()
+            self._archive_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_mask_options(self):
+        """
+        Keyword arguments for Mask.save
+        """
+        if self.mask_format == 2:
+            return dict(version=2, ab_step=self.ab_step, compression=self.compression)
+        return {}
+
+    def get_glob_dist_options(self):
+        """
+        Keyword arguments for ar_utils.save_glob_dist
+        """
+        if self.glob_dist_format == 2:
+            return dict(version=2, dtype=self.glob_dist_dtype)
+        return {}
+
+    def encode_parallel(self, img_paths, jobs, chunks_per_job=4):
+        """
+        Encodes images in a pool of jobs worker processes. Every worker has its own Encoder, nothing is shared.
+        Images are split into chunks of about the same total file size, big chunks first.
+        Prints a throughput summary at the end.
+        :param chunks_per_job: more chunks balance better, fewer have less overhead
+        :return: number of encoded images
+        """
+        chunks = _size_balanced_chunks(img_paths, jobs * chunks_per_job)
+        start = time.perf_counter()
+        encoded = 0
+        busy = 0.0
+        # spawn: same behaviour on all platforms, workers don't inherit loaded nets or threads
+        with multiprocessing.get_context("spawn").Pool(jobs, initializer=init_worker,
+                                                       initargs=(self.get_kwargs(),)) as pool:
+            for results in pool.imap_unordered(encode_chunk_in_worker, chunks):
+                for img_path, seconds in results:
+                    if seconds is None:
+                        continue
+                    encoded += 1
+                    busy += seconds
+        wall_time = time.perf_counter() - start
+
+        print("Encoded %d of %d images in %.2fs with %d workers: %.2f images/s, worker utilization: %.0f%%"
+              % (encoded, len(img_paths), wall_time, jobs, encoded / wall_time if wall_time else 0,
+                 100 * busy / (wall_time * jobs) if wall_time else 0))
+        return encoded
+
     def load_image(self, path, colorspace="lab", quantize=False):
         """
+        :param path: path to image or ImageContext
         :param quantize: quantize loaded image (only applies to ab of LAB)
+        :return: view of the image context, don't modify
         """
+        ctx = self.get_context(path)
         if colorspace == "lab":
-            img_rgb = cv2.cvtColor(cv2.imread(path, 1), cv2.COLOR_BGR2RGB)
-            img_lab = self.rgb_to_lab(img_rgb)
-            img_lab[1] = self.quantize(img_lab[1], k=self.quantize_k, ret_labels=False)
-            img_lab[2] = self.quantize(img_lab[2], k=self.quantize_k, ret_labels=False)
-            return img_lab
+            return self.get_lab_quantized(ctx)
         elif colorspace == "rgb":
-            img = cv2.cvtColor(cv2.imread(path, 1), cv2.COLOR_BGR2RGB)
-            return img
+            return ctx.rgb
         elif "gray" in colorspace or "grey" in colorspace:
-            return cv2.cvtColor(cv2.imread(path, 1), cv2.COLOR_BGR2GRAY)
+            return ctx.gray
+
+    def get_context(self, img):
+        """
+        Returns the ImageContext for img, reuses the current one, if it's for the same image.
+        :param img: path to image or ImageContext
+        """
+        if isinstance(img, ImageContext):
+            ctx = img
+        elif self.context is not None and self.context.path == img:
+            return self.context
+        else:
+            ctx = ImageContext(img)
+        if ctx is not self.context:
+            # new image, forget quantization of the last one
+            self.quantizer.clear()
+            self.context = ctx
+        return ctx
+
+    def get_lab_quantized(self, ctx, median_k=None):
+        """
+        Lab view (lab, y, x) with quantized a and b channels. Unmodified, if quantization is off (k=0).
+        :param median_k: if set, use the median denoised image with this kernel size
+        """
+        lab = ctx.lab if median_k is None else ctx.lab_median(median_k)
+        if not self.quantize_k:
+            return lab
+
+        def compute():
+            img = lab.copy()
+            img[1] = self.quantize(img[1], k=self.quantize_k, ret_labels=False)
+            img[2] = self.quantize(img[2], k=self.quantize_k, ret_labels=False)
+            return img
+        return ctx.view(("lab_quantized", median_k, self.quantize_k), compute)
 
     def quantize(self, arr, k=0, ret_labels=False):
         """
         Quantizes a 2D Array using K-Means clustering to k clusters.
+        Clustering results are reused for the rest of the current image, see Quantizer.
         :param arr: 2D Array, usually a or b channel.
         :param ret_labels: if True, returns tuple: image with labels from 0-k and centers (label_img, centers). False: normally usable array
         """
@@ -139,105 +450,148 @@ class Encoder(object):
             arr = arr + 100
             ab_shifted = True
 
-        inarray=np.array(arr, dtype=np.uint8)
-        orig=inarray
-        inarray=inarray.reshape((-1,1))
-        kmeans=KMeans(n_clusters=k,init='k-means++')
-        kmeans.fit(inarray)
-        centers=kmeans.cluster_centers_
-        labels=kmeans.labels_
+        inarray = np.array(arr, dtype=np.uint8)
         if ret_labels:
-            final = labels.reshape(orig.shape)
-            centers = centers.astype(int)
+            final, centers = self.quantizer.quantize(inarray, k, ret_labels=True)
             if ab_shifted:
                 centers = centers - 100
             return (final, centers)
         else:
-            f=[]
-            centers=centers.squeeze()
-            for i in labels:
-                f.append(centers[i])
-            final=np.asarray(f)
-            final=final.reshape(orig.shape)
-            final = final.astype(int)
+            final = self.quantizer.quantize(inarray, k)
             if ab_shifted:
                 final = final - 100
             return final
-        
+
     def rgb_to_lab(self, rgb):
-        return color.rgb2lab(rgb).transpose((2, 0, 1))
+        return _rgb2lab(rgb)
 
     def encode(self, img_path):
         """
         Executes the right encoding method depending on self.method set.
-        Converts img to grayscale and saves in self.output_path
-        :return:
-        """
-        self.image_path = img_path
-        img_lab_fullres = self.load_image(img_path)
-        img_gray = self.load_image(img_path, colorspace="gray")
-        ar_utils.save_img(self.output_path, ar_utils.gen_new_gray_filename(img_path), img_gray)
-
-        if "ideepcolor-px" in self.method:
-            filename_mask = ar_utils.gen_new_mask_filename(img_path)
-            mask = None
-            if self.method == "ideepcolor-px-grid":
-                mask = self.get_color_mask_grid(img_path, self.grid_size, self.size, self.p)
-                mask.save(self.output_path, os.path.basename(filename_mask), grid_size=self.grid_size)
-            elif self.method == "ideepcolor-px-selective":
-                mask = self.get_color_mask_selective(img_path)
-                mask.save(self.output_path, os.path.basename(filename_mask))
-            # "ideepcolor-px-grid-exclude"
-            elif self.method == ar_utils.methods[4]:
-                mask = self.get_color_mask_grid(img_path, self.grid_size, self.size, self.p, exclude=True)
-                mask.save(self.output_path, os.path.basename(filename_mask))
-            # "ideepcolor-px-grid-selective"
-            elif self.method == ar_utils.methods[5]:
-                # get two masks, one grid one selective, save both in Decoder combine both
-                mask_grid = self.get_color_mask_grid(img_path)
-                mask_grid.save(self.output_path, os.path.basename(filename_mask), name_extra="1", grid_size=self.grid_size)
-
-                mask_sel = self.get_color_mask_selective(img_path)#, sigma_gauss_div=225, sigma_bilat_div=250)
-                mask_sel.save(self.output_path, os.path.basename(filename_mask), name_extra="2")
+        Converts img to grayscale and saves in self.output_path, if self.write_ir
+        :param img_path: path to image or ImageContext
+        :return: ar_utils.IntermediateRepresentation of the image
+        """
+        # only stop tracing started here, to not slow down everything after encoding (e.g. the decoder)
+        stop_tracing = False
+        if self.stats:
+            start = time.perf_counter()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                stop_tracing = True
+            elif hasattr(tracemalloc, "reset_peak"):
+                # python >= 3.9, older versions report the peak since tracing was started
+                tracemalloc.reset_peak()
+            # peak is reported relative to the memory traced before this image
+            baseline = tracemalloc.get_traced_memory()[0]
+
+        try:
+            # decode image once, all methods use views of it. Always a new context, the file could have changed
+            if not isinstance(img_path, ImageContext):
+                img_path = ImageContext(img_path)
+            ctx = self.get_context(img_path)
+            img_path = ctx.path
+            self.image_path = img_path
+            ir = ar_utils.IntermediateRepresentation(img_path, ctx.gray, mask_options=self.get_mask_options(),
+                                                     glob_dist_options=self.get_glob_dist_options())
+
+            if "ideepcolor-px" in self.method:
+                if self.method == "ideepcolor-px-grid":
+                    mask = self.get_color_mask_grid(ctx, self.grid_size, self.size, self.p)
+                    ir.masks.append((mask, self.grid_size))
+                elif self.method == "ideepcolor-px-selective":
+                    mask = self.get_color_mask_selective(ctx)
+                    ir.masks.append((mask, None))
+                # "ideepcolor-px-grid-exclude"
+                elif self.method == ar_utils.methods[4]:
+                    mask = self.get_color_mask_grid(ctx, self.grid_size, self.size, self.p, exclude=True)
+                    ir.masks.append((mask, None))
+                # "ideepcolor-px-grid-selective"
+                elif self.method == ar_utils.methods[5]:
+                    # get two masks, one grid one selective, save both in Decoder combine both
+                    mask_grid = self.get_color_mask_grid(ctx)
+                    ir.masks.append((mask_grid, self.grid_size))
+
+                    mask_sel = self.get_color_mask_selective(ctx)#, sigma_gauss_div=225, sigma_bilat_div=250)
+                    ir.masks.append((mask_sel, None))
                 
 
-        elif self.method == "ideepcolor-global":
-            self.encode_ideepcolor_global(img_path, self.size)
+            elif self.method == "ideepcolor-global":
+                ir.glob_dist = self.encode_ideepcolor_global_batch([ctx], self.size, save=False)[0]
 
-        # ideepcolor-stock: no encoding necessary
-        elif self.method == ar_utils.methods[3]:
-            pass
+            # ideepcolor-stock: no encoding necessary
+            elif self.method == ar_utils.methods[3]:
+                pass
 
-        else:
-            print("Error: method not valid:", self.method)
+            else:
+                print("Error: method not valid:", self.method)
+
+            if self.write_ir:
+                if self.archive:
+                    self.get_archive_writer().write_files(ir.files())
+                else:
+                    ir.save(self.output_path)
+
+            if self.stats:
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                print("Encoded %s in %.3fs, peak memory: %.1f MB, image views: %.1f MB"
+                      % (img_path, time.perf_counter() - start, peak / 2**20, ctx.nbytes() / 2**20))
+        finally:
+            if stop_tracing:
+                tracemalloc.stop()
+        # free views, image is done
+        self.context = None
+        return ir
 
     def encode_ideepcolor_global(self, img_path, size) -> np.ndarray:
-        import caffe
-        lab = importlib.import_module("interactive-deep-colorization.data.lab_gamut")
+        """
+        :param img_path: path to image or ImageContext
+        :return: global distribution (313 bins)
+        """
+        return self.encode_ideepcolor_global_batch([img_path], size)[0]
 
-        img_path = os.path.abspath(img_path)
-        prev_wd = os.getcwd()
+    def encode_ideepcolor_global_batch(self, img_paths, size, save=True) -> np.ndarray:
+        """
+        Global distributions of multiple images with one forward pass, each saved as .glob_dist file.
+        :param img_paths: list of paths to images or ImageContexts
+        :param save: False: only return them
+        :return: array Nx313, one global distribution per image
+        """
+        ctxs = [img if isinstance(img, ImageContext) else ImageContext(img) for img in img_paths]
+        imgs_bgr = np.stack([self._get_glob_dist_input(ctx, size) for ctx in ctxs])
+
+        gt_glob_net = self.get_global_stats_net()
+        with _global_stats_lock:
+            gt_glob_net.blobs['img_bgr'].reshape(*imgs_bgr.shape)
+            gt_glob_net.reshape()
+            gt_glob_net.blobs['img_bgr'].data[...] = imgs_bgr
+            gt_glob_net.forward()
+            glob_dists = gt_glob_net.blobs['gt_glob_ab_313_drop'].data[:,:-1,0,0].copy()
+
+        if save:
+            for ctx, glob_dist_in in zip(ctxs, glob_dists):
+                ar_utils.save_glob_dist(self.output_path, ctx.path, glob_dist_in, **self.get_glob_dist_options())
+        return glob_dists
+
+    def get_global_stats_net(self):
+        """
+        Returns the caffe net, which calculates the global distribution. Only loaded on first use.
+        """
+        import caffe
 
-        ideepcolor_folder = "./interactive-deep-colorization"
-        # check if already in folder
-        if not os.path.basename(ideepcolor_folder) == os.path.basename(os.getcwd()):
-            os.chdir(ideepcolor_folder)
-            
-        # models need to be downloaded before, using "interactive-deep-colorization/models/fetch_models.sh"
-        global_stats_model = os.path.abspath('./models/global_model/global_stats.prototxt')
-        weights = os.path.abspath('./models/global_model/dummy.caffemodel')
-        gt_glob_net = caffe.Net(global_stats_model, 1, weights=weights)
+        def load():
+            return caffe.Net(global_stats_prototxt, caffe.TEST, weights=global_stats_weights)
+        return self.session.get("caffe-global-stats", None, global_stats_weights, -1, load)
 
-        # load image
-        ref_img_fullres = caffe.io.load_image(os.path.abspath(img_path))
+    def _get_glob_dist_input(self, ctx, size):
+        """
+        Image as input for the global stats net: size x size, BGR, 3 x size x size
+        """
+        import caffe
+        # same as caffe.io.load_image: rgb as float 0-1
+        ref_img_fullres = ctx.rgb.astype(np.float32) / 255
         img_glob_dist = (255*caffe.io.resize_image(ref_img_fullres,(size,size))).astype('uint8')
-        gt_glob_net.blobs['img_bgr'].data[...] = img_glob_dist[:,:,::-1].transpose((2,0,1))
-        gt_glob_net.forward()
-        glob_dist_in = gt_glob_net.blobs['gt_glob_ab_313_drop'].data[0,:-1,0,0].copy()
-        os.chdir(prev_wd)
-
-        ar_utils.save_glob_dist(self.output_path, img_path, glob_dist_in)
-        return glob_dist_in
+        return img_glob_dist[:,:,::-1].transpose((2,0,1))
 
     def denoise_image_for_px_selection(self, rgb, k=5):
         """
@@ -248,7 +602,7 @@ class Encoder(object):
 
     def get_color_mask_grid(self, img_path, grid_size=None, size=None, p=None, exclude=False, rand_offset=None):
         """
-        :param img: original color image as lab (lab, y, x)
+        :param img_path: path to original color image or ImageContext
         :param grid_size: distance between pixels of grid in pixels 0 - mask size (-1: every space filled, 0: None filled (stock coloring))
         :param exclude: Use exclude method. Leave out similar colored pixels
         :param rand_offset: For testing/debugging, give every pixel in the grid a random offset of +-this. if used, don't save with grid.
@@ -266,52 +620,21 @@ class Encoder(object):
         if grid_size == 0:
             return mask
 
-        rgb = self.load_image(img_path, colorspace="rgb")
-        rgb = self.denoise_image_for_px_selection(rgb, k=5)
-        img = self.rgb_to_lab(rgb)
-        # if k=0 (default), arr will not be modified
-        img[1] = self.quantize(img[1], k=self.quantize_k, ret_labels=False)
-        img[2] = self.quantize(img[2], k=self.quantize_k, ret_labels=False)
+        ctx = self.get_context(img_path)
+        # median denoised lab, if k=0 (default), a&b will not be quantized
+        img = self.get_lab_quantized(ctx, median_k=5)
 
         h = len(img[0])
         w = len(img[0][0])
 
-        for y in range(size):
-            if y % grid_size != 0:
-                continue
-            for x in range(size):
-                if x % grid_size != 0:
-                    continue
-                use_px = True
-                if exclude:
-                    use_px = self.mask_check_vicinity(img, y, x)
-                if use_px:
-                    if rand_offset and not exclude:
-                        y_off = random.randrange(-rand_offset, rand_offset)
-                        x_off = random.randrange(-rand_offset, rand_offset)
-                        if y+y_off>=size or y-y_off<0 or x+x_off>=size or x-x_off<0:
-                            continue
-                        y_img, x_img = ar_utils._coord_mask_to_img(h, w, y+y_off, x+x_off, size)
-                        mask.put_point((y+y_off, x+x_off), [ img[1][y_img][x_img],
-                                                             img[2][y_img][x_img] ])
-                    else:
-                        y_img, x_img = ar_utils._coord_mask_to_img(h, w, y, x, size)
-                        mask.put_point((y, x), [ img[1][y_img][x_img],
-                                                 img[2][y_img][x_img] ])
-                    
+        locs, vals = self.sample_grid(img, grid_size, size, exclude=exclude, rand_offset=rand_offset, ctx=ctx)
+        mask.put_points(locs, vals)
 
         if self.plot:
             import matplotlib.pyplot as plt
-            rgb = self.load_image(img_path, colorspace="rgb")
-            plt.imshow(rgb)
-            y_arr, x_arr = [], []
-            for ys in range(mask.size):
-                for xs in range(mask.size):
-                    if not mask.mask[0][ys][xs]:
-                        continue
-                    y_img, x_img = ar_utils._coord_mask_to_img(h, w, ys, xs, size)
-                    y_arr.append(y_img)
-                    x_arr.append(x_img)
+            plt.imshow(ctx.rgb)
+            ys, xs = np.nonzero(mask.mask[0])
+            y_arr, x_arr = ar_utils._coord_mask_to_img(h, w, ys, xs, size)
 
             plt.scatter(x=x_arr, y=y_arr, c='r', s=1)
                     
@@ -323,45 +646,85 @@ class Encoder(object):
 
         return mask
 
-    def mask_check_vicinity(self, img, y, x, round_to=25, radius=1):
+    def sample_grid(self, img, grid_size, size, exclude=False, rand_offset=None, ctx=None):
         """
-        round_to: 10 for cityscapes, 20/25 for colorful high res
-        Checks if pixels of same color (rounded) are in square vicinity of size radius of coordinates given.
-        y and x mask coordinates, not image
-        Returns True if other colors are in vicinity. False if all colors in this radius are the same.
-        TODO: clear cache after IR got written
+        Picks the color cues of a grid for all grid points at once.
+        :param img: color image as lab (lab, y, x)
+        :param ctx: optional ImageContext of img, to cache intermediate results of exclude
+        :param grid_size: distance between grid points in mask coordinates. -1: every point
+        :param size: mask size
+        :return: tuple (locs, vals). Nx2 array of mask coordinates (y, x), Nx2 array of (a, b)
         """
         h = len(img[0])
         w = len(img[0][0])
-        # bin_mask = mask.mask[0]
-
-        if not hasattr(self, 'px_vic_cache_a'):
+        grid = np.arange(0, size, abs(grid_size))
+        ys, xs = [coords.ravel() for coords in np.meshgrid(grid, grid, indexing="ij")]
+
+        if exclude:
+            keep = self.mask_check_vicinity(img, ys, xs, size=size, ctx=ctx)
+            ys, xs = ys[keep], xs[keep]
+        elif rand_offset:
+            # draw offsets grid point by grid point, so results stay the same for a seeded random
+            offsets = np.array([(random.randrange(-rand_offset, rand_offset), random.randrange(-rand_offset, rand_offset))
+                                for i in range(len(ys))], dtype=int).reshape(-1, 2)
+            y_off, x_off = offsets[:, 0], offsets[:, 1]
+            keep = ~((ys + y_off >= size) | (ys - y_off < 0) | (xs + x_off >= size) | (xs - x_off < 0))
+            ys, xs = (ys + y_off)[keep], (xs + x_off)[keep]
+
+        y_img, x_img = ar_utils._coord_mask_to_img(h, w, ys, xs, size)
+        locs = np.stack((ys, xs), axis=1)
+        vals = np.stack((img[1][y_img, x_img], img[2][y_img, x_img]), axis=1)
+        return locs, vals
+
+    def get_vicinity_planes(self, img, round_to=25, ctx=None):
+        """
+        Median denoised a and b channels, rounded to round_to, for mask_check_vicinity.
+        :param img: color image as lab (lab, y, x)
+        :param ctx: ImageContext img belongs to. If given, the planes are cached there and dropped with the image.
+        :return: tuple (a, b)
+        """
+        def compute():
             a = img[1]+100 
             b = img[2]+100
             a = np.int16(a)  # OpenCV is weird. why not int8 ??!!???
             b = np.int16(b)
-            self.px_vic_cache_a = self.round_arr_to( self.denoise_image_for_px_selection(a), round_to)
-            self.px_vic_cache_b = self.round_arr_to( self.denoise_image_for_px_selection(b), round_to)
+            return (self.round_arr_to( self.denoise_image_for_px_selection(a), round_to),
+                    self.round_arr_to( self.denoise_image_for_px_selection(b), round_to))
 
-        a = self.px_vic_cache_a
-        b = self.px_vic_cache_b
+        if ctx is None:
+            return compute()
+        return ctx.view(("vicinity_ab", round_to, self.quantize_k), compute)
+
+    def mask_check_vicinity(self, img, ys, xs, round_to=25, radius=1, size=None, ctx=None):
+        """
+        round_to: 10 for cityscapes, 20/25 for colorful high res
+        Checks if pixels of same color (rounded) are in square vicinity of size radius of coordinates given.
+        ys and xs: arrays of mask coordinates, not image. All points are checked at once.
+        Returns bool array, True if other colors are in vicinity. False if all colors in this radius are the same.
+        """
+        if size is None:
+            size = self.size
+        a, b = self.get_vicinity_planes(img, round_to, ctx=ctx)
+        h, w = a.shape
 
-        y_img, x_img = ar_utils._coord_mask_to_img(h, w, y, x, self.size)
-        center = (a[y_img][x_img], b[y_img][x_img])
+        y_img, x_img = ar_utils._coord_mask_to_img(h, w, ys, xs, size)
+        center_a = a[y_img, x_img]
+        center_b = b[y_img, x_img]
+        different = np.zeros(len(ys), dtype=bool)
+        # compare with the shifted coordinates of all points at once
         for y_rel in range(-radius, radius):
             for x_rel in range(-radius, radius):
-                y_px, x_px = ar_utils._coord_mask_to_img(h, w, y + y_rel, x + x_rel, self.size)
-                if y_px >= h or y_px < 0 or x_px >= w or x_px < 0:
-                    continue
-                ab = (a[y_px][x_px], b[y_px][x_px])
-                if center != ab:
-                    return True
-        return False
-        
+                y_px, x_px = ar_utils._coord_mask_to_img(h, w, ys + y_rel, xs + x_rel, size)
+                inside = (y_px < h) & (y_px >= 0) & (x_px < w) & (x_px >= 0)
+                y_px = np.where(inside, y_px, 0)
+                x_px = np.where(inside, x_px, 0)
+                different |= inside & ((a[y_px, x_px] != center_a) | (b[y_px, x_px] != center_b))
+        return different
 
     # Everything for selective color mask
     def get_color_mask_selective(self, img_path, round_to=10, scaling_factor=None, sigma_gauss_div=250, sigma_bilat_div=500):
         """
+        :param img_path: path to original color image or ImageContext
         :param sigma_gauss_div: divider for the gaussian sigma (last blurring step). Smaller -> stronger blur -> fewer points. Default: 250
         :return Mask: Mask of pixels
         """
@@ -369,8 +732,9 @@ class Encoder(object):
         # PARAM: hardcoded, round_to (for cityscapes rather smaller (8). Default: 10)
         # PARAM: hardcoded, scaling_factor: 8 for highres, or higher. 4, 2 for cityscapes and low res
 
+        ctx = self.get_context(img_path)
         # load as rgb 0-255, also save copy for plot later
-        rgb_orig = rgb = self.load_image(img_path, colorspace="rgb")
+        rgb_orig = rgb = ctx.rgb
 
         img_dims = rgb.shape[:-1]
 
@@ -382,9 +746,9 @@ class Encoder(object):
         
         # Median Filter; remove extreme individual noise pixels
         # will be used for selection of pixels for mask later and also as first preprocessing step
-        rgb = self.denoise_image_for_px_selection(rgb, k=5)
+        rgb = ctx.rgb_median(5)
 
-        lab_median = self.rgb_to_lab(rgb)
+        lab_median = ctx.lab_median(5)
         a_median = lab_median[1].astype(int)
         b_median = lab_median[2].astype(int)
         # will be returned unmodified, if k=0
@@ -442,18 +806,16 @@ class Encoder(object):
         # delete points near edges, since sometimes they tend to bunch on the edges, and those are not super important for colorization anyway
         h, w = a.shape
         dist = 2  # distance from edges
-        keep = np.ones(len(centres), dtype=bool)
-        for idx, c in enumerate(centres):
-            if c[0] < dist or c[0] > h-dist or c[1] < dist or c[1] > w-dist:
-                keep[idx] = False
+        keep = ((centres[:, 0] >= dist) & (centres[:, 0] <= h-dist) &
+                (centres[:, 1] >= dist) & (centres[:, 1] <= w-dist))
         centres = centres[keep]
 
         # Save image with red dots for selected pixels
         if self.plot:
             import matplotlib.pyplot as plt
             plt.imshow(rgb_orig)
-            y = np.array( [row[0] for row in centres] )*scaling_factor
-            x = np.array( [row[1] for row in centres] )*scaling_factor
+            y = centres[:, 0]*scaling_factor
+            x = centres[:, 1]*scaling_factor
             plt.scatter(x=x, y=y, c='r', s=1)
             plt_fn = ar_utils.gen_new_mask_filename(self.image_path, [self.method, self.size])
             plt_path = os.path.join(self.output_path, plt_fn)
@@ -463,13 +825,13 @@ class Encoder(object):
 
         # Use found interesting pixels as coordinates to fill mask
         h, w = img_dims
-        for px in centres:
-            # scale up to resolution of input image
-            loc = (px[0]*scaling_factor, px[1]*scaling_factor)
-            # use colors from median filtered image
-            val = (a_median[loc], b_median[loc])
-            loc = ar_utils._coord_img_to_mask(h, w, loc[0], loc[1], size=self.size)
-            mask.put_point(loc, val)
+        # scale up to resolution of input image
+        loc_y = centres[:, 0]*scaling_factor
+        loc_x = centres[:, 1]*scaling_factor
+        # use colors from median filtered image
+        vals = np.stack((a_median[loc_y, loc_x], b_median[loc_y, loc_x]), axis=1)
+        locs = np.stack(ar_utils._coord_img_to_mask(h, w, loc_y, loc_x, size=self.size), axis=1)
+        mask.put_points(locs, vals)
 
         return mask
 
@@ -505,22 +867,19 @@ class Encoder(object):
     def set_color_area_ids(self, ab):
         """
         Replaces every seperate blob of a color with a unique id
+        Ids are ordered by color first, then by the first pixel of the blob (row by row).
         """
-        # replace pixel values via ff with unique id
-        id_ = 0
-        # np.unique sorted ascendingly
-        unique_colors = np.unique(ab)
-        for col in unique_colors:
-            # while as long as there is this color in the array
-            while np.where(ab==col)[0].size:
-                found_pos = np.where(ab==col)
-                y = found_pos[0][0]
-                x = found_pos[1][0]
-                # run ff from this pixel and give all connected same colors the same id
-                ab = self.flood_fill(ab, (y, x), id_)
-                # cv2.floodFill(ab_uint8, None, (x, y), id)
-                id_ = id_+1
-        return ab
+        from skimage.measure import label
+        ab = np.asarray(ab, dtype=np.int64)
+        # label all blobs in one pass: (diagonal) neighbours with the same combined ab value belong to the same blob.
+        # ab values are >= 0, so no pixel is background
+        blobs = label(ab, background=-1, connectivity=2).ravel()
+        blob_labels, first_px = np.unique(blobs, return_index=True)
+        # sort blobs by color, then by position of first pixel
+        order = np.lexsort((first_px, ab.ravel()[first_px]))
+        ids = np.empty(len(order), dtype="uint32")
+        ids[order] = np.arange(len(order))
+        return ids[np.searchsorted(blob_labels, blobs)].reshape(ab.shape)
 
     def get_centres(self, ab_ids, random_px_threshold=1000):
         """
@@ -528,55 +887,47 @@ class Encoder(object):
         :param ab_ids: 2D Array of combined a&b channel, where each self-contained unique blob is replaced with a id
         :param random_px_threshold: size of blob, at which to add new random pixels. 
         """
-        import scipy.spatial.distance
-        import random
-        ids = np.unique(ab_ids)
-        centres = []
+        # group all pixel positions by id, stable sort keeps them row by row inside each blob
+        order = np.argsort(ab_ids, axis=None, kind="stable")
+        ids, starts, sizes = np.unique(ab_ids.ravel()[order], return_index=True, return_counts=True)
+        area_coords_y, area_coords_x = np.divmod(order, ab_ids.shape[1])
+
+        # centre of every blob at once
+        centres_y = np.round(np.add.reduceat(area_coords_y, starts) / sizes).astype(int)
+        centres_x = np.round(np.add.reduceat(area_coords_x, starts) / sizes).astype(int)
+        # the centre could be outside of its shape
+        inside = ab_ids[centres_y, centres_x] == ids
 
-        for id in ids:
-            area_coords = np.where(ab_ids == id)
-            area_coords_y = area_coords[0]
-            area_coords_x = area_coords[1]
+        centres = []
+        add_random = self.method != ar_utils.methods[5]
+        for blob, size in enumerate(sizes):
             # Skip extremely small blobs of only a few pixels
-            if len(area_coords_y) <= 4:
+            if size <= 4:
                 continue
-            # get centre
-            centre = ( int(round((sum(area_coords_y)/len(area_coords_y)))),
-                       int(round((sum(area_coords_x)/len(area_coords_x)))) )
-
-            # since centre could be outside shape, search nearest point to centre
-            closest = None
-            dist = float('inf')
-            # TODO: get more points if area is above certain size
-            # NOTE: this is really slow, if centre not in shape. Maybe just use a random point in this case. 
-            for idx, i in enumerate(area_coords_y):
-                # break if calculated centre is inside area
-                if centre[0] in area_coords_y and centre[1] in area_coords_x:
-                    closest = centre
-                    break
-                
-                n_dist = distance.euclidean((area_coords_y[idx], area_coords_x[idx]), centre)
-                if n_dist < dist:
-                    dist = n_dist
-                    closest = (area_coords_y[idx], area_coords_x[idx])
-            centres.append(closest)
+            blob_y = area_coords_y[starts[blob]:starts[blob] + size]
+            blob_x = area_coords_x[starts[blob]:starts[blob] + size]
+            if inside[blob]:
+                centres.append((centres_y[blob], centres_x[blob]))
+            else:
+                # nearest point of the shape to the centre
+                nearest = np.argmin((blob_y - centres_y[blob])**2 + (blob_x - centres_x[blob])**2)
+                centres.append((blob_y[nearest], blob_x[nearest]))
 
             # if current blob is particularly large, use additional randomly selected pixels. Not with grid+selective
-            if len(area_coords_y) >= random_px_threshold and self.method != ar_utils.methods[5]:
+            if size >= random_px_threshold and add_random:
 
                 # scale up additional pixels linearly in beginning, logarithmically later
-                if len(area_coords_y) < random_px_threshold*3:
-                    add_px = int( len(area_coords_y) // random_px_threshold )
+                if size < random_px_threshold*3:
+                    add_px = int( size // random_px_threshold )
                 else:
-                    add_px = int(round( math.log(len(area_coords_y), 10) ))
-                
+                    add_px = int(round( math.log(size, 10) ))
+
                 for i in range(add_px):
-                    random.seed(i)
-                    new_coord = random.randint(0, len(area_coords_y)-1)
-                    new_px = (area_coords_y[new_coord], area_coords_x[new_coord])
-                    centres.append(new_px)
-                    
-        return np.array(centres)
+                    # seeded with i -> same pixels for every run
+                    new_coord = random.Random(i).randint(0, size-1)
+                    centres.append((blob_y[new_coord], blob_x[new_coord]))
+
+        return np.array(centres, dtype=int).reshape(-1, 2)
 
     def lab_to_rgb(self, *args):
         """
@@ -590,10 +941,67 @@ class Encoder(object):
         else:
             print("Wrong number of arguments in lab_to_rgb. ")
             return None
+        from skimage import color
         return np.fliplr(np.rot90(color.lab2rgb(np.transpose(lab)), 3))
 
 
 
+# Encoder of a worker process, see init_worker
+_worker_encoder = None
+
+
+def init_worker(encoder_kwargs):
+    """
+    Initializer for worker processes: every worker gets its own Encoder, nothing is shared.
+    :param encoder_kwargs: keyword arguments for Encoder
+    """
+    global _worker_encoder
+    _worker_encoder = Encoder(**encoder_kwargs)
+    # runs when the worker process exits, atexit handlers don't
+    multiprocessing.util.Finalize(_worker_encoder, _worker_encoder.close, exitpriority=10)
+
+
+def encode_in_worker(img_path, bgr=None):
+    """
+    Encodes one image with the Encoder of this worker process.
+    :param bgr: optional, already decoded image
+    :return: tuple (img_path, seconds spent encoding)
+    """
+    start = time.perf_counter()
+    _worker_encoder.encode(ImageContext(img_path, bgr))
+    return (img_path, time.perf_counter() - start)
+
+
+def encode_chunk_in_worker(img_paths):
+    """
+    Encodes a chunk of images with the Encoder of this worker process. Errors only skip the image.
+    :return: list of tuples (img_path, seconds spent encoding or None on error)
+    """
+    results = []
+    for img_path in img_paths:
+        try:
+            results.append(encode_in_worker(img_path))
+        except Exception as err:
+            print("Error encoding " + img_path + ": " + str(err))
+            results.append((img_path, None))
+    return results
+
+
+def _size_balanced_chunks(img_paths, n_chunks):
+    """
+    Splits paths into up to n_chunks chunks with about the same total file size.
+    Biggest files are assigned first, each to the currently smallest chunk. Chunks are sorted biggest first.
+    """
+    chunks = [[] for i in range(max(1, min(n_chunks, len(img_paths))))]
+    totals = [0] * len(chunks)
+    for img_path in sorted(img_paths, key=os.path.getsize, reverse=True):
+        i = totals.index(min(totals))
+        chunks[i].append(img_path)
+        totals[i] += os.path.getsize(img_path)
+    order = sorted(range(len(chunks)), key=lambda i: totals[i], reverse=True)
+    return [chunks[i] for i in order if chunks[i]]
+
+
 if __name__ == "__main__":
-    ec = Encoder()
-    ec.main()
+    with Encoder() as ec:
+        ec.main()
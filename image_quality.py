@@ -5,6 +5,11 @@ Calculates the Image Quality using PSNR and MS-SSIM (by  default) recursively an
 """
 
 import os, sys
+import time
+import copy
+import shutil
+import hashlib
+import tempfile
 import numpy as np
 import argparse
 # from sewar import full_ref
@@ -14,24 +19,43 @@ import concurrent.futures
 from multiprocessing import Pool
 from pathlib import Path
 import warnings
-from fast_qa.fast_qa import ssim, ms_ssim, vif_spatial
-import lpips
-import torch
-
-from skimage import color
-import skimage
-from packaging import version
-if version.parse(skimage.__version__) < version.parse("0.17.0"):
-    from skimage.measure import compare_ssim as ssim_sk
-    from skimage.measure import compare_psnr as psnr_sk
-else:
-    from skimage.metrics import structural_similarity as ssim_sk
-    from skimage.metrics import peak_signal_noise_ratio as psnr_sk
+import quality_metrics
+import ar_utils
+import results_store
+# skimage (PSNR, Lab), fast_qa (SSIM, MS-SSIM, VIF) and lpips (imports torch) are only imported, when their metric is used
+
+
+# metric name (column) -> ImageQuality attribute, in the order of the columns
+METRICS = [
+    ("LPIPS", "lpips"),
+    ("PSNR", "psnr"),
+    ("MS-SSIM", "msssim"),
+    ("SSIM", "ssim"),
+    ("VIF-SPATIAL", "vif"),
+]
+
+
+def skimage_metrics():
+    """
+    :return: tuple (structural_similarity, peak_signal_noise_ratio) of the installed skimage version
+    """
+    import skimage
+    from packaging import version
+    if version.parse(skimage.__version__) < version.parse("0.17.0"):
+        from skimage.measure import compare_ssim as ssim_sk
+        from skimage.measure import compare_psnr as psnr_sk
+    else:
+        from skimage.metrics import structural_similarity as ssim_sk
+        from skimage.metrics import peak_signal_noise_ratio as psnr_sk
+    return ssim_sk, psnr_sk
+
 
 class ImageQuality(object):
     def __init__(self, in_path="output_images", reference_path="../pictures/", out_file="image_quality.org",
                  recursive=True, skip=False, truncate=4, ab=False, format_org=False,
-                 no_header_name=False, ssim=False, vif=False):
+                 no_header_name=False, ssim=False, vif=False, msssim=False, psnr=False, lpips=False, jobs=None,
+                 chunksize=0, lpips_batch=8, engine="fast_qa", reference_cache=True, cache_dir=None,
+                 store=None):
         self.in_path = in_path
         self.ref_path = reference_path
         self.out_file = out_file
@@ -43,12 +67,35 @@ class ImageQuality(object):
         self.format_org = format_org
         self.ssim = ssim
         self.vif = vif
+        self.msssim = msssim
+        self.psnr = psnr
+        self.lpips = lpips
+        # LPIPS network, loaded once per process by get_lpips_model
+        self.loss_fn = None
+        self.lpips_error = None
+        # max image pairs per LPIPS forward pass
+        self.lpips_batch = lpips_batch
         self.no_header_name = no_header_name
+        # worker processes of the pool for all image pairs, default: one per cpu
+        self.jobs = jobs or self.cpus
+        # image pairs sent to a worker at once, 0: chosen from the number of pairs
+        self.chunksize = chunksize
+        # "fast_qa" or "numpy": SSIM, MS-SSIM and PSNR of quality_metrics, with precomputed reference statistics
+        self.engine = engine
+        # decode references compared to more than one image only once, see ReferenceCache
+        self.use_reference_cache = reference_cache
+        # folder for the reference cache, None: system temp folder
+        self.cache_dir = cache_dir
+        # ReferenceCache while run_jobs is running
+        self.reference_cache = None
+        # SQLite file of results_store.ResultsStore, None: compute all pairs
+        self.store_path = store
 
         # Disable Complex to float casting warning
         warnings.filterwarnings('ignore')
-        # lower CPU priority (to not freeze PC)
-        os.nice(19)
+        # lower CPU priority (to not freeze PC), unix only, inherited by the workers
+        if hasattr(os, "nice"):
+            os.nice(19)
 
     def main(self):
         parser = argparse.ArgumentParser(
@@ -148,6 +195,58 @@ class ImageQuality(object):
             help="Calculate LPIPS (Learned Perceptual Image Patch Similarity). Warning: only works on RGB. if --ab is set, calculates on RGB. ",
             action="store_true",
         )
+        parser.add_argument(
+            "-j", "--jobs",
+            dest="jobs",
+            type=int,
+            help="Number of worker processes for all image pairs. Default: number of cpus",
+            default=self.cpus,
+        )
+        parser.add_argument(
+            "--lpips_batch",
+            dest="lpips_batch",
+            type=int,
+            help="Max number of image pairs of the same size per LPIPS forward pass. Default: 8",
+            default=8,
+        )
+        parser.add_argument(
+            "--engine",
+            dest="engine",
+            choices=["fast_qa", "numpy"],
+            help="fast_qa: SSIM, MS-SSIM and VIF of fast_qa, PSNR of skimage, every channel on its own. numpy: PSNR, \
+            SSIM and MS-SSIM of quality_metrics, all channels in one vectorized pass, with the statistics of every \
+            reference image computed once. Default: fast_qa. Note: older RGB results of fast_qa were computed on the \
+            first 3 image rows instead of the R, G, B channels and aren't comparable",
+            default="fast_qa",
+        )
+        parser.add_argument(
+            "--no_reference_cache",
+            dest="no_reference_cache",
+            help="Decode the reference image again for every recolored image, instead of once into memory mapped files",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--cache_dir",
+            dest="cache_dir",
+            type=str,
+            help="Folder for the decoded reference images, removed afterwards. Default: system temp folder",
+            default=None,
+        )
+        parser.add_argument(
+            "--store",
+            dest="store",
+            type=str,
+            help="SQLite file to keep the results in. Only pairs and metrics, that aren't stored for the current \
+            version (size, modification time) of both images, are computed. Default: None, compute everything",
+            default=None,
+        )
+        parser.add_argument(
+            "--chunksize",
+            dest="chunksize",
+            type=int,
+            help="Image pairs sent to a worker at once. Default: 0, chosen from the number of pairs",
+            default=0,
+        )
 
         args = parser.parse_args()
         self.in_path = args.input_path
@@ -165,6 +264,13 @@ class ImageQuality(object):
         self.psnr = args.psnr
         self.vif = args.vif
         self.lpips = args.lpips
+        self.jobs = max(1, args.jobs)
+        self.chunksize = args.chunksize
+        self.lpips_batch = max(1, args.lpips_batch)
+        self.engine = args.engine
+        self.use_reference_cache = not args.no_reference_cache
+        self.cache_dir = args.cache_dir
+        self.store_path = args.store
 
         # set default methods, if non are given
         if not self.msssim and not self.ssim and not self.psnr and not self.vif and not self.lpips:
@@ -173,8 +279,7 @@ class ImageQuality(object):
             self.lpips = True
 
         if self.lpips:
-            # TODO: add spatial as parameter
-            self.loss_fn = lpips.LPIPS(net='alex', verbose=True)  # Can also set net = 'squeeze' or 'vgg' squeeze: more lightweight
+            # the LPIPS network is loaded in the worker processes, see init_worker
             if self.ab:
                 print("Warning LPIPS only runs on RGB. LPIPS will run on RGB, the rest on the ab channels. ")
 
@@ -183,15 +288,118 @@ class ImageQuality(object):
     def get_and_write_quality(self):
         """
         To be executed, when imported. 
+        Collects the image pairs of all folders first and runs them in one pool.
+        A folder's .org file is written, as soon as all of its pairs are done.
+        With a results store, only the metrics missing in the store are computed, the rest is taken from it.
         """
-        # TODO: make it efficiently use multithreading, generate huge list of src & target image / folder -> MT that
         ref_paths, ref_names = self.get_ref_paths_names()
-        
+        jobs, folders = self.get_jobs(ref_paths, ref_names)
+        print("Found %d recolored images in %d folder(s)" % (len(jobs), len(folders)))
+
+        metrics = self.get_metrics()
+        store = results_store.ResultsStore(self.store_path) if self.store_path else None
+        # index -> stored values
+        stored = {}
+        # tuple of missing metrics -> jobs
+        groups = {}
+        for job in jobs:
+            idx, root, ref_path, rec_path = job
+            if store is not None:
+                stored[idx] = store.get(ref_path, rec_path, metrics, self.ab, self.engine)
+            missing = tuple(metric for metric in metrics if metric not in stored.get(idx, {}))
+            if missing:
+                groups.setdefault(missing, []).append(job)
+
+        remaining = {root: 0 for root in folders}
+        for group in groups.values():
+            for idx, root, ref_path, rec_path in group:
+                remaining[root] += 1
+        results = {root: [] for root in folders}
+        for idx, root, ref_path, rec_path in jobs:
+            if len(stored.get(idx, {})) == len(metrics):
+                results[root].append((idx, self.get_stored_quality(stored[idx], ref_path, rec_path)))
+        if store is not None:
+            print("%d image pairs up to date in %s" % (len(jobs) - sum(remaining.values()), self.store_path))
+
+        # folders without images, or without changes
+        for root, count in folders.items():
+            if not remaining[root]:
+                if not count:
+                    print("Now in: ", root)
+                self.write_folder(results.pop(root), ref_names, root)
+
+        computed = sum(remaining.values())
+        start = time.perf_counter()
+        try:
+            for missing, group in groups.items():
+                for idx, root, quality in self.with_metrics(missing).run_jobs(group):
+                    if quality is not None:
+                        if store is not None:
+                            ref_path, rec_path = jobs[idx][2:]
+                            store.put(ref_path, rec_path, {metric: quality[metric] for metric in missing},
+                                      self.ab, self.engine)
+                            if len(missing) < len(metrics):
+                                values = dict(stored[idx])
+                                values.update(quality)
+                                quality = self.get_stored_quality(values, ref_path, rec_path)
+                        results[root].append((idx, quality))
+                    remaining[root] -= 1
+                    if not remaining[root]:
+                        self.write_folder(results.pop(root), ref_names, root)
+        finally:
+            if store is not None:
+                store.close()
+        elapsed = time.perf_counter() - start
+        if computed:
+            print("Compared %d image pairs in %.2fs with %d worker(s): %.2f pairs/s"
+                  % (computed, elapsed, min(self.jobs, computed), computed / elapsed if elapsed else 0))
+
+    def write_folder(self, results, ref_names, root):
+        """
+        :param results: list of tuples (index, quality dict), written in the order the pairs were found
+        """
+        qualities = [quality for idx, quality in sorted(results, key=lambda r: r[0])]
+        self.write_quality(qualities, ref_names, os.path.join(root, self.out_file))
+
+    def get_metrics(self):
+        """
+        :return: names of the enabled metrics, in the order of the columns
+        """
+        return [metric for metric, attribute in METRICS if getattr(self, attribute)]
+
+    def with_metrics(self, metrics):
+        """
+        :return: this ImageQuality, or a copy with only the given metrics enabled
+        """
+        if list(metrics) == self.get_metrics():
+            return self
+        image_quality = copy.copy(self)
+        for metric, attribute in METRICS:
+            setattr(image_quality, attribute, metric in metrics)
+        return image_quality
+
+    def get_stored_quality(self, values, ref_path, rec_path):
+        """
+        :param values: dict metric -> value with all enabled metrics, e.g. from the results store
+        :return: quality dict with the columns of calc_quality_images
+        """
+        quality = {metric: values[metric] for metric in self.get_metrics()}
+        quality["File"] = rec_path
+        self.add_file_info(quality, ref_path, rec_path)
+        return quality
+
+    def get_jobs(self, ref_paths, ref_names):
+        """
+        Finds the recolored versions of all reference images in in_path and its subfolders.
+        Every folder is listed once, its files are matched to the references by name, see match_reference.
+        :return: tuple (list of jobs (index, folder, reference path, recolored path), dict folder -> number of jobs)
+        """
+        jobs = []
+        folders = {}
+        ref_index = set(ref_names)
         # iterate through all subfolders of in_path
         for root, dirs, files in os.walk(self.in_path):
             # root: dir in which to place .org file later
-            # files: list of all files in root
-            # iterate through all input files and search for recolored versions
             if self.skip and Path(os.path.join(root, self.out_file)).exists():
                 print("File '" + os.path.join(root, self.out_file) + "' already exists, skipping. ")
                 if not self.recursive:
@@ -199,17 +407,79 @@ class ImageQuality(object):
                 else:
                     continue
 
-            print("Now in: ", root)
-            qualities = []
-            for idx, ref_name in enumerate(ref_names):
-                files_matching_ref = self.find_files(ref_name, root)
-                if not files_matching_ref:
+            folders[root] = 0
+            # reference name -> recolored paths
+            matches = {}
+            for fil in files:
+                # skip mask plot visulizations
+                # TODO: check properly if file is image
+                if ".mask" in fil or ".glob_dist" in fil:
                     continue
-                # qualities: Array of dictionaries
-                qualities = qualities + self.calc_quality(ref_paths[idx], files_matching_ref)
-            self.write_quality(qualities, ref_names, os.path.join(root, self.out_file))
+                ref_name = self.match_reference(fil, ref_index)
+                if ref_name is not None:
+                    matches.setdefault(ref_name, []).append(os.path.abspath(os.path.join(root, fil)))
+            for idx, ref_name in enumerate(ref_names):
+                for rec_path in matches.get(ref_name, []):
+                    jobs.append((len(jobs), root, ref_paths[idx], rec_path))
+                    folders[root] += 1
             if not self.recursive:
                 break
+        return jobs, folders
+
+    @staticmethod
+    def match_reference(filename, ref_index):
+        """
+        Reference name of a recolored file: the original filename of ar_utils.parse_recolored_filename.
+        Other files match the longest reference name, that is followed by "_", "." or nothing,
+        so rgb_0001 doesn't match rgb_00010.
+        :param ref_index: set of reference names (filenames wo extension)
+        :return: reference name or None
+        """
+        parsed = ar_utils.parse_recolored_filename(filename)
+        if parsed is not None and parsed[0] in ref_index:
+            return parsed[0]
+        stem = os.path.splitext(filename)[0]
+        if stem in ref_index:
+            return stem
+        for i in range(len(stem) - 1, 0, -1):
+            if stem[i] in "_." and stem[:i] in ref_index:
+                return stem[:i]
+        return None
+
+    def run_jobs(self, jobs):
+        """
+        Runs calc_quality_images for all jobs from get_jobs in one pool of self.jobs worker processes.
+        Every worker gets a copy of this object once, jobs are sent in chunks, LPIPS is batched within a chunk.
+        :return: generator of tuples (index, folder, quality dict or None on error), in the order they finish
+        """
+        if not jobs:
+            return
+        processes = min(self.jobs, len(jobs))
+        # about 4 chunks per worker: balances different image sizes, without sending every pair alone
+        chunksize = self.chunksize or max(1, len(jobs) // (processes * 4))
+        chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+        # references with more than one recolored image are decoded once by the workers, before the jobs
+        counts = {}
+        for idx, root, ref_path, rec_path in jobs:
+            counts[ref_path] = counts.get(ref_path, 0) + 1
+        cached_refs = [ref_path for ref_path, count in counts.items() if count > 1]
+        if self.use_reference_cache and cached_refs:
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            self.reference_cache = ReferenceCache(tempfile.mkdtemp(prefix="image_quality_", dir=self.cache_dir),
+                                                  ab=self.ab, stats_scales=self.get_stats_scales())
+        try:
+            with Pool(processes=processes, initializer=init_worker, initargs=(self,)) as pool:
+                if self.reference_cache is not None:
+                    for cached in pool.imap_unordered(cache_reference, cached_refs):
+                        pass
+                for results in pool.imap_unordered(calc_quality_chunk, chunks):
+                    for result in results:
+                        yield result
+        finally:
+            if self.reference_cache is not None:
+                self.reference_cache.close()
+                self.reference_cache = None
 
     def calc_quality(self, ref_path, recolored_paths):
         """
@@ -221,17 +491,16 @@ class ImageQuality(object):
         if type(recolored_paths) is str:
             recolored_paths = [recolored_paths]
 
-        mp_args = []
+        jobs = []
         for i in recolored_paths:
             # skip mask plot visulizations
             # TODO: check properly if file is image
             if ".mask" in i or ".glob_dist" in i:
                 continue
-            mp_args.append((ref_path, i))
-        
-        qualities = self.run_multiprocessing(self.calc_quality_image, mp_args)
-        
-        return qualities
+            jobs.append((len(jobs), None, ref_path, i))
+
+        results = sorted(self.run_jobs(jobs), key=lambda r: r[0])
+        return [quality for idx, root, quality in results if quality is not None]
 
     def calc_quality_image(self, ref_path, rec_path):
         """
@@ -240,27 +509,153 @@ class ImageQuality(object):
         :param rec_path: path to recolored image
         :return: Dictionary. {"File": recolor.png, "Metric": value, ...}
         """
-        ref_img = cv2.cvtColor(cv2.imread(ref_path, 1), cv2.COLOR_BGR2RGB)
-        img = cv2.cvtColor(cv2.imread(rec_path, 1), cv2.COLOR_BGR2RGB)
-        result = {}
+        return self.calc_quality_images([(ref_path, rec_path)])[0]
 
+    def calc_quality_images(self, pairs):
+        """
+        Calculate quality measures for multiple images. LPIPS runs batched on the pairs with the same image size.
+        :param pairs: list of tuples (reference path, recolored path)
+        :return: list of dictionaries, see calc_quality_image
+        """
+        refs = {}
+        for ref_path, rec_path in pairs:
+            if ref_path not in refs:
+                refs[ref_path] = self.read_reference(ref_path)
+        images = [(refs[ref_path][0], self.read_image(rec_path)) for ref_path, rec_path in pairs]
+        results = [self.calc_metrics(ref_img, img, rec_path, refs[ref_path])
+                   for (ref_img, img), (ref_path, rec_path) in zip(images, pairs)]
         if self.lpips:
-            ref_tensor = lpips.im2tensor(lpips.load_image(ref_path))
-            rec_tensor = lpips.im2tensor(lpips.load_image(rec_path))
+            for result, lpips_val in zip(results, self.calc_lpips(images)):
+                result["LPIPS"] = lpips_val
+        for result, (ref_path, rec_path) in zip(results, pairs):
+            self.add_file_info(result, ref_path, rec_path)
+        return results
+
+    @staticmethod
+    def add_file_info(result, ref_path, rec_path):
+        """
+        Adds the columns Method and Extras (parsed from the recolored filename, empty if it can't be parsed)
+        and the name of the reference to a result of calc_metrics
+        """
+        parsed = ar_utils.parse_recolored_filename(rec_path)
+        result["Method"] = parsed[1] if parsed is not None else ""
+        result["Extras"] = "_".join(parsed[2]) if parsed is not None else ""
+        result["Reference"] = os.path.splitext(os.path.basename(ref_path))[0]
+
+    def read_pair(self, ref_path, rec_path):
+        """
+        :return: tuple (reference image, recolored image), both RGB
+        """
+        return self.read_reference(ref_path)[0], self.read_image(rec_path)
 
-            lpips_val = self.loss_fn.forward(ref_tensor, rec_tensor)
-            result["LPIPS"] = float(lpips_val)
+    def read_image(self, path):
+        """
+        :return: image RGB
+        """
+        img = cv2.imread(path, 1)
+        if img is None:
+            raise IOError("Can't read image: " + path)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def read_reference(self, ref_path):
+        """
+        Reference image from the reference cache, decoded if it isn't cached
+        :return: tuple (RGB image, Lab planes or None, quality_metrics.ReferenceStats or None), see ReferenceCache
+        """
+        if self.reference_cache is not None:
+            ref = self.reference_cache.get(ref_path)
+            if ref is not None:
+                return ref
+        return ReferenceCache.decode(self.read_image(ref_path), self.ab, self.get_stats_scales())
+
+    def get_stats_scales(self):
+        """
+        :return: scales of the reference statistics needed: 0: none, 1: PSNR, SSIM, 5: MS-SSIM
+        """
+        if self.engine != "numpy":
+            return 0
+        if self.msssim:
+            return len(quality_metrics.MS_SSIM_WEIGHTS)
+        return 1 if self.ssim or self.psnr else 0
+
+    def get_lpips_model(self):
+        """
+        LPIPS network, loaded on first use, once per process
+        """
+        if self.loss_fn is None:
+            if self.lpips_error is not None:
+                # don't try to load (download) it again for every image
+                raise self.lpips_error
+            import lpips
+            try:
+                # TODO: add spatial as parameter
+                self.loss_fn = lpips.LPIPS(net='alex', verbose=False)  # Can also set net = 'squeeze' or 'vgg' squeeze: more lightweight
+            except Exception as err:
+                self.lpips_error = err
+                raise
+        return self.loss_fn
+
+    def calc_lpips(self, images):
+        """
+        LPIPS of image pairs, pairs of the same size are stacked into batches of up to self.lpips_batch
+        :param images: list of tuples (reference image, recolored image), RGB as from read_pair
+        :return: list of LPIPS values
+        """
+        import torch
+        import lpips
+        loss_fn = self.get_lpips_model()
+        values = [None] * len(images)
+        by_shape = {}
+        for i, (ref_img, img) in enumerate(images):
+            by_shape.setdefault((ref_img.shape, img.shape), []).append(i)
+        for idxs in by_shape.values():
+            for start in range(0, len(idxs), self.lpips_batch):
+                batch = idxs[start:start + self.lpips_batch]
+                # same as lpips.im2tensor(lpips.load_image(path)), without reading the files again
+                ref_tensor = torch.cat([lpips.im2tensor(images[i][0]) for i in batch])
+                rec_tensor = torch.cat([lpips.im2tensor(images[i][1]) for i in batch])
+                with torch.no_grad():
+                    lpips_vals = loss_fn.forward(ref_tensor, rec_tensor)
+                for i, lpips_val in zip(batch, lpips_vals.flatten().tolist()):
+                    values[i] = lpips_val
+        return values
+
+    def calc_metrics(self, ref_img, img, rec_path, ref=None):
+        """
+        All quality measures except LPIPS, see calc_quality_images
+        :param ref_img: reference image RGB
+        :param img: recolored image RGB
+        :param ref: tuple of read_reference, None: computed from ref_img
+        :return: Dictionary. {"File": recolor.png, "Metric": value, ...}, LPIPS: None
+        """
+        if ref is None:
+            ref = ReferenceCache.decode(ref_img, self.ab, self.get_stats_scales())
+        if self.engine == "numpy":
+            return self.calc_metrics_numpy(ref, img, rec_path)
+
+        result = {}
+        if self.psnr:
+            ssim_sk, psnr_sk = skimage_metrics()
+        if self.msssim or self.ssim or self.vif:
+            from fast_qa import fast_qa
+
+        if self.lpips:
+            # first column, filled in by calc_lpips
+            result["LPIPS"] = None
 
         with concurrent.futures.ThreadPoolExecutor() as executor:
             
 
             # RGB
             if not self.ab:
+                # (channel, height, width), like the Lab planes. Before, ref_img[0], [1], [2] were the first 3 rows of
+                # the image, not R, G, B: RGB results of this engine changed and aren't comparable to older result files
+                ref_planes = np.ascontiguousarray(ref_img.transpose((2, 0, 1)))
+                planes = np.ascontiguousarray(img.transpose((2, 0, 1)))
                 if self.psnr:
-                    psnr = executor.submit(psnr_sk, ref_img, img)
-                    psnr_r = executor.submit(psnr_sk, ref_img[0], img[0])
-                    psnr_g = executor.submit(psnr_sk, ref_img[1], img[1])
-                    psnr_b = executor.submit(psnr_sk, ref_img[2], img[2])
+                    psnr_r = executor.submit(psnr_sk, ref_planes[0], planes[0])
+                    psnr_g = executor.submit(psnr_sk, ref_planes[1], planes[1])
+                    psnr_b = executor.submit(psnr_sk, ref_planes[2], planes[2])
 
                     psnr_r = psnr_r.result()
                     psnr_g = psnr_g.result()
@@ -270,15 +665,9 @@ class ImageQuality(object):
                     result["PSNR"] = psnr
 
                 if self.msssim:
-                    msssim = executor.submit(full_ref.msssim,
-                                                ref_img, img,
-                                                # default values
-                                                weights=[0.0448, 0.2856, 0.3001, 0.2363, 0.1333],
-                                                ws=11, K1=0.01, K2=0.03, MAX=None)
-                    
-                    msssim_r = executor.submit(ms_ssim, ref_img[0], img[0], max_val=255)
-                    msssim_g = executor.submit(ms_ssim, ref_img[1], img[1], max_val=255)
-                    msssim_b = executor.submit(ms_ssim, ref_img[2], img[2], max_val=255)
+                    msssim_r = executor.submit(fast_qa.ms_ssim, ref_planes[0], planes[0], max_val=255)
+                    msssim_g = executor.submit(fast_qa.ms_ssim, ref_planes[1], planes[1], max_val=255)
+                    msssim_b = executor.submit(fast_qa.ms_ssim, ref_planes[2], planes[2], max_val=255)
                     msssim_r = msssim_r.result()
                     msssim_g = msssim_g.result()
                     msssim_b = msssim_b.result()
@@ -287,9 +676,9 @@ class ImageQuality(object):
                     result["MS-SSIM"] = msssim
                     
                 if self.ssim:
-                    ssim_r = executor.submit(ssim, ref_img[0], img[0], max_val=255)
-                    ssim_g = executor.submit(ssim, ref_img[1], img[1], max_val=255)
-                    ssim_b = executor.submit(ssim, ref_img[2], img[2], max_val=255)
+                    ssim_r = executor.submit(fast_qa.ssim, ref_planes[0], planes[0], max_val=255)
+                    ssim_g = executor.submit(fast_qa.ssim, ref_planes[1], planes[1], max_val=255)
+                    ssim_b = executor.submit(fast_qa.ssim, ref_planes[2], planes[2], max_val=255)
                     ssim_r = ssim_r.result()
                     ssim_g = ssim_g.result()
                     ssim_b = ssim_b.result()
@@ -297,9 +686,9 @@ class ImageQuality(object):
                     result["SSIM"] = ssim_fast_qa
 
                 if self.vif:
-                    vif_spatial_r = executor.submit(vif_spatial, ref_img[0], img[0], max_val=255)
-                    vif_spatial_g = executor.submit(vif_spatial, ref_img[1], img[1], max_val=255)
-                    vif_spatial_b = executor.submit(vif_spatial, ref_img[2], img[2], max_val=255)
+                    vif_spatial_r = executor.submit(fast_qa.vif_spatial, ref_planes[0], planes[0], max_val=255)
+                    vif_spatial_g = executor.submit(fast_qa.vif_spatial, ref_planes[1], planes[1], max_val=255)
+                    vif_spatial_b = executor.submit(fast_qa.vif_spatial, ref_planes[2], planes[2], max_val=255)
                     vif_spatial_r = vif_spatial_r.result()
                     vif_spatial_g = vif_spatial_g.result()
                     vif_spatial_b = vif_spatial_b.result()
@@ -308,10 +697,8 @@ class ImageQuality(object):
 
             # ab only
             else:
-                img_lab = color.rgb2lab(img).transpose((2, 0, 1)) + 100
-                img_lab = img_lab.astype(int)
-                ref_img_lab = color.rgb2lab(ref_img).transpose((2, 0, 1)) + 100
-                ref_img_lab = ref_img_lab.astype(int)
+                img_lab = ReferenceCache.lab_planes(img)
+                ref_img_lab = ref[1]
 
                 
                 if self.psnr:
@@ -323,24 +710,24 @@ class ImageQuality(object):
                     result["PSNR"] = psnr
                     
                 if self.msssim:
-                    msssim_qa_a = executor.submit(ms_ssim, ref_img_lab[1], img_lab[1], max_val=200)
-                    msssim_qa_b = executor.submit(ms_ssim, ref_img_lab[2], img_lab[2], max_val=200)
+                    msssim_qa_a = executor.submit(fast_qa.ms_ssim, ref_img_lab[1], img_lab[1], max_val=200)
+                    msssim_qa_b = executor.submit(fast_qa.ms_ssim, ref_img_lab[2], img_lab[2], max_val=200)
                     msssim_qa_a = msssim_qa_a.result()
                     msssim_qa_b = msssim_qa_b.result()
                     msssim_fast_qa = np.mean([msssim_qa_a, msssim_qa_b])
                     result["MS-SSIM"] = msssim_fast_qa
 
                 if self.ssim:
-                    ssim_a = executor.submit(ssim, ref_img_lab[1], img_lab[1], max_val=200)
-                    ssim_b = executor.submit(ssim, ref_img_lab[2], img_lab[2], max_val=200)
+                    ssim_a = executor.submit(fast_qa.ssim, ref_img_lab[1], img_lab[1], max_val=200)
+                    ssim_b = executor.submit(fast_qa.ssim, ref_img_lab[2], img_lab[2], max_val=200)
                     ssim_a = ssim_a.result()
                     ssim_b = ssim_b.result()
                     ssim_fast_qa = np.mean([ssim_a, ssim_b])
                     result["SSIM"] = ssim_fast_qa
 
                 if self.vif:
-                    vif_spatial_a = executor.submit(vif_spatial, ref_img_lab[1], img_lab[1], max_val=200)
-                    vif_spatial_b = executor.submit(vif_spatial, ref_img_lab[2], img_lab[2], max_val=200)
+                    vif_spatial_a = executor.submit(fast_qa.vif_spatial, ref_img_lab[1], img_lab[1], max_val=200)
+                    vif_spatial_b = executor.submit(fast_qa.vif_spatial, ref_img_lab[2], img_lab[2], max_val=200)
                     vif_spatial_a = vif_spatial_a.result()
                     vif_spatial_b = vif_spatial_b.result()
                     vif = np.mean([vif_spatial_a, vif_spatial_b])
@@ -356,11 +743,45 @@ class ImageQuality(object):
         
         return result
 
-    def run_multiprocessing(self, func, args_tuple, n_processors=None):
-        if not n_processors:
-            n_processors = int( self.cpus // 3 )
-        with Pool(processes=n_processors) as pool:
-            return pool.starmap(func, args_tuple)
+    def calc_metrics_numpy(self, ref, img, rec_path):
+        """
+        calc_metrics of the numpy engine: PSNR, SSIM and MS-SSIM of the R, G, B or a, b planes in one vectorized
+        pass, with the precomputed statistics of the reference, see quality_metrics.ReferenceStats.compare
+        :param ref: tuple of read_reference
+        """
+        ref_img, ref_img_lab, ref_stats = ref
+        result = {}
+        if self.lpips:
+            # first column, filled in by calc_lpips
+            result["LPIPS"] = None
+
+        if not self.ab:
+            ref_planes = ref_img.transpose((2, 0, 1))
+            planes = img.transpose((2, 0, 1))
+            max_val = 255
+        else:
+            ref_planes = ref_img_lab[1:3]
+            planes = ReferenceCache.lab_planes(img)[1:3]
+            max_val = 200
+
+        if ref_stats is not None:
+            values = ref_stats.compare(planes, psnr=self.psnr, ssim=self.ssim, ms_ssim=self.msssim)
+            for metric in ("PSNR", "MS-SSIM", "SSIM"):
+                if metric in values:
+                    result[metric] = np.mean(values[metric])
+        if self.vif:
+            from fast_qa import fast_qa
+            result["VIF-SPATIAL"] = np.mean([fast_qa.vif_spatial(ref_plane, plane, max_val=max_val)
+                                             for ref_plane, plane in zip(ref_planes, planes)])
+        result["File"] = rec_path
+        return result
+
+    def __getstate__(self):
+        # workers load their own LPIPS network, see init_worker
+        state = dict(self.__dict__)
+        state["loss_fn"] = None
+        state["lpips_error"] = None
+        return state
 
     def write_quality(self, qualities, ref_names, out_file):
         if not qualities:
@@ -368,73 +789,82 @@ class ImageQuality(object):
             return
 
         format_string = "%." + str(self.truncate) + "f"
-        with open(out_file, "w") as f:
-            f.write("* Image Quality of ")
-            if self.ab:
-                f.write("Color Channels\n")
-            else:
-                f.write("Color + Luminance\n")
-
+        # whole file is collected first and written at once
+        lines = ["* Image Quality of "]
+        if self.ab:
+            lines.append("Color Channels\n")
+        else:
+            lines.append("Color + Luminance\n")
 
         # To iterate over number of quality metrics later
-        qual_count = None
-        
+        qual_count = [qn for qn in qualities[0].keys() if qn not in ("File", "Reference")]
+        # reference name -> qualities, in their order
+        by_ref = {}
+        for qual in qualities:
+            if "Reference" in qual:
+                by_ref.setdefault(qual["Reference"], []).append(qual)
+
         written_tbl_head = False
         for ref_name in ref_names:
             if not self.no_header_name:
                 written_tbl_head = False
-            for qual in qualities:
+            if "Reference" in qualities[0]:
+                ref_qualities = by_ref.get(ref_name, [])
+            else:
+                ref_qualities = [qual for qual in qualities if ref_name in qual["File"]]
+            for qual in ref_qualities:
                 # qual: dict
-                qual_names = list(qual.keys())
-                qual_names.remove("File")
-                if qual_count is None:
-                    qual_count = qual_names
-                if not ref_name in qual["File"]:
-                    continue
+                qual_names = [qn for qn in qual.keys() if qn not in ("File", "Reference")]
                 if not written_tbl_head:
-                    with open(out_file, "a") as f:
-                        written_tbl_head = True
-                        f.write("\n")
-                        if not self.no_header_name:
-                            f.write("** " + ref_name + "\n")
-                        # write table head
-                        f.write("| Image Name | ")
-                        for qn in qual_names:
-                            f.write(qn + " | ")
-                        f.write("\n")
-                        # write table delimiter
-                        f.write("|------------")
-                        for qn in qual_names:
-                            f.write(" +----------- ")
-                        f.write("|\n")
-                        
-                with open(out_file, "a") as f:
-                    f.write("| " + os.path.basename(qual["File"]) + " | " )
-                    # TODO: maybe handle float nan
+                    written_tbl_head = True
+                    lines.append("\n")
+                    if not self.no_header_name:
+                        lines.append("** " + ref_name + "\n")
+                    # write table head
+                    lines.append("| Image Name | ")
+                    for qn in qual_names:
+                        lines.append(qn + " | ")
+                    lines.append("\n")
+                    # write table delimiter
+                    lines.append("|------------")
                     for qn in qual_names:
-                        f.write(format_string%(qual[qn]) + "| ")
-                    f.write("\n")
+                        lines.append(" +----------- ")
+                    lines.append("|\n")
+
+                lines.append("| " + os.path.basename(qual["File"]) + " | " )
+                # TODO: maybe handle float nan
+                for qn in qual_names:
+                    if isinstance(qual[qn], str):
+                        lines.append(qual[qn] + "| ")
+                    else:
+                        lines.append(format_string%(qual[qn]) + "| ")
+                lines.append("\n")
 
         # write last row for mean and formula, if everything is in one table
         if self.no_header_name and qual_count:
             mean_formula = "@>${col}=vmean(@{col}..@>>)"
-            with open(out_file, "a") as f:
-                # write table delimiter
-                f.write("|------------")
-                for qn in qual_count:
-                    f.write(" +----------- ")
-                f.write("|\n")
-                # Write row for Mean
-                f.write("| Mean | ")
-                for qn in qual_count:
-                    f.write(" | ")
-                f.write("\n")
-                # write formula
-                f.write("#+TBLFM: ")
-                first_column = 2
-                for i, qn in enumerate(qual_count):
-                    f.write(mean_formula.format(col=first_column+i))
-                    f.write("::")
+            # write table delimiter
+            lines.append("|------------")
+            for qn in qual_count:
+                lines.append(" +----------- ")
+            lines.append("|\n")
+            # Write row for Mean
+            lines.append("| Mean | ")
+            for qn in qual_count:
+                lines.append(" | ")
+            lines.append("\n")
+            # write formula
+            lines.append("#+TBLFM: ")
+            first_column = 2
+            for i, qn in enumerate(qual_count):
+                # no mean of text columns (Method, Extras)
+                if isinstance(qualities[0][qn], str):
+                    continue
+                lines.append(mean_formula.format(col=first_column+i))
+                lines.append("::")
+
+        with open(out_file, "w") as f:
+            f.write("".join(lines))
 
         if self.format_org:
             os.system("emacs --batch " + out_file + 
@@ -446,21 +876,6 @@ class ImageQuality(object):
                 os.remove(out_file + "~")
         print("Wrote: ", out_file)
     
-    def find_files(self, search_string, path, recursive=False):
-        """
-        Returns an array with all full file paths to files containing 'search_string' in 'path'.
-        """
-        result = []
-        for root, dirs, files in os.walk(path):
-            for fil in files:
-                if search_string in fil and fil not in result:
-                    result.append(os.path.abspath(os.path.join(root, fil)))
-            # First dir is path itself, so break if no subdirs should be searched
-            if not recursive:
-                break
-
-        return result
-
     def get_ref_paths_names(self):
         """Returns an array with all reference images and a second array with all of their filenames (wo extension)"""
         # iterate through reference folder to get all ref image paths
@@ -483,6 +898,174 @@ class ImageQuality(object):
         return (ref_paths, ref_names)
 
 
+class ReferenceCache(object):
+    """
+    Reference images, decoded once into .npy files in a temporary folder. Workers memory map them, so all processes
+    share the same pages, instead of decoding the reference again for every recolored image.
+    Also holds the Lab planes (with --ab) and the SSIM statistics of the numpy engine (quality_metrics.ReferenceStats).
+    """
+
+    def __init__(self, path, ab=False, stats_scales=0, max_open=8):
+        """
+        :param path: cache folder, deleted by close()
+        :param stats_scales: scales of the SSIM statistics, 0: none
+        :param max_open: references kept open per process
+        """
+        self.path = path
+        self.ab = ab
+        self.stats_scales = stats_scales
+        self.max_open = max_open
+        # ref path -> tuple of decode, memory mapped
+        self._open = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_open"] = {}
+        return state
+
+    def folder(self, ref_path):
+        return os.path.join(self.path, hashlib.sha1(os.path.abspath(ref_path).encode("utf-8")).hexdigest())
+
+    def add(self, ref_path):
+        """
+        Decodes ref_path into the cache, if it isn't cached yet
+        :return: True, if the reference is cached
+        """
+        folder = self.folder(ref_path)
+        if os.path.isdir(folder):
+            return True
+        img = cv2.imread(ref_path, 1)
+        if img is None:
+            return False
+        ref_img, ref_img_lab, ref_stats = self.decode(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), self.ab, self.stats_scales)
+        # written into a temporary folder and renamed, so readers never see a partial reference
+        tmp_folder = tempfile.mkdtemp(dir=self.path)
+        np.save(os.path.join(tmp_folder, "rgb.npy"), ref_img)
+        if ref_img_lab is not None:
+            np.save(os.path.join(tmp_folder, "lab.npy"), ref_img_lab)
+        if ref_stats is not None:
+            ref_stats.save(os.path.join(tmp_folder, "stats"))
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # added by another process meanwhile
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        return True
+
+    def get(self, ref_path):
+        """
+        :return: tuple (RGB image, Lab planes or None, ReferenceStats or None), None if not cached
+        """
+        ref = self._open.get(ref_path)
+        if ref is not None:
+            return ref
+        folder = self.folder(ref_path)
+        if not os.path.isdir(folder):
+            return None
+        # copy on write: writable arrays for libraries, which don't take read only buffers, pages still shared
+        ref_img = np.load(os.path.join(folder, "rgb.npy"), mmap_mode="c")
+        ref_img_lab = np.load(os.path.join(folder, "lab.npy"), mmap_mode="c") if self.ab else None
+        ref_stats = None
+        if self.stats_scales:
+            ref_stats = quality_metrics.ReferenceStats.load(os.path.join(folder, "stats"), mmap_mode="c")
+        if len(self._open) >= self.max_open:
+            del self._open[next(iter(self._open))]
+        ref = self._open[ref_path] = (ref_img, ref_img_lab, ref_stats)
+        return ref
+
+    def close(self):
+        self._open = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    @staticmethod
+    def decode(ref_img, ab=False, stats_scales=0):
+        """
+        :param ref_img: reference image RGB
+        :param stats_scales: scales of the SSIM statistics, 0: none
+        :return: tuple (RGB image, Lab planes or None, ReferenceStats or None)
+            Statistics of the R, G, B planes, or the a, b planes with ab
+        """
+        ref_img_lab = ReferenceCache.lab_planes(ref_img) if ab else None
+        ref_stats = None
+        if stats_scales:
+            if ab:
+                planes, max_val = ref_img_lab[1:3], 200
+            else:
+                planes, max_val = ref_img.transpose((2, 0, 1)), 255
+            scales = min(stats_scales, quality_metrics.ms_ssim_scales(ref_img.shape))
+            ref_stats = quality_metrics.ReferenceStats.from_planes(planes, max_val, scales)
+        return ref_img, ref_img_lab, ref_stats
+
+    @staticmethod
+    def lab_planes(img):
+        """
+        :param img: image RGB
+        :return: Lab planes (3, height, width), shifted by 100 and rounded down to int
+        """
+        from skimage import color
+        img_lab = color.rgb2lab(img).transpose((2, 0, 1)) + 100
+        return img_lab.astype(int)
+
+
+# ImageQuality of a worker process, see init_worker
+_worker_quality = None
+
+
+def init_worker(image_quality):
+    """
+    Initializer for worker processes: gets the ImageQuality with all settings once, instead of with every job.
+    Loads the LPIPS network once per worker, it is not sent from the parent process.
+    """
+    global _worker_quality
+    _worker_quality = image_quality
+    if image_quality.lpips:
+        import torch
+        # workers share the cpus
+        torch.set_num_threads(max(1, image_quality.cpus // image_quality.jobs))
+        try:
+            image_quality.get_lpips_model()
+        except Exception as err:
+            # an exception here would make the pool restart the worker forever, the jobs report it instead
+            print("Error loading LPIPS: " + str(err))
+
+
+def cache_reference(ref_path):
+    """
+    Decodes a reference image into the ReferenceCache in a worker process
+    :return: True, if cached. Errors are reported by the jobs of the reference.
+    """
+    try:
+        return _worker_quality.reference_cache.add(ref_path)
+    except Exception:
+        return False
+
+
+def calc_quality_chunk(jobs):
+    """
+    Calculates the quality of a chunk of jobs from ImageQuality.get_jobs in a worker process.
+    On errors, the jobs are calculated one by one, to only skip the failing images.
+    :return: list of tuples (index, folder, quality dict or None on error)
+    """
+    try:
+        qualities = _worker_quality.calc_quality_images([(ref_path, rec_path) for idx, root, ref_path, rec_path in jobs])
+    except Exception:
+        return [calc_quality_job(job) for job in jobs]
+    return [(idx, root, quality) for (idx, root, ref_path, rec_path), quality in zip(jobs, qualities)]
+
+
+def calc_quality_job(job):
+    """
+    Calculates the quality of one job from ImageQuality.get_jobs in a worker process. Errors only skip the image.
+    :return: tuple (index, folder, quality dict or None on error)
+    """
+    idx, root, ref_path, rec_path = job
+    try:
+        return idx, root, _worker_quality.calc_quality_image(ref_path, rec_path)
+    except Exception as err:
+        print("Error comparing " + rec_path + " with " + ref_path + ": " + str(err))
+        return idx, root, None
+
+
 if __name__ == "__main__":
     iq = ImageQuality()
     iq.main()
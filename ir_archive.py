@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Packs the files of the intermediate representation (gray images, .mask and .glob_dist sidecars) into a few
+big shard files, instead of millions of small files. Every shard has an index file next to it.
+
+python ir_archive.py list archive_folder
+python ir_archive.py extract archive_folder -o intermediate_representation
+python ir_archive.py pack intermediate_representation -o archive_folder
+"""
+
+import os, sys
+import argparse
+import mmap
+import time
+
+
+SHARD_EXT = ".irs"
+INDEX_EXT = ".idx"
+
+
+class IRArchive(object):
+    """
+    Folder of shards. Files are appended to the shard of this writer, a line "name offset length" in its index
+    file makes them visible. Every writer (process) appends to its own shards, so parallel encoders don't conflict.
+    Readers load all index files into a dict (name -> shard, offset, length) and memory map the shards.
+    A name written again replaces the older one.
+    """
+
+    def __init__(self, path, mode="r", max_shard_size=1 << 30):
+        """
+        :param path: archive folder
+        :param mode: "r": read only, "a": read and append
+        :param max_shard_size: start a new shard, when the current one gets bigger, Bytes
+        """
+        if mode not in ("r", "a"):
+            raise ValueError("mode has to be 'r' or 'a'")
+        self.path = path
+        self.mode = mode
+        self.max_shard_size = max_shard_size
+        # name -> (shard path, offset, length)
+        self.index = {}
+        # shard path -> mmap
+        self._maps = {}
+        self._shard = None
+        self._shard_index = None
+        self._shard_count = 0
+        if mode == "a":
+            os.makedirs(path, exist_ok=True)
+        elif not os.path.isdir(path):
+            raise FileNotFoundError("Archive not found: " + path)
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return sorted(self.index.keys())
+
+    def refresh(self):
+        """
+        Reloads the index files, to see files written by other processes
+        """
+        index = {}
+        # shard names start with their creation time -> newer entries win
+        for fil in sorted(os.scandir(self.path), key=lambda f: f.name):
+            if not fil.name.endswith(INDEX_EXT):
+                continue
+            shard_path = fil.path[:-len(INDEX_EXT)] + SHARD_EXT
+            with open(fil.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").rsplit("\t", 2)
+                    # incomplete last line of a crashed writer
+                    if len(parts) != 3:
+                        continue
+                    index[parts[0]] = (shard_path, int(parts[1]), int(parts[2]))
+        self.index = index
+
+    def read(self, name):
+        """
+        :return: content of file name, memoryview into the memory mapped shard
+        """
+        shard_path, offset, length = self.index[name]
+        mm = self._maps.get(shard_path)
+        if mm is None or len(mm) < offset + length:
+            if mm is not None:
+                try:
+                    mm.close()
+                except BufferError:
+                    pass
+            with open(shard_path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard_path] = mm
+        return memoryview(mm)[offset:offset + length]
+
+    def get(self, name, default=None):
+        return self.read(name) if name in self.index else default
+
+    def write(self, name, data):
+        """
+        Appends file name with content data (bytes) to the shard of this writer
+        """
+        if self.mode != "a":
+            raise IOError("Archive opened read only: " + self.path)
+        if "\t" in name or "\n" in name:
+            raise ValueError("Name must not contain tabs or newlines: " + repr(name))
+        if self._shard is None or self._shard.tell() + len(data) > self.max_shard_size:
+            self._new_shard()
+        offset = self._shard.tell()
+        self._shard.write(data)
+        # data first, so the index never points to missing data
+        self._shard.flush()
+        self._shard_index.write("%s\t%d\t%d\n" % (name, offset, len(data)))
+        self._shard_index.flush()
+        self.index[name] = (self._shard.name, offset, len(data))
+
+    def write_files(self, files):
+        """
+        :param files: dict name -> bytes
+        """
+        for name, data in files.items():
+            self.write(name, data)
+
+    def extract(self, out_path, names=None):
+        """
+        Writes files of the archive into folder out_path
+        :param names: list of names, None: all
+        :return: number of extracted files
+        """
+        names = self.names() if names is None else names
+        for name in names:
+            # names come from the index files, don't write outside of out_path
+            if os.path.isabs(name) or ".." in name.replace("\\", "/").split("/"):
+                raise ValueError("Unsafe name in archive: " + repr(name))
+        os.makedirs(out_path, exist_ok=True)
+        for name in names:
+            with open(os.path.join(out_path, name), "wb") as f:
+                f.write(self.read(name))
+        return len(names)
+
+    def close(self):
+        for mm in self._maps.values():
+            try:
+                mm.close()
+            except BufferError:
+                # still used by a memoryview, freed with it
+                pass
+        self._maps = {}
+        if self._shard is not None:
+            self._shard.close()
+            self._shard_index.close()
+            self._shard = None
+            self._shard_index = None
+
+    def _new_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard_index.close()
+        name = "shard-%s-%d-%03d" % (time.strftime("%Y%m%d%H%M%S"), os.getpid(), self._shard_count)
+        self._shard_count += 1
+        self._shard = open(os.path.join(self.path, name + SHARD_EXT), "ab")
+        self._shard_index = open(os.path.join(self.path, name + INDEX_EXT), "a", encoding="utf-8")
+
+
+def is_archive(path):
+    """
+    True, if folder path contains shard index files
+    """
+    return os.path.isdir(path) and any(fil.name.endswith(INDEX_EXT) for fil in os.scandir(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="IR Archive", description="List, extract and pack intermediate representation archives")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    p = subparsers.add_parser("list", help="list files in archive")
+    p.add_argument("archive", type=str, help="archive folder")
+
+    p = subparsers.add_parser("extract", help="extract files of archive into a folder")
+    p.add_argument("archive", type=str, help="archive folder")
+    p.add_argument("names", type=str, nargs="*", help="files to extract, default: all")
+    p.add_argument("-o", "--output_path", action="store", dest="output_path", type=str,
+                   default="intermediate_representation")
+
+    p = subparsers.add_parser("pack", help="append all files of a folder to an archive")
+    p.add_argument("input_path", type=str, help="folder, e.g. intermediate_representation")
+    p.add_argument("-o", "--output_path", action="store", dest="output_path", type=str, default="ir_archive",
+                   help="archive folder")
+
+    args = parser.parse_args()
+    if args.command == "list":
+        with IRArchive(args.archive) as archive:
+            for name in archive.names():
+                shard_path, offset, length = archive.index[name]
+                print("%s\t%d\t%s" % (name, length, os.path.basename(shard_path)))
+            print("%d files" % len(archive), file=sys.stderr)
+    elif args.command == "extract":
+        with IRArchive(args.archive) as archive:
+            missing = [name for name in args.names if name not in archive]
+            if missing:
+                print("Not in archive: " + ", ".join(missing))
+                sys.exit(1)
+            count = archive.extract(args.output_path, args.names or None)
+            print("Extracted %d files to %s" % (count, args.output_path))
+    elif args.command == "pack":
+        with IRArchive(args.output_path, mode="a") as archive:
+            count = 0
+            for fil in sorted(os.scandir(args.input_path), key=lambda f: f.name):
+                if not fil.is_file():
+                    continue
+                with open(fil.path, "rb") as f:
+                    archive.write(fil.name, f.read())
+                count += 1
+            print("Packed %d files into %s" % (count, args.output_path))
+
+
+if __name__ == "__main__":
+    main()
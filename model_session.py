@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Keeps loaded colorization networks alive between decodes, so the weights are only loaded once per process.
+"""
+
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+
+class ModelSession(object):
+    """
+    Cache of prepared colorization models, keyed on (backend, Xd size, checkpoint path, gpu_id).
+    Also keeps track of the time spent loading models and the time spent running them.
+    Models hold the state of the last loaded image, so a session should only be used by one decoder at a time.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.load_times = {}
+        self.load_time = 0.0
+        self.inference_time = 0.0
+        self.loads = 0
+        self.inferences = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(backend, size, checkpoint, gpu_id):
+        checkpoint = os.path.abspath(checkpoint) if checkpoint else None
+        return (backend, size, checkpoint, gpu_id)
+
+    def get(self, backend, size, checkpoint, gpu_id, loader):
+        """
+        Returns the cached model for this key, or creates it by calling loader() and caches it.
+        :param loader: function without arguments, which returns the prepared model
+        """
+        key = self.key(backend, size, checkpoint, gpu_id)
+        with self._lock:
+            model = self.models.get(key)
+            if model is None:
+                start = time.perf_counter()
+                model = loader()
+                elapsed = time.perf_counter() - start
+                self.load_times[key] = elapsed
+                self.load_time += elapsed
+                self.loads += 1
+                self.models[key] = model
+        return model
+
+    @contextmanager
+    def inference(self):
+        """
+        Context manager to time everything, that is not model loading.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inference_time += time.perf_counter() - start
+            self.inferences += 1
+
+    def evict(self, backend=None, size=None, checkpoint=None, gpu_id=None):
+        """
+        Removes all cached models matching the given values. None matches everything.
+        :return: number of evicted models
+        """
+        if checkpoint:
+            checkpoint = os.path.abspath(checkpoint)
+        evicted = 0
+        with self._lock:
+            for key in list(self.models.keys()):
+                if backend is not None and key[0] != backend:
+                    continue
+                if size is not None and key[1] != size:
+                    continue
+                if checkpoint is not None and key[2] != checkpoint:
+                    continue
+                if gpu_id is not None and key[3] != gpu_id:
+                    continue
+                del self.models[key]
+                evicted += 1
+        if evicted:
+            self._free_gpu_memory()
+        return evicted
+
+    def close(self):
+        """
+        Evicts all models.
+        """
+        return self.evict()
+
+    def _free_gpu_memory(self):
+        # only if torch was already imported by a model, don't import it just for this
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self) -> dict:
+        return {
+            "models": len(self.models),
+            "loads": self.loads,
+            "load_time": self.load_time,
+            "inferences": self.inferences,
+            "inference_time": self.inference_time,
+        }
+
+    def report(self):
+        print("Model loading: %d model(s) in %.3fs, inference: %d image(s) in %.3fs"
+              % (self.loads, self.load_time, self.inferences, self.inference_time))
+
+
+# shared by all Decoders of this process, unless they get their own session
+default_session = ModelSession()
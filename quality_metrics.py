@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+PSNR, SSIM and MS-SSIM of all channels of an image in one vectorized pass, with precomputed statistics of the
+reference image. When many recolored versions are compared to the same reference, the Gaussian filtered mean and
+variance of the reference (on every scale of MS-SSIM) are computed once, only the recolored image and its product
+with the reference are filtered for each version. SSIM and MS-SSIM share the filter responses of the first scale.
+
+SSIM as Wang et al. 2004 (11x11 Gaussian window, sigma 1.5, K1=0.01, K2=0.03), the same values as
+skimage.metrics.structural_similarity(gaussian_weights=True, sigma=1.5, use_sample_covariance=False) per channel.
+MS-SSIM as Wang et al. 2003, with 2x2 average downsampling between the scales.
+"""
+
+import os
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+K1 = 0.01
+K2 = 0.03
+SIGMA = 1.5
+# 11 tap filter with sigma 1.5
+TRUNCATE = 3.5
+WIN_SIZE = 2 * int(TRUNCATE * SIGMA + 0.5) + 1
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+
+def gaussian(planes):
+    """
+    :param planes: array (channels, height, width), every plane filtered on its own
+    """
+    return gaussian_filter(planes, (0, SIGMA, SIGMA), truncate=TRUNCATE, mode="reflect")
+
+
+def downsample(planes):
+    """
+    2x2 average of every plane, odd last row/column is dropped
+    """
+    h, w = planes.shape[1] // 2 * 2, planes.shape[2] // 2 * 2
+    planes = planes[:, :h, :w]
+    return (planes[:, 0::2, 0::2] + planes[:, 1::2, 0::2] + planes[:, 0::2, 1::2] + planes[:, 1::2, 1::2]) / 4
+
+
+def ms_ssim_scales(shape, max_scales=len(MS_SSIM_WEIGHTS)):
+    """
+    Number of MS-SSIM scales, whose smallest image is still bigger than the window
+    :param shape: (height, width, ...) of the image
+    """
+    scales = 1
+    size = min(shape[:2])
+    while scales < max_scales and size // 2 >= WIN_SIZE:
+        size //= 2
+        scales += 1
+    return scales
+
+
+class ReferenceStats(object):
+    """
+    Reference image planes (channels, height, width), their Gaussian filtered mean and variance on each scale.
+    Arrays can be saved and memory mapped, to be shared by processes.
+    """
+
+    def __init__(self, planes, means, variances, max_val):
+        """
+        :param planes: list of the planes on each scale, float64
+        :param means: list of the filtered means on each scale
+        :param variances: list of the filtered variances on each scale
+        :param max_val: data range, e.g. 255
+        """
+        self.planes = planes
+        self.means = means
+        self.variances = variances
+        self.max_val = max_val
+
+    @property
+    def scales(self):
+        return len(self.planes)
+
+    @classmethod
+    def from_planes(cls, planes, max_val=255, scales=1):
+        """
+        :param planes: reference image planes (channels, height, width), e.g. R, G, B or a, b
+        :param scales: 1: PSNR and SSIM only, see ms_ssim_scales
+        """
+        all_planes, means, variances = [], [], []
+        x = np.asarray(planes, dtype=np.float64)
+        for scale in range(scales):
+            if scale:
+                x = downsample(x)
+            mu, xx = np.split(gaussian(np.concatenate([x, x * x])), 2)
+            all_planes.append(x)
+            means.append(mu)
+            variances.append(xx - mu * mu)
+        return cls(all_planes, means, variances, max_val)
+
+    def save(self, path):
+        """
+        :param path: folder, created if it doesn't exist
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "max_val.npy"), np.array(self.max_val))
+        for scale in range(self.scales):
+            np.save(os.path.join(path, "plane_%d.npy" % scale), self.planes[scale])
+            np.save(os.path.join(path, "mean_%d.npy" % scale), self.means[scale])
+            np.save(os.path.join(path, "variance_%d.npy" % scale), self.variances[scale])
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param mmap_mode: see np.load, "r": memory mapped, read only
+        """
+        planes, means, variances = [], [], []
+        scale = 0
+        while os.path.isfile(os.path.join(path, "plane_%d.npy" % scale)):
+            planes.append(np.load(os.path.join(path, "plane_%d.npy" % scale), mmap_mode=mmap_mode))
+            means.append(np.load(os.path.join(path, "mean_%d.npy" % scale), mmap_mode=mmap_mode))
+            variances.append(np.load(os.path.join(path, "variance_%d.npy" % scale), mmap_mode=mmap_mode))
+            scale += 1
+        max_val = np.load(os.path.join(path, "max_val.npy")).item()
+        return cls(planes, means, variances, max_val)
+
+    def compare(self, planes, psnr=False, ssim=False, ms_ssim=False):
+        """
+        All requested metrics of all channels in one pass. Per scale, the mean and variance of the compared planes
+        and their product with the reference are filtered in one call, for all channels at once.
+        :param planes: planes of the compared image (channels, height, width), same shape as the reference
+        :return: dict "PSNR", "SSIM", "MS-SSIM" -> array of the values per channel, for the requested metrics.
+            MS-SSIM with the weights of Wang et al., normalized to the number of scales, negative values clipped to 0
+        """
+        if np.shape(planes) != self.planes[0].shape:
+            raise ValueError("Image shape %s doesn't match reference %s" % (np.shape(planes), self.planes[0].shape))
+        c1 = (K1 * self.max_val) ** 2
+        c2 = (K2 * self.max_val) ** 2
+        pad = (WIN_SIZE - 1) // 2
+        crop = (slice(None), slice(pad, -pad), slice(pad, -pad))
+        y = np.asarray(planes, dtype=np.float64)
+        results = {}
+        if psnr:
+            mse = np.mean((self.planes[0] - y) ** 2, axis=(1, 2), dtype=np.float64)
+            with np.errstate(divide="ignore"):
+                results["PSNR"] = 10 * np.log10(self.max_val ** 2 / mse)
+        if not ssim and not ms_ssim:
+            return results
+
+        scales = self.scales if ms_ssim else 1
+        values = []
+        for scale in range(scales):
+            if scale:
+                y = downsample(y)
+            x, mu_x, var_x = self.planes[scale], self.means[scale], self.variances[scale]
+            mu_y, yy, xy = np.split(gaussian(np.concatenate([y, y * y, x * y])), 3)
+            var_y = yy - mu_y * mu_y
+            cov = xy - mu_x * mu_y
+            contrast_structure = ((2 * cov + c2) / (var_x + var_y + c2))[crop]
+            if scale == 0 or scale == scales - 1:
+                # luminance is only needed for SSIM and the last scale of MS-SSIM
+                luminance = ((2 * mu_x * mu_y + c1) / (mu_x * mu_x + mu_y * mu_y + c1))[crop]
+                ssim_map = luminance * contrast_structure
+                if scale == 0 and ssim:
+                    results["SSIM"] = ssim_map.mean(axis=(1, 2), dtype=np.float64)
+            if ms_ssim:
+                if scale == scales - 1:
+                    values.append(ssim_map.mean(axis=(1, 2), dtype=np.float64))
+                else:
+                    values.append(contrast_structure.mean(axis=(1, 2), dtype=np.float64))
+        if ms_ssim:
+            weights = np.array(MS_SSIM_WEIGHTS[:scales])
+            weights /= weights.sum()
+            results["MS-SSIM"] = np.prod(np.maximum(np.array(values), 0) ** weights[:, np.newaxis], axis=0)
+        return results
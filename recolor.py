@@ -1,20 +1,26 @@
 #!/usr/bin/env python3
 
+import time
+# startup cost of the imports below, shown by run_batch
+_import_start = time.perf_counter()
 import argparse
-import importlib
-from PIL import Image
 import os, sys
-import ar_utils, encoder, decoder
+import glob
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+import cv2
+import ar_utils, encoder, decoder, model_session, watch
 
-# -'s in import not allowed
+# colorize_image of interactive-deep-colorization is imported by the Decoder, when it creates a model
 # ideepcolor = importlib.import_module("interactive-deep-colorization")
-CI = importlib.import_module("interactive-deep-colorization.data.colorize_image")
 # CICIT = importlib.import_module("interactive-deep-colorization.data.colorize_image.ColorizeImageTorch")
 # ideepcolor_pytorch = importlib.import_module("colorization-pytorch")
 
 sys.path.insert(1, os.path.abspath("interactive-deep-colorization"))
+import_time = time.perf_counter() - _import_start
 
-# TODO: add full auto mode: watch folder for new images
 # TODO: add config file parser. Encoder, Decoder etc.
 # TODO: Encoder, Decoder
 class Recolor(object):
@@ -30,12 +36,14 @@ class Recolor(object):
         # Whether to open an extra window with the output
         self.show_plot = False
         self.ir_folder = None
+        # keeps the decoder models loaded between images
+        self.session = model_session.default_session
 
         # lower CPU priority (to not freeze PC)
         # os.nice(19)
 
 
-    def main(self):
+    def get_parser(self):
         parser = argparse.ArgumentParser(prog='Recolor', description='TODO')
 
         parser.add_argument('-o', '--output_path', action='store', dest='output_path', type=str,
@@ -58,7 +66,11 @@ class Recolor(object):
         parser.add_argument('-s', '--size', action='store', dest='size', type=int, default=256,
                                help='Size of the indermediate mask to store the color pixels. Power of 2. \
                                The bigger, the more accurate the result, but requires more storage, and RAM capacity (decoder) \
-                               (For 2048 up to 21GB RAM)')
+                               (For 2048 up to 21GB RAM, unless decoded with --tile_size)')
+        parser.add_argument('--tile_size', action='store', dest='tile_size', type=int, default=0,
+                            help='ideepcolor-px: decode bigger masks in overlapping tiles of this size, e.g. 256. Default: 0, off')
+        parser.add_argument('--tile_overlap', action='store', dest='tile_overlap', type=int, default=32,
+                            help='Overlap of neighbouring tiles, blended linearly. Default: 32')
         parser.add_argument('-g', '--grid_size', action='store', dest='grid_size', type=int, default=10,
                                help='Spacing between color pixels in intermediate mask (--size).  -1: fill every spot in mask.  0: dont use any color pixel ')
         parser.add_argument('-p', '--p', action='store', dest='p', type=int, default=0,
@@ -73,12 +85,48 @@ class Recolor(object):
         parser.add_argument('--cpu_mode', dest='cpu_mode', help='do not use gpu', action='store_true')
         # parser.add_argument('--pytorch_maskcent', dest='pytorch_maskcent', help='need to center mask (activate for siggraph_pretrained but not for converted caffemodel)', action='store_true')
         parser.add_argument('--delete_gray', dest='delete_gray', help='Delete generated grayscale image after colorization', action='store_true')
+        parser.add_argument('--write_ir', dest='write_ir', action='store_true', default=None,
+                            help='Write the intermediate representation to disk. Default: on, off with --delete_gray')
+        parser.add_argument('--no_write_ir', dest='write_ir', action='store_false',
+                            help='Pass the intermediate representation from encoder to decoder in memory only')
+        parser.add_argument('--archive', dest='archive', action='store', type=str, default=None,
+                            help='Write the intermediate representation into this archive folder (see ir_archive.py), instead of single files')
+        parser.add_argument('--mask_format', dest='mask_format', action='store', type=int, default=1, choices=[1, 2],
+                            help='Version of the .mask format. 2: bit packed, smaller. Default: 1')
+        parser.add_argument('--ab_step', dest='ab_step', action='store', type=int, default=1,
+                            help='Mask format 2: precision of the saved a/b values, 1: lossless, 2: round to 2, ... Default: 1')
+        parser.add_argument('--compression', dest='compression', action='store', type=str, default=None,
+                            choices=["zlib", "zstd"], help='Mask format 2: compress .mask files. zstd needs zstandard')
+        parser.add_argument('--glob_dist_format', dest='glob_dist_format', action='store', type=int, default=1,
+                            choices=[1, 2], help='Version of the .glob_dist format. 2: 1 Byte index, smaller values. Default: 1')
+        parser.add_argument('--glob_dist_dtype', dest='glob_dist_dtype', action='store', type=str, default="float16",
+                            choices=ar_utils.glob_dist_dtypes, help='glob_dist format 2: type of the values. Default: float16')
+        parser.add_argument('-w', '--watch', dest='watch', action='store_true',
+                            help='Keep running and recolor new images in input folder as they arrive')
+        parser.add_argument('--journal', dest='journal', action='store', type=str, default=None,
+                            help='Watch: file to record recolored images in, to skip them after a restart. Default: in output_path')
+        parser.add_argument('--settle_time', dest='settle_time', action='store', type=float, default=1.0,
+                            help='Watch: seconds a new file has to stay unchanged, before it counts as completely written')
+        parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                            help='For folders: read, encode and decode images at the same time in separate stages')
+        parser.add_argument('-j', '--jobs', dest='jobs', action='store', type=int, default=os.cpu_count(),
+                            help='Pipeline: number of encoder processes. Default: number of CPUs')
+        parser.add_argument('--readers', dest='readers', action='store', type=int, default=2,
+                            help='Pipeline: number of threads reading images. Default: 2')
+        parser.add_argument('--queue_depth', dest='queue_depth', action='store', type=int, default=4,
+                            help='Pipeline: max images waiting between two stages. Default: 4')
+        return parser
 
-
-        args = parser.parse_args()
+    def prepare_args(self, args):
+        """
+        Checks and completes parsed arguments
+        """
         # self.maskcent = args.pytorch_maskcent
         # self.show_plot = args.show_plot
 
+        if args.write_ir is None:
+            args.write_ir = not args.delete_gray
+
         if args.cpu_mode:
             self.gpu_id = -1
             args.gpu_id = -1
@@ -95,6 +143,22 @@ class Recolor(object):
 
         self.ir_path = os.path.abspath(args.intermediate_representation)
         args.intermediate_representation = self.ir_path
+        return args
+
+    def main(self):
+        args = self.prepare_args(self.get_parser().parse_args())
+        from PIL import Image
+
+        if args.watch:
+            if not os.path.isdir(args.input_path):
+                print('--watch needs a directory as input_path')
+                sys.exit(1)
+            os.makedirs(args.output_path, exist_ok=True)
+            journal = args.journal or os.path.join(args.output_path, ".recolor_journal")
+            watch.watch_folder(args.input_path, lambda path: self.img_recolor(args, path), journal_path=journal,
+                               accept=watch.is_image, settle_time=args.settle_time)
+            self.session.report()
+            return
 
         if not os.path.isdir(args.input_path):
             if not os.path.isfile(args.input_path):
@@ -111,44 +175,304 @@ class Recolor(object):
             os.makedirs(args.output_path, exist_ok=True)
             os.makedirs(args.intermediate_representation, exist_ok=True)
             
-            for root, d_names, f_names in os.walk(args.input_path):
-                for file_name in f_names:
-                    file_path = os.path.join(root, file_name)
-                    relative_path = os.path.relpath(file_path, args.input_path)
-                    output_file = os.path.join(args.output_path, relative_path)
+            if args.pipeline:
+                self.run_pipeline(args, self.get_image_paths(args.input_path))
+            else:
+                for root, d_names, f_names in os.walk(args.input_path):
+                    for file_name in f_names:
+                        file_path = os.path.join(root, file_name)
+                        relative_path = os.path.relpath(file_path, args.input_path)
+                        output_file = os.path.join(args.output_path, relative_path)
+
+
+                        try:
+                            # to check if valid image
+                            Image.open(file_path)
+                            print("\nNow recoloring: ", file_path)
+                            self.img_recolor(args, file_path)
+                        except IOError as err:
+                            print("Skipping non image file: ", file_path)
+                            print(err)
+                            # traceback.print_exc()
+                            print()
+                            pass
+
+        self.session.report()
+
+    def get_encoder_kwargs(self, args, **overrides):
+        """
+        Keyword arguments for Encoder from the parsed arguments
+        """
+        kwargs = dict(output_path=args.intermediate_representation, method=args.method, size=args.size, p=args.p,
+                      grid_size=args.grid_size, plot=args.plot, quantize=args.quantize, write_ir=args.write_ir,
+                      mask_format=args.mask_format, ab_step=args.ab_step, compression=args.compression,
+                      glob_dist_format=args.glob_dist_format, glob_dist_dtype=args.glob_dist_dtype,
+                      archive=args.archive)
+        kwargs.update(overrides)
+        return kwargs
+
+    def get_decoder_kwargs(self, args, **overrides):
+        """
+        Keyword arguments for Decoder from the parsed arguments
+        """
+        kwargs = dict(output_path=args.output_path, method=args.method, size=args.size, p=args.p, gpu_id=args.gpu_id,
+                      plot=args.plot, session=self.session, tile_size=args.tile_size, tile_overlap=args.tile_overlap)
+        kwargs.update(overrides)
+        return kwargs
+
+    def run_batch(self, paths, **options):
+        """
+        Recolors a list of images in this process. Imports and models are loaded only once for all images.
+        :param paths: list of image paths or glob pattern, e.g. "images/*.png"
+        :param options: same as the command line options, e.g. method="ideepcolor-px-grid", size=256, delete_gray=True
+        :return: dict with the time in seconds of every phase
+        """
+        if isinstance(paths, str):
+            paths = sorted(glob.glob(paths, recursive=True))
+        args = self.get_parser().parse_args([])
+        for key, val in options.items():
+            if not hasattr(args, key):
+                raise ValueError("Unknown option: " + key)
+            setattr(args, key, val)
+        args = self.prepare_args(args)
+        os.makedirs(args.output_path, exist_ok=True)
+        if args.write_ir:
+            os.makedirs(args.intermediate_representation, exist_ok=True)
+
+        ec = encoder.Encoder(**self.get_encoder_kwargs(args))
+        dc = decoder.Decoder(**self.get_decoder_kwargs(args))
+
+        times = {"imports": import_time, "model loading": 0.0, "encode": 0.0, "decode": 0.0}
+        recolored = 0
+        for path in paths:
+            try:
+                start = time.perf_counter()
+                ir = ec.encode(path)
+                times["encode"] += time.perf_counter() - start
+
+                load_time = self.session.load_time
+                start = time.perf_counter()
+                dc.decode(ir)
+                load_time = self.session.load_time - load_time
+                times["model loading"] += load_time
+                times["decode"] += time.perf_counter() - start - load_time
+            except Exception as err:
+                print("Error recoloring " + path + ": " + str(err))
+                continue
+            recolored += 1
 
+            img_gray_path = os.path.join(args.intermediate_representation, ir.gray_filename)
+            if args.delete_gray and os.path.exists(img_gray_path):
+                os.remove(img_gray_path)
+        ec.close()
 
+        # one process per image (python recolor.py -i <file>) paid imports and model loading for every image
+        startup = times["imports"] + times["model loading"]
+        print("\nRecolored %d of %d images" % (recolored, len(paths)))
+        print("| Phase | Total (s) | Per image (s) |")
+        print("|---|---|---|")
+        for phase, seconds in times.items():
+            print("| %s | %.3f | %.3f |" % (phase, seconds, seconds / recolored if recolored else 0))
+        print("Startup paid once: %.3fs, with one process per image: ~%.3fs" % (startup, startup * recolored))
+        return times
+
+    def get_image_paths(self, input_path):
+        """
+        Returns all image files in input_path and its subfolders
+        """
+        from PIL import Image
+        paths = []
+        for root, d_names, f_names in os.walk(input_path):
+            for file_name in f_names:
+                file_path = os.path.join(root, file_name)
+                try:
+                    # to check if valid image
+                    Image.open(file_path)
+                    paths.append(file_path)
+                except IOError as err:
+                    print("Skipping non image file: ", file_path)
+        return paths
+
+    def run_pipeline(self, args, paths):
+        """
+        Recolors all images with overlapping stages, connected by bounded queues:
+        reader threads (read + decode image) -> encoder processes -> one decoder thread, which keeps the model loaded.
+        A full queue blocks the stage before it, so at most args.queue_depth images wait between two stages.
+        Prints the utilization of every stage at the end.
+        The intermediate representation is always written as single files, --archive is ignored.
+        """
+        if args.archive:
+            print("Pipeline: --archive is ignored, the intermediate representation is passed on as single files")
+        os.makedirs(args.output_path, exist_ok=True)
+        os.makedirs(args.intermediate_representation, exist_ok=True)
+        jobs = max(1, args.jobs or 1)
+        readers = max(1, args.readers)
+        queue_depth = max(1, args.queue_depth)
+
+        stages = {"read": _StageStats(readers), "encode": _StageStats(jobs), "decode": _StageStats(1)}
+        read_q = queue.Queue(maxsize=queue_depth)
+        decode_q = queue.Queue(maxsize=queue_depth)
+        paths_iter = iter(paths)
+        paths_lock = threading.Lock()
+
+        def read_worker():
+            while True:
+                with paths_lock:
+                    path = next(paths_iter, None)
+                if path is None:
+                    break
+                start = time.perf_counter()
+                bgr = cv2.imread(path, 1)
+                stages["read"].add(time.perf_counter() - start)
+                if bgr is None:
+                    print("Skipping unreadable image: ", path)
+                    continue
+                read_q.put((path, bgr))
+
+        # set, if the decoder couldn't be loaded: the main thread stops, instead of waiting for the full decode_q
+        decoder_failed = threading.Event()
+
+        def put_decode(path):
+            """
+            decode_q.put, blocks if the decoder is behind. Exits with an error, if the decoder couldn't be loaded.
+            """
+            while True:
+                if decoder_failed.is_set():
+                    print("Stopping pipeline, decoder not available")
+                    sys.exit(1)
+                try:
+                    decode_q.put(path, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def decode_worker():
+            try:
+                dc = decoder.Decoder(**self.get_decoder_kwargs(args))
+                # the model is loaded lazily otherwise, a broken model would only fail every single decode
+                dc.load_model()
+            except Exception as err:
+                print("Error loading decoder: ", err)
+                decoder_failed.set()
+                return
+            while True:
+                path = decode_q.get()
+                if path is None:
+                    break
+                img_gray_path = os.path.join(args.intermediate_representation, ar_utils.gen_new_gray_filename(path))
+                start = time.perf_counter()
+                try:
+                    dc.decode(img_gray_path)
+                    stages["decode"].add(time.perf_counter() - start)
+                except Exception as err:
+                    print("Error decoding: ", img_gray_path, err)
+                    # busy, but not a decoded image
+                    stages["decode"].add(time.perf_counter() - start, items=0)
+                if args.delete_gray and os.path.exists(img_gray_path):
+                    os.remove(img_gray_path)
+
+        start_time = time.perf_counter()
+        reader_threads = [threading.Thread(target=read_worker, daemon=True) for i in range(readers)]
+        decoder_thread = threading.Thread(target=decode_worker, daemon=True)
+        for t in reader_threads + [decoder_thread]:
+            t.start()
+
+        def readers_done():
+            for t in reader_threads:
+                t.join()
+            read_q.put(None)
+        threading.Thread(target=readers_done, daemon=True).start()
+
+        # IR is passed to the decoder through the folder, --archive doesn't apply here
+        encoder_kwargs = self.get_encoder_kwargs(args, write_ir=True, archive=None)
+        # spawn: workers start clean, without the models and threads of this process
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=encoder.init_worker,
+                                                    initargs=(encoder_kwargs,)) as pool:
+            # future -> image path
+            in_flight = {}
+
+            def pass_on(done):
+                for future in done:
+                    path = in_flight.pop(future)
                     try:
-                        # to check if valid image
-                        Image.open(file_path)
-                        print("\nNow recoloring: ", file_path)
-                        self.img_recolor(args, file_path)
-                    except IOError as err:
-                        print("Skipping non image file: ", file_path)
-                        print(err)
-                        # traceback.print_exc()
-                        print()
-                        pass
+                        path, busy = future.result()
+                    except Exception as err:
+                        print("Error encoding: ", path, err)
+                        continue
+                    stages["encode"].add(busy)
+                    if decoder_failed.is_set():
+                        # don't start waiting encodes, running ones are waited for by the pool
+                        for f in in_flight:
+                            f.cancel()
+                    put_decode(path)
+
+            while True:
+                item = read_q.get()
+                if item is None:
+                    break
+                in_flight[pool.submit(encoder.encode_in_worker, *item)] = item[0]
+                # every worker busy and queue_depth more waiting -> wait for encoder
+                while len(in_flight) >= jobs + queue_depth:
+                    done, not_done = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    pass_on(done)
+            pass_on(concurrent.futures.wait(in_flight)[0])
 
+        put_decode(None)
+        decoder_thread.join()
+        if decoder_failed.is_set():
+            sys.exit(1)
+        wall_time = time.perf_counter() - start_time
+
+        print("\nPipeline: %d images in %.2fs (%.2f images/s)"
+              % (stages["decode"].items, wall_time, stages["decode"].items / wall_time if wall_time else 0))
+        print("| Stage | Workers | Images | Busy (s) | Utilization |")
+        for name, stage in stages.items():
+            print("| %s | %d | %d | %.2f | %.0f%% |"
+                  % (name, stage.workers, stage.items, stage.busy, 100 * stage.utilization(wall_time)))
 
     def img_recolor(self, args, input_image_path):
         """
-        Performs Encoding and Decoding at once
+        Performs Encoding and Decoding at once. The decoder gets the intermediate representation in memory,
+        writing it to disk is optional (args.write_ir).
         """
         
-        ec = encoder.Encoder(output_path=args.intermediate_representation, method=args.method,
-                             size=args.size, p=args.p, grid_size=args.grid_size, plot=args.plot, quantize=args.quantize)
-        dc = decoder.Decoder(output_path=args.output_path, method=args.method, size=args.size, p=args.p, gpu_id=args.gpu_id, plot=args.plot)
+        dc = decoder.Decoder(**self.get_decoder_kwargs(args))
+        with encoder.Encoder(**self.get_encoder_kwargs(args)) as ec:
+            ir = ec.encode(input_image_path)
+        dc.decode(ir)
 
-        ec.encode(input_image_path)
-        img_gray_name = ar_utils.gen_new_gray_filename(input_image_path)
-        img_gray_path = os.path.join(args.intermediate_representation, img_gray_name)
-        dc.decode(img_gray_path)
+        img_gray_path = os.path.join(args.intermediate_representation, ir.gray_filename)
 
         if args.delete_gray and os.path.exists(img_gray_path):
             os.remove(img_gray_path)
         
 
+class _StageStats(object):
+    """
+    Busy time and processed items of one pipeline stage
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, items=1):
+        """
+        :param items: 0 for failed items, which only count as busy time
+        """
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def utilization(self, wall_time):
+        if not wall_time:
+            return 0.0
+        return self.busy / (wall_time * self.workers)
+
+
 if __name__ == "__main__":
     rc = Recolor()
     rc.main()
\ No newline at end of file
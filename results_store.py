@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Persistent store of image quality results (SQLite), so image_quality.py only computes new or changed pairs and
+metrics on a re-run. A value is valid as long as size and modification time of both images are unchanged.
+
+python results_store.py image_quality.sqlite
+"""
+
+import os, sys
+import time
+import argparse
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    ref_path TEXT NOT NULL,
+    rec_path TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    ab INTEGER NOT NULL,
+    engine TEXT NOT NULL,
+    ref_size INTEGER NOT NULL,
+    ref_mtime_ns INTEGER NOT NULL,
+    rec_size INTEGER NOT NULL,
+    rec_mtime_ns INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (ref_path, rec_path, metric, ab, engine)
+)
+"""
+
+
+class ResultsStore(object):
+    """
+    Table of results keyed by (reference path, recolored path, metric, ab, engine), with size and modification time
+    of both images. Writes are committed in batches, at most commit_interval seconds apart, and on close.
+    """
+
+    def __init__(self, path, commit_interval=1.0):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self._last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def stamp(path):
+        """
+        :return: tuple (size, modification time in ns) of file path
+        """
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, ref_path, rec_path, metrics, ab, engine):
+        """
+        :param metrics: metric names, e.g. ["PSNR", "MS-SSIM"]
+        :return: dict metric -> value of the metrics stored for the current version of both images
+        """
+        try:
+            ref_stamp = self.stamp(ref_path)
+            rec_stamp = self.stamp(rec_path)
+        except OSError:
+            return {}
+        rows = self.connection.execute(
+            "SELECT metric, value FROM results WHERE ref_path=? AND rec_path=? AND ab=? AND engine=? "
+            "AND ref_size=? AND ref_mtime_ns=? AND rec_size=? AND rec_mtime_ns=?",
+            (ref_path, rec_path, int(ab), engine) + ref_stamp + rec_stamp)
+        return {metric: value for metric, value in rows if metric in metrics and value is not None}
+
+    def put(self, ref_path, rec_path, values, ab, engine):
+        """
+        Stores (replaces) the values of a pair
+        :param values: dict metric -> value
+        """
+        ref_stamp = self.stamp(ref_path)
+        rec_stamp = self.stamp(rec_path)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(ref_path, rec_path, metric, int(ab), engine) + ref_stamp + rec_stamp + (float(value),)
+             for metric, value in values.items()])
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
+            self.connection = None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="Results Store", description="Summary of an image quality results store")
+    parser.add_argument("store", type=str, help="SQLite file, e.g. image_quality.sqlite")
+    args = parser.parse_args()
+    if not os.path.isfile(args.store):
+        print("Store not found: " + args.store)
+        sys.exit(1)
+    with ResultsStore(args.store) as store:
+        rows = store.connection.execute(
+            "SELECT metric, ab, engine, COUNT(*), AVG(value) FROM results GROUP BY metric, ab, engine ORDER BY metric")
+        for metric, ab, engine, count, mean in rows:
+            print("%s\t%s\t%s\t%d pairs\tmean %.4f" % (metric, "ab" if ab else "rgb", engine, count,
+                                                       mean if mean is not None else float("nan")))
+
+
+if __name__ == "__main__":
+    main()
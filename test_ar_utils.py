@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Round trips of the "bytes" mask format and the .glob_dist format, against the struct based writers and readers
+they replaced.
+python -m unittest test_ar_utils
+"""
+
+import struct
+import unittest
+import numpy as np
+import cv2
+
+import ar_utils
+import encoder
+
+
+def _old_mask_to_bytes(mask, grid_size=None):
+    """
+    Writer of the "bytes" format before the vectorized Mask.to_bytes
+    """
+    coord_type = "H" if mask.size > 256 else "B"
+    data = struct.pack("H", mask.size)
+    third_byte = mask.p
+    if grid_size:
+        third_byte = third_byte + (1 << 7)
+    data += struct.pack("B", third_byte)
+    if grid_size:
+        data += struct.pack("B", grid_size)
+    for y in range(mask.size):
+        for x in range(mask.size):
+            if mask.mask[0][y][x] == 0:
+                continue
+            if grid_size is None:
+                data += struct.pack(coord_type, y) + struct.pack(coord_type, x)
+            data += struct.pack("b", int(mask.input_ab[0][y][x])) + struct.pack("b", int(mask.input_ab[1][y][x]))
+    return data
+
+
+def _old_mask_from_bytes(data):
+    """
+    Reader of the "bytes" format before the vectorized Mask.from_bytes, one put_point per cue
+    """
+    saved_mask_size = struct.unpack_from("H", data, 0)[0]
+    mask = ar_utils.Mask(saved_mask_size)
+    third_byte = data[2]
+    mask.p = third_byte & 0b1111111
+    pos = 3
+    if (third_byte - mask.p) >= (1 << 7):
+        mask.grid_size = data[3]
+        pos = 4
+    coord_type, coord_bytes = ("H", 2) if saved_mask_size > 256 else ("B", 1)
+    for y in range(mask.size):
+        for x in range(mask.size):
+            if mask.grid_size:
+                if y % mask.grid_size != 0 or x % mask.grid_size != 0:
+                    continue
+            else:
+                if pos + 2 * coord_bytes > len(data):
+                    return mask
+                y, x = struct.unpack_from(coord_type * 2, data, pos)
+                pos += 2 * coord_bytes
+            if pos + 2 > len(data):
+                return mask
+            a, b = struct.unpack_from("bb", data, pos)
+            pos += 2
+            mask.put_point((y, x), (a, b))
+    return mask
+
+
+def _test_image(seed=0, shape=(200, 300)):
+    rng = np.random.RandomState(seed)
+    return cv2.resize(rng.randint(0, 256, (8, 8, 3)).astype(np.uint8), shape[::-1], interpolation=cv2.INTER_CUBIC)
+
+
+def _selective_mask(size, p, count, seed=0):
+    """
+    Cues at random positions, like the selective method places them
+    """
+    rng = np.random.RandomState(seed)
+    mask = ar_utils.Mask(size, p)
+    mask.put_points(rng.randint(0, size, (count, 2)), rng.randint(-110, 110, (count, 2)))
+    return mask
+
+
+def _test_masks():
+    """
+    :return: list of (name, Mask, grid size to save): grid and grid-exclude of the Encoder, selective
+    """
+    masks = []
+    for size, p in ((256, 0), (512, 0), (256, 1)):
+        for method in ("ideepcolor-px-grid", "ideepcolor-px-grid-exclude"):
+            ec = encoder.Encoder(method=method, size=size, p=p, write_ir=False)
+            ir = ec.encode(encoder.ImageContext("test.png", _test_image(size)))
+            for mask, grid_size in ir.masks:
+                masks.append(("%s %d p=%d" % (method, size, p), mask, grid_size))
+        masks.append(("selective %d p=%d" % (size, p), _selective_mask(size, p, 500, seed=size + p), None))
+    return masks
+
+
+def assert_masks_equal(test, expected, actual, msg):
+    test.assertEqual(expected.size, actual.size, msg)
+    test.assertEqual(expected.p, actual.p, msg)
+    np.testing.assert_array_equal(expected.mask, actual.mask, err_msg=msg)
+    np.testing.assert_array_equal(expected.input_ab, actual.input_ab, err_msg=msg)
+
+
+class TestMaskV1(unittest.TestCase):
+    def setUp(self):
+        self.masks = _test_masks()
+
+    def test_bytes_equal_old_writer(self):
+        for name, mask, grid_size in self.masks:
+            self.assertEqual(mask.to_bytes(grid_size), _old_mask_to_bytes(mask, grid_size), name)
+
+    def test_from_bytes_equal_old_reader(self):
+        for name, mask, grid_size in self.masks:
+            data = mask.to_bytes(grid_size)
+            loaded = ar_utils.Mask()
+            loaded.from_bytes(data)
+            assert_masks_equal(self, _old_mask_from_bytes(data), loaded, name)
+            self.assertEqual(loaded.grid_size, grid_size, name)
+
+    def test_round_trip(self):
+        for name, mask, grid_size in self.masks:
+            if mask.p:
+                # p > 0 saves every cell of the patches as a cue, they grow when put again
+                continue
+            loaded = ar_utils.Mask()
+            loaded.from_bytes(mask.to_bytes(grid_size))
+            expected = ar_utils.Mask(mask.size, mask.p)
+            # values are saved as int
+            expected.mask = mask.mask
+            expected.input_ab = np.trunc(mask.input_ab)
+            assert_masks_equal(self, expected, loaded, name)
+
+    def test_save_load(self):
+        import tempfile
+        name, mask, grid_size = self.masks[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mask.save(tmp_dir, "test.png", grid_size)
+            loaded = ar_utils.Mask()
+            loaded.load(tmp_dir, "test.png")
+        expected = ar_utils.Mask()
+        expected.from_bytes(mask.to_bytes(grid_size))
+        assert_masks_equal(self, expected, loaded, name)
+
+
+class TestMaskV2(unittest.TestCase):
+    def setUp(self):
+        self.masks = _test_masks()
+
+    @staticmethod
+    def _load(data):
+        mask = ar_utils.Mask()
+        mask.from_bytes(data)
+        return mask
+
+    def test_same_mask_as_v1(self):
+        for name, mask, grid_size in self.masks:
+            if grid_size and mask.p:
+                # version 1 restores these cues on the grid, see Mask.to_bytes_v2
+                continue
+            expected = self._load(mask.to_bytes(grid_size))
+            for compression in (None, "zlib"):
+                loaded = self._load(mask.to_bytes_v2(grid_size, compression=compression))
+                assert_masks_equal(self, expected, loaded, "%s %s" % (name, compression))
+                self.assertEqual(loaded.grid_size, grid_size, name)
+
+    def test_layouts(self):
+        layouts = {"ideepcolor-px-grid ": ar_utils.MASK_LAYOUT_GRID,
+                   "ideepcolor-px-grid-exclude": ar_utils.MASK_LAYOUT_BITMAP,
+                   "selective": ar_utils.MASK_LAYOUT_COORDS}
+        for name, mask, grid_size in self.masks:
+            if mask.p:
+                continue
+            layout = ar_utils._mask_v2_header.unpack_from(mask.to_bytes_v2(grid_size))[2]
+            expected = [value for key, value in layouts.items() if name.startswith(key)]
+            self.assertEqual([layout], expected, name)
+
+    def test_ab_step(self):
+        for name, mask, grid_size in self.masks:
+            if grid_size and mask.p:
+                continue
+            expected = self._load(mask.to_bytes(grid_size))
+            loaded = self._load(mask.to_bytes_v2(grid_size, ab_step=3))
+            np.testing.assert_array_equal(expected.mask, loaded.mask, err_msg=name)
+            self.assertLessEqual(np.abs(expected.input_ab - loaded.input_ab).max(), 1.5, name)
+
+    def test_parse_size(self):
+        for name, mask, grid_size in self.masks:
+            self.assertEqual(ar_utils.Mask.parse_size(mask.to_bytes(grid_size)), mask.size, name)
+            self.assertEqual(ar_utils.Mask.parse_size(mask.to_bytes_v2(grid_size)), mask.size, name)
+
+    def test_empty_mask(self):
+        mask = ar_utils.Mask(256, 0)
+        loaded = self._load(mask.to_bytes_v2())
+        assert_masks_equal(self, mask, loaded, "empty")
+
+    def test_unknown_version(self):
+        data = bytearray(ar_utils.Mask(256, 0).to_bytes_v2())
+        data[len(ar_utils.MASK_V2_MAGIC)] = 3
+        with self.assertRaises(ValueError):
+            self._load(bytes(data))
+
+
+def _old_glob_dist_to_bytes(glob_dist):
+    """
+    Writer of the .glob_dist format before version 2
+    """
+    data = b""
+    for idx, val in enumerate(glob_dist):
+        if val == 0.0:
+            continue
+        data += struct.pack("h", idx) + struct.pack("f", val)
+    return data
+
+
+def _test_glob_dists():
+    """
+    :return: list of (name, global distribution): sparse, dense, few bins far apart, empty
+    """
+    rng = np.random.RandomState(0)
+    sparse = rng.rand(313) * (rng.rand(313) < 0.2)
+    dense = rng.rand(313)
+    dense[:40] = 0
+    apart = np.zeros(313)
+    apart[[3, 150, 300]] = [0.5, 0.3, 0.2]
+    dists = [("sparse", sparse / sparse.sum()), ("dense", dense / dense.sum()), ("apart", apart),
+             ("empty", np.zeros(313))]
+    return dists
+
+
+class TestGlobDist(unittest.TestCase):
+    def test_v1_bytes_equal_old_writer(self):
+        for name, glob_dist in _test_glob_dists():
+            self.assertEqual(ar_utils.glob_dist_to_bytes(glob_dist), _old_glob_dist_to_bytes(glob_dist), name)
+
+    def test_v1_round_trip(self):
+        for name, glob_dist in _test_glob_dists():
+            loaded = ar_utils.glob_dist_from_bytes(_old_glob_dist_to_bytes(glob_dist))
+            np.testing.assert_array_equal(loaded, glob_dist.astype(np.float32), err_msg=name)
+
+    def test_v2_round_trip(self):
+        # max error relative to the largest value
+        tolerances = {"float32": 0, "float16": 1e-3, "uint8": 0.5 / 255}
+        for name, glob_dist in _test_glob_dists():
+            v1 = ar_utils.glob_dist_from_bytes(ar_utils.glob_dist_to_bytes(glob_dist))
+            for dtype, tolerance in tolerances.items():
+                msg = "%s %s" % (name, dtype)
+                loaded = ar_utils.glob_dist_from_bytes(ar_utils.glob_dist_to_bytes(glob_dist, version=2, dtype=dtype))
+                if dtype != "uint8":
+                    # uint8 rounds the smallest values to 0
+                    np.testing.assert_array_equal(loaded == 0, glob_dist == 0, err_msg=msg)
+                self.assertLessEqual(np.abs(loaded - v1).max(), tolerance * glob_dist.max(), msg)
+
+    def test_v2_smaller(self):
+        for name, glob_dist in _test_glob_dists():
+            if name not in ("sparse", "dense"):
+                # a few values only: the header of version 2 is bigger than what it saves
+                continue
+            v1 = ar_utils.glob_dist_to_bytes(glob_dist)
+            # float32 with a 2 Byte index can be a few Bytes bigger, because of the header
+            for dtype in ("float16", "uint8"):
+                self.assertLess(len(ar_utils.glob_dist_to_bytes(glob_dist, version=2, dtype=dtype)), len(v1),
+                                "%s %s" % (name, dtype))
+
+    def test_save_load(self):
+        import tempfile
+        name, glob_dist = _test_glob_dists()[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = ar_utils.save_glob_dist(tmp_dir, "test.png", glob_dist, version=2, dtype="float32")
+            np.testing.assert_array_equal(ar_utils.load_glob_dist(path), glob_dist.astype(np.float32))
+
+
+if __name__ == "__main__":
+    unittest.main()
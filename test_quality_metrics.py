@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+quality_metrics against skimage and a per channel, per scale reference implementation of MS-SSIM.
+fast_qa isn't a test dependency, "python benchmark.py metrics" prints the differences to it where it is installed.
+python -m unittest test_quality_metrics
+"""
+
+import unittest
+import numpy as np
+import cv2
+from scipy.ndimage import gaussian_filter
+
+import quality_metrics
+from image_quality import skimage_metrics
+
+
+def _planes(seed, shape=(3, 203, 170)):
+    """
+    Smooth random reference planes and a noisy version of them, uint8 range
+    """
+    rng = np.random.RandomState(seed)
+    ref = np.stack([cv2.resize(rng.randint(0, 256, (12, 12)).astype(np.float32), shape[:0:-1],
+                               interpolation=cv2.INTER_CUBIC) for _ in range(shape[0])])
+    ref = np.clip(ref, 0, 255).astype(np.uint8)
+    rec = np.clip(ref.astype(int) + rng.randint(-25, 26, ref.shape), 0, 255).astype(np.uint8)
+    return ref, rec
+
+
+def _ms_ssim_reference(x, y, max_val=255):
+    """
+    MS-SSIM of one plane as Wang et al. 2003, one scale after the other, downsampling with cv2.INTER_AREA
+    """
+    c1 = (quality_metrics.K1 * max_val) ** 2
+    c2 = (quality_metrics.K2 * max_val) ** 2
+    pad = (quality_metrics.WIN_SIZE - 1) // 2
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    scales = quality_metrics.ms_ssim_scales(x.shape)
+    weights = np.array(quality_metrics.MS_SSIM_WEIGHTS[:scales])
+    weights /= weights.sum()
+    result = 1.0
+    for scale in range(scales):
+        if scale:
+            h, w = x.shape[0] // 2 * 2, x.shape[1] // 2 * 2
+            x = cv2.resize(x[:h, :w], (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+            y = cv2.resize(y[:h, :w], (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+
+        def filt(img):
+            return gaussian_filter(img, quality_metrics.SIGMA, truncate=quality_metrics.TRUNCATE, mode="reflect")
+        mu_x, mu_y = filt(x), filt(y)
+        var_x = filt(x * x) - mu_x ** 2
+        var_y = filt(y * y) - mu_y ** 2
+        cov = filt(x * y) - mu_x * mu_y
+        cs = (2 * cov + c2) / (var_x + var_y + c2)
+        if scale == scales - 1:
+            cs = cs * (2 * mu_x * mu_y + c1) / (mu_x ** 2 + mu_y ** 2 + c1)
+        value = cs[pad:-pad, pad:-pad].mean()
+        result *= max(value, 0) ** weights[scale]
+    return result
+
+
+class TestReferenceStats(unittest.TestCase):
+    def test_psnr_ssim_match_skimage(self):
+        ssim_sk, psnr_sk = skimage_metrics()
+        ref, rec = _planes(0)
+        stats = quality_metrics.ReferenceStats.from_planes(ref, 255)
+        results = stats.compare(rec, psnr=True, ssim=True)
+        for c in range(ref.shape[0]):
+            self.assertAlmostEqual(results["PSNR"][c], psnr_sk(ref[c], rec[c], data_range=255), places=10)
+            self.assertAlmostEqual(results["SSIM"][c], ssim_sk(ref[c], rec[c], data_range=255, gaussian_weights=True,
+                                                               sigma=1.5, use_sample_covariance=False), places=10)
+
+    def test_ms_ssim_matches_reference(self):
+        ref, rec = _planes(1)
+        stats = quality_metrics.ReferenceStats.from_planes(ref, 255, quality_metrics.ms_ssim_scales(ref.shape[1:]))
+        # odd sizes on the way: 203x170 -> 101x85 -> 50x42 -> 25x21
+        self.assertEqual(stats.scales, 4)
+        results = stats.compare(rec, ms_ssim=True)
+        for c in range(ref.shape[0]):
+            self.assertAlmostEqual(results["MS-SSIM"][c], _ms_ssim_reference(ref[c], rec[c]), places=10)
+
+    def test_identical_images(self):
+        ref, _ = _planes(2)
+        stats = quality_metrics.ReferenceStats.from_planes(ref, 255, quality_metrics.ms_ssim_scales(ref.shape[1:]))
+        results = stats.compare(ref, psnr=True, ssim=True, ms_ssim=True)
+        self.assertTrue(np.isinf(results["PSNR"]).all())
+        np.testing.assert_allclose(results["SSIM"], 1)
+        np.testing.assert_allclose(results["MS-SSIM"], 1)
+
+    def test_saved_stats(self):
+        import tempfile
+        ref, rec = _planes(3)
+        stats = quality_metrics.ReferenceStats.from_planes(ref, 255, quality_metrics.ms_ssim_scales(ref.shape[1:]))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats.save(tmp_dir)
+            loaded = quality_metrics.ReferenceStats.load(tmp_dir)
+            expected = stats.compare(rec, psnr=True, ssim=True, ms_ssim=True)
+            for metric, values in loaded.compare(rec, psnr=True, ssim=True, ms_ssim=True).items():
+                np.testing.assert_array_equal(values, expected[metric])
+
+
+if __name__ == "__main__":
+    unittest.main()
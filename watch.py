@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Watches a folder and hands over new files as soon as they are completely written.
+Used by the --watch modes of encoder, decoder and recolor, which keep running and keep their models loaded.
+"""
+
+import os, sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import ar_utils
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+_event_header = struct.Struct("iIII")
+
+
+class Journal(object):
+    """
+    Append only file of processed files, so a restarted watcher doesn't process them again.
+    A file counts as new again, if its size or modification time changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.done = set(line.rstrip("\n") for line in f)
+
+    @staticmethod
+    def key(file_path, stat=None):
+        stat = stat if stat is not None else os.stat(file_path)
+        return "%s\t%d\t%d" % (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, key):
+        self.done.add(key)
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(key + "\n")
+
+
+class FolderWatcher(object):
+    """
+    Yields the files in a folder (not its subfolders), first the existing ones, then new ones as they arrive.
+    Uses inotify on Linux and polls the folder everywhere else.
+    A file is only handed over, after its size and modification time didn't change for settle_time seconds,
+    so partially written files are skipped until they are complete.
+    """
+
+    def __init__(self, path, accept=None, journal_path=None, settle_time=1.0, poll_interval=1.0, use_inotify=True):
+        """
+        :param accept: optional function (path) -> bool, to ignore files, e.g. non images
+        :param journal_path: file to record processed files in, None: no journal
+        """
+        self.path = path
+        self.accept = accept
+        self.journal = Journal(journal_path)
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        # path -> (size, mtime, time the file was last seen changing)
+        self.pending = {}
+        # journal keys of files not accepted, to not check them again
+        self.ignored = set()
+        # journal keys of files, that failed in this run: not retried until they change or the watcher restarts
+        self.failed_keys = set()
+        self.running = False
+        self._fd = _inotify_watch(path) if use_inotify else None
+
+    @property
+    def backend(self):
+        return "inotify" if self._fd is not None else "polling"
+
+    def __iter__(self):
+        return self.watch()
+
+    def watch(self):
+        """
+        Generator of complete, not yet processed files. Runs until stop() is called.
+        The caller has to call done(path) after processing a file, to record it in the journal,
+        or failed(path), if processing it failed.
+        """
+        self.running = True
+        self._scan()
+        try:
+            while self.running:
+                for path in self._ready():
+                    yield path
+                    if not self.running:
+                        return
+                self._wait()
+        finally:
+            self.close()
+
+    def done(self, path):
+        """
+        Records path as processed in the journal
+        """
+        try:
+            self.journal.add(Journal.key(path))
+        except OSError:
+            # already deleted again
+            pass
+
+    def failed(self, path):
+        """
+        Records path as failed, only for this run: it is retried, when it changes or the watcher is restarted
+        """
+        try:
+            self.failed_keys.add(Journal.key(path))
+        except OSError:
+            pass
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _scan(self):
+        for fil in os.scandir(self.path):
+            if fil.is_file():
+                self._touch(fil.path)
+
+    def _touch(self, path):
+        """
+        Marks path as possibly new or changed
+        """
+        if path not in self.pending:
+            self.pending[path] = (None, None, time.monotonic())
+
+    def _wait(self):
+        if self._fd is None:
+            time.sleep(self.poll_interval)
+            self._scan()
+            return
+        # wake up for events, or to check if pending files have settled
+        timeout = self.settle_time / 2 if self.pending else self.poll_interval
+        readable = select.select([self._fd], [], [], timeout)[0]
+        if readable:
+            for name in _read_events(self._fd):
+                self._touch(os.path.join(self.path, name))
+
+    def _ready(self):
+        """
+        Pending files, that didn't change for settle_time
+        """
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, changed) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # deleted or moved away
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                if size is None:
+                    # first look: a file not modified for settle_time already is complete, e.g. on startup
+                    changed = now - min(self.settle_time, max(0.0, time.time() - stat.st_mtime))
+                else:
+                    changed = now
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, changed)
+            if stat.st_size == 0 or now - changed < self.settle_time:
+                continue
+            del self.pending[path]
+            key = Journal.key(path, stat)
+            if key in self.journal or key in self.ignored or key in self.failed_keys:
+                continue
+            if self.accept is not None and not self.accept(path):
+                self.ignored.add(key)
+                continue
+            ready.append(path)
+        return sorted(ready)
+
+
+def watch_folder(path, process, journal_path=None, accept=None, settle_time=1.0, poll_interval=1.0):
+    """
+    Calls process(file_path) for every existing and new file in folder path, until interrupted (Ctrl+C).
+    Errors are printed and skip only the file, failed files aren't recorded in the journal and are retried
+    after a restart, or when they change.
+    :return: number of processed files
+    """
+    watcher = FolderWatcher(path, accept=accept, journal_path=journal_path, settle_time=settle_time,
+                            poll_interval=poll_interval)
+    print("Watching %s for new files (%s), stop with Ctrl+C" % (path, watcher.backend))
+    processed = 0
+    try:
+        for file_path in watcher:
+            start = time.perf_counter()
+            try:
+                process(file_path)
+            except Exception as err:
+                print("Error processing " + file_path + ": " + str(err))
+                watcher.failed(file_path)
+                continue
+            processed += 1
+            print("Processed %s in %.3fs" % (file_path, time.perf_counter() - start))
+            watcher.done(file_path)
+    except KeyboardInterrupt:
+        print("\nStopped watching, processed %d file(s)" % processed)
+    return processed
+
+
+def is_image(path):
+    """
+    True, if path is an image file PIL can open
+    """
+    from PIL import Image
+    try:
+        with Image.open(path):
+            return True
+    except IOError:
+        return False
+
+
+def is_gray_image(path):
+    """
+    True, if path is a grayscale image of the intermediate representation (*.gray.*)
+    """
+    return ar_utils.get_fn_wo_ext(path)[2] == ".gray" and is_image(path)
+
+
+def _inotify_watch(path):
+    """
+    :return: non blocking inotify file descriptor watching folder path, None if inotify is not available
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY)
+        if wd < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def _read_events(fd):
+    """
+    :return: names of the files of all waiting inotify events
+    """
+    names = []
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset + _event_header.size <= len(data):
+        wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+        offset += _event_header.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        if name:
+            names.append(os.fsdecode(name))
+    return names